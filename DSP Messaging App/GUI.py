@@ -7,9 +7,12 @@
 
 import tkinter as tk
 from tkinter import ttk, filedialog, TclError
-from Profile import Post, Profile
-from ds_messenger import DirectMessenger, DirectMessage
+from Profile import DsuFileError, Post, Profile, message_key, profile_cache, profile_persister
+from ds_messenger import DirectMessage
+from history_archive import archive_profile
+from ds_sync import Outbox, SyncWorker
 import copy
+import time
 
 
 class Body(tk.Frame):
@@ -37,37 +40,206 @@ class Body(tk.Frame):
         # contact, is accessed in order to send to correct recipient
         self.selected_contact = ''
 
-        # This is what will be tied to each username so that when a contact is clicked on the
-        # TreeView widget, it will display the chat history
-        self._chat_history = []
+        # What message_viewer shows: whose chat it is, how many messages the chat had when the viewer last caught
+        # up with it, and the timestamp of the newest message shown together with the keys of the messages at that
+        # timestamp. A poll only renders what came after.
+        self._rendered_contact = None
+        self._chat_count = 0
+        self._rendered_last = None
+        self._rendered_keys = set()
+
+        # The viewer holds a window of consecutive pages of the chat, newest first, each with the time range it
+        # covers (since <= timestamp < until, None for open ends) and the mark its text starts at, plus the time
+        # ranges of the newer pages that were dropped from the top of the window, the nearest one last.
+        self._pages = []
+        self._newer_pages = []
+        self._mark_count = 0
+        self._paging = False  # a page is about to be added
+
+        # The open profile talks to the server from two threads of its own: the sync worker polls for new messages
+        # and the outbox sends them, each over its own session
+        self._sync_worker = None
+        self._outbox = None
+
+        # how many of the updates the sync worker and the outbox queued are applied per call of update_messages, and
+        # how many milliseconds apart the calls are
+        self.sync_batch = 200
+        self.sync_ms = 50
+
+        # how many messages a page of the viewer holds, how many pages it keeps, and how close to either end of
+        # the viewer (as a fraction of it) scrolling has to get to page in more
+        self.page_size = 200
+        self.max_pages = 5
+        self.page_margin = 0.1
 
         # After all initialization is complete, call the _draw method to pack the widgets
         # into the Body instance 
         self._draw()
 
-    def generate_chat_history(self, messages):
+    def render_chat(self, profile: Profile):
         """
-        This function will take the sent messages from the user and recieved messages from other
-        users and combine them chronologically into ._chat_history and prints to message view in a
-        friendly format
+        Shows the chat with the selected contact in message_viewer, newest message on top. If the viewer already
+        shows that chat, only the messages that arrived since the last call are inserted, so a poll costs as much as
+        the new messages rather than the whole chat. A message that arrived out of order, older than the newest one
+        shown, or more new messages than a page holds, make the chat be drawn again from its latest page.
+
+        Only a window of at most max_pages pages of page_size messages is kept in the viewer (see _page_older and
+        _page_newer). While the newest page is scrolled out of the window, new messages are not inserted; they show
+        up when it is paged back in.
         """
-        sorted_list = self.sort_by_timestamp(messages)
+        contact = self.selected_contact
+        if contact != self._rendered_contact:
+            self._show_latest(profile, contact)
+            return
+        if self._newer_pages:
+            return
 
-        for element in sorted_list:
-            username_frm = element['frm']
-            message = element['message']
-            formatted = f"{username_frm} : {message} \n\n"
+        limit = self.page_size + len(self._rendered_keys) + 1
+        newest = profile.get_chat_messages(contact, since=self._rendered_last, limit=limit)
+        new = [message for message in newest if message_key(message) not in self._rendered_keys]
+        if len(newest) == limit or self._chat_count + len(new) != profile.chat_count(contact):
+            self._show_latest(profile, contact)
+            return
+        if new:
+            self.message_viewer.insert("1.0", self._format_messages(new))
+            self._chat_count += len(new)
+            self._track_newest(new)
+
+    def _format_messages(self, messages) -> str:
+        """returns the text of messages (sorted by timestamp) as the viewer shows them, newest first"""
+        return ''.join(f"{message['frm']} : {message['message']} \n\n" for message in reversed(messages))
+
+    def _track_newest(self, messages) -> None:
+        """records the newest of messages (sorted by timestamp) as the newest message the viewer shows"""
+        last = messages[-1]['timestamp']
+        if last != self._rendered_last:
+            self._rendered_keys = set()
+        self._rendered_keys.update(message_key(message) for message in messages if message['timestamp'] == last)
+        self._rendered_last = last
+
+    def _show_latest(self, profile: Profile, contact) -> None:
+        """Empties message_viewer and shows the latest page of the chat with contact."""
+        self.message_viewer.delete("1.0", "end")
+        for page in self._pages:
+            self.message_viewer.mark_unset(page['mark'])
+        self._pages = []
+        self._newer_pages = []
+        self._rendered_contact = contact
+        self._rendered_last = None
+        self._rendered_keys = set()
+
+        since, messages = self._fetch_page(profile, None)
+        self._add_page(since, None, messages, "end")
+        self._chat_count = profile.chat_count(contact)
+        if messages:
+            self._track_newest(messages)
+
+    def _fetch_page(self, profile: Profile, until) -> tuple:
+        """
+        returns (since, messages): about page_size of the latest messages of the selected chat before until, and the
+        timestamp the page starts at (None if it reaches back to the start of the chat). A page never splits the
+        messages that share a timestamp, so that pages can be fetched again by their time range alone: the messages
+        at the oldest timestamp of a full page are left to the next one.
+        """
+        messages = profile.get_chat_messages(self.selected_contact, until=until, limit=self.page_size)
+        if len(messages) < self.page_size:
+            return None, messages
+        oldest = messages[0]['timestamp']
+        for i, message in enumerate(messages):
+            if message['timestamp'] != oldest:
+                return message['timestamp'], messages[i:]
+        # the whole page shares one timestamp
+        return oldest, profile.get_chat_messages(self.selected_contact, since=oldest, until=until)
+
+    def _add_page(self, since, until, messages, where) -> None:
+        """
+        Inserts a page of messages at the top ("1.0") or the bottom ("end") of message_viewer. Each page starts at a
+        mark with left gravity, so text inserted right at it (new messages, or the page below's text when a newer
+        page is paged in above it) stays on the right side of it.
+        """
+        self._mark_count += 1
+        mark = f"page{self._mark_count}"
+        page = {'since': since, 'until': until, 'mark': mark}
+        viewer = self.message_viewer
+        if where == "end":
+            viewer.mark_set(mark, "end-1c")
+            viewer.mark_gravity(mark, tk.LEFT)
+            viewer.insert("end", self._format_messages(messages))
+            self._pages.append(page)
+        else:
+            below = self._pages[0]['mark']
+            viewer.mark_gravity(below, tk.RIGHT)
+            viewer.insert("1.0", self._format_messages(messages))
+            viewer.mark_gravity(below, tk.LEFT)
+            viewer.mark_set(mark, "1.0")
+            viewer.mark_gravity(mark, tk.LEFT)
+            self._pages.insert(0, page)
+
+    def _keep_view(self, change) -> None:
+        """Calls change, which adds or removes text above the visible part of the viewer, without moving the view."""
+        self.message_viewer.mark_set("view_top", "@0,0")
+        change()
+        self.message_viewer.yview("view_top")
+
+    def _page_older(self) -> None:
+        """
+        Adds the page of messages older than the ones shown at the bottom of message_viewer, and drops the newest
+        page shown if that makes more than max_pages and the page is out of sight above the view.
+        """
+        self._paging = False
+        oldest = self._pages[-1]['since'] if self._pages else None
+        if oldest is None:
+            return
+        profile = profile_cache.get(self.current_path)
+        since, messages = self._fetch_page(profile, oldest)
+        self._add_page(since, oldest, messages, "end")
 
-            if formatted not in self._chat_history:
-                self._chat_history.append(formatted)
+        viewer = self.message_viewer
+        if len(self._pages) > self.max_pages and viewer.compare(self._pages[1]['mark'], '<', "@0,0"):
+            top = self._pages.pop(0)
+            self._keep_view(lambda: viewer.delete("1.0", self._pages[0]['mark']))
+            viewer.mark_unset(top['mark'])
+            self._newer_pages.append((top['since'], top['until']))
 
-    def sort_by_timestamp(self, message_list):
+    def _page_newer(self) -> None:
         """
-        This function takes a list of messages and sorts it by timestamp.
+        Puts the page above the ones shown back at the top of message_viewer, and drops the oldest page shown if
+        that makes more than max_pages and the page is out of sight below the view. When the newest page comes back,
+        the messages that arrived while it was out of the window come with it.
         """
-        sorted_list = sorted(message_list, key=lambda d: d['timestamp'])
-        return sorted_list
-
+        self._paging = False
+        if not self._newer_pages:
+            return
+        profile = profile_cache.get(self.current_path)
+        since, until = self._newer_pages.pop()
+        messages = profile.get_chat_messages(self.selected_contact, since=since, until=until)
+        self._keep_view(lambda: self._add_page(since, until, messages, "1.0"))
+        if until is None:
+            self._chat_count = profile.chat_count(self.selected_contact)
+            if messages:
+                self._track_newest(messages)
+
+        viewer = self.message_viewer
+        bottom = f"@0,{viewer.winfo_height()}"
+        if len(self._pages) > self.max_pages and viewer.compare(self._pages[-1]['mark'], '>', bottom):
+            page = self._pages.pop()
+            viewer.delete(page['mark'], "end")
+            viewer.mark_unset(page['mark'])
+
+    def _viewer_scrolled(self, first, last) -> None:
+        """
+        The yscrollcommand of message_viewer: moves the scrollbar, and pages in older messages when the view gets
+        near the bottom of the viewer (where the oldest messages are) or newer ones when it gets near the top.
+        """
+        self._viewer_scrollbar.set(first, last)
+        if self._paging or not self._pages:
+            return
+        if float(last) > 1 - self.page_margin and self._pages[-1]['since'] is not None:
+            self._paging = True
+            self.after_idle(self._page_older)
+        elif float(first) < self.page_margin and self._newer_pages:
+            self._paging = True
+            self.after_idle(self._page_newer)
 
     def node_select(self, event):
         """
@@ -91,18 +263,12 @@ class Body(tk.Frame):
         index = int(value, 16) - 1
 
         self.selected_contact = self._contacts[index]
-        self.current_profile.load_profile(self.current_path)
-
-        self._chat_history = []
+        self.current_profile = profile_cache.get(self.current_path)
 
-        contact_messages = self.current_profile.get_chat_messages(self.selected_contact)
-        self.generate_chat_history(contact_messages)
-
-        print(self._chat_history)
-        self.message_viewer.delete(0.0, "end")
-
-        for chat in self._chat_history:
-            self.message_viewer.insert(0.0, chat)
+        self._rendered_contact = None
+        self.render_chat(self.current_profile)
+        self.render_outbox()
+        self._user_active()
 
         print("CURENT CONTACT SELECTED: ", self.selected_contact)
 
@@ -119,6 +285,8 @@ class Body(tk.Frame):
         """
         self.message_viewer.delete(0.0, "end")
         self.message_viewer.insert(0.0, text)
+        # the viewer no longer shows a chat
+        self._rendered_contact = None
 
     def set_messages(self, messages: list):
         """
@@ -172,6 +340,7 @@ class Body(tk.Frame):
         self.set_text_entry("")
         self.message_editor.configure(state=tk.NORMAL)
         self._messages = []
+        self.render_outbox()
         for item in self.posts_tree.get_children():
             self.posts_tree.delete(item)
 
@@ -183,39 +352,110 @@ class Body(tk.Frame):
         self.posts_tree.insert('', id, text=contact)
 
 
-    def update_messages(self):
+    def send_message(self, message: str, recipient: str):
         """
-        This function will run on a timer to check for incoming messages to the user and update the profile and GUI
-        accordingly.
+        Queues a message to recipient in the outbox of the open profile, which sends it on its own thread. Until the
+        server has answered, the message is shown in outbox_viewer.
         """
-        current_user = Profile()
-        current_user.load_profile(self.current_path)
-        update_messenger = DirectMessenger(username=current_user.username, password=current_user.password)
-        newmessages = update_messenger.retrieve_new()
-
-        for message in newmessages:
-            if message not in current_user._messages:
-                current_user.add_msg(message)
+        self._start_sync()
+        if self._outbox is None:
+            print("Unable to send the message, the outbox could not be opened.")
+            return
+        self._outbox.send(message, recipient)
+        self.render_outbox()
+        # a reply is likely to follow
+        self._user_active()
 
-        current_user.save_profile(self.current_path)
+    def _user_active(self, event=None):
+        """
+        Lets the sync worker know that the user is chatting, so that it polls for new messages more often.
+        """
+        if self._sync_worker is not None:
+            self._sync_worker.activity()
 
-        if self.selected_contact != '':
-            contact_messages = current_user.get_chat_messages(self.selected_contact)
-            self.generate_chat_history(contact_messages)
+    def render_outbox(self):
+        """
+        Shows the messages to the selected contact that are still being sent, or that the server refused, in
+        outbox_viewer, newest first like message_viewer. Messages that were sent show up in message_viewer instead.
+        """
+        entries = []
+        if self._outbox is not None and self.selected_contact != '':
+            entries = self._outbox.entries(self.selected_contact)
+        status = {'pending': "sending...", 'failed': "not sent"}
+        text = ''.join(f"{self.current_profile.username} : {entry['message']} [{status[entry['status']]}] \n"
+                       for entry in reversed(entries))
+        self.outbox_viewer.configure(state=tk.NORMAL)
+        self.outbox_viewer.delete("1.0", "end")
+        self.outbox_viewer.insert("1.0", text)
+        self.outbox_viewer.configure(state=tk.DISABLED)
 
-            for chat in self._chat_history:
-                if chat not in self.message_viewer.get('1.0', 'end'):
-                    self.message_viewer.insert(0.0, chat)
+    def update_messages(self):
+        """
+        This function will run on a timer to bring incoming messages into the GUI. The server is polled by a
+        SyncWorker on a thread of its own, which merges the messages into the profile and queues them; here, on the
+        GUI's thread, at most sync_batch of them are taken off the queue per call, so that neither a slow server nor
+        a big sync holds up the window.
+        """
+        self._start_sync()
 
-        tree_contact_list = []
+        selected_chat_changed = False
+        # _contacts holds the same names as the tree, without asking Tk for every item
+        tree_contacts = set(self._contacts)
+        for kind, value in self._sync_worker.drain(self.sync_batch):
+            if kind == 'error':
+                print(value)
+                continue
+            sender = value['from']
+            if sender not in tree_contacts:
+                tree_contacts.add(sender)
+                self.add_contact(sender)
+            if sender == self.selected_contact:
+                selected_chat_changed = True
+
+        outbox_changed = False
+        if self._outbox is not None:
+            for entry in self._outbox.drain(self.sync_batch):
+                if entry['recipient'] == self.selected_contact:
+                    outbox_changed = True
+                    # a sent message is in the profile now
+                    selected_chat_changed = selected_chat_changed or entry['status'] == 'sent'
+
+        if selected_chat_changed:
+            self.render_chat(profile_cache.get(self.current_path))
+        if outbox_changed:
+            self.render_outbox()
+
+        # the rest of a big batch is taken as soon as Tk has handled its other events
+        backlog = self._sync_worker.pending() or (self._outbox is not None and self._outbox.pending())
+        self.root.after(ms=1 if backlog else self.sync_ms, func=self.update_messages)
+
+    def _start_sync(self):
+        """
+        Starts the sync worker and the outbox of the open profile, unless they already run for it.
+        """
+        if self._sync_worker is not None and self._sync_worker.path == self.current_path:
+            return
+        self.stop_sync()
+        self._sync_worker = SyncWorker(self.current_path)
+        self._sync_worker.start()
+        try:
+            self._outbox = Outbox(self.current_path)
+        except DsuFileError as ex:
+            print("Unable to open the outbox:", ex)
+            return
+        self._outbox.start()
 
-        for i in self.posts_tree.get_children():
-            tree_contact_list.append(self.posts_tree.item(i)["text"])
-        for user in current_user._users:
-            if user not in tree_contact_list:
-                self.add_contact(user)
-        # print("looping")
-        self.root.after(ms=1000, func=self.update_messages)
+    def stop_sync(self):
+        """
+        Stops the sync worker and the outbox of the open profile, if they run. Messages that were not sent yet stay
+        in the outbox file and are sent the next time the profile is opened.
+        """
+        if self._sync_worker is not None:
+            self._sync_worker.stop()
+            self._sync_worker = None
+        if self._outbox is not None:
+            self._outbox.stop()
+            self._outbox = None
 
     def _draw(self):
         """
@@ -245,15 +485,20 @@ class Body(tk.Frame):
         # -----------------
 
         # NEW WIDGETS ------
+        # the messages of the selected chat that are still in the outbox, above the newest ones in message_viewer
+        self.outbox_viewer = tk.Text(master=view_frame, height=3, width=0, state=tk.DISABLED)
+        self.outbox_viewer.pack(fill=tk.X, side=tk.TOP, padx=1, pady=1)
+
         self.message_viewer = tk.Text(master=view_frame, height=20, width=0)
         self.message_viewer.pack(fill=tk.BOTH, side=tk.LEFT, expand=True, padx=1, pady=1)
 
         self.message_editor = tk.Text(master=message_frame, height=10, width=0)
         self.message_editor.pack(fill=tk.BOTH, side=tk.TOP, expand=True)
+        self.message_editor.bind("<Key>", self._user_active, add="+")
 
-        message_viewer_scrollbar = tk.Scrollbar(master=viewer_scroll_frame, command=self.message_viewer.yview)
-        self.message_viewer['yscrollcommand'] = message_viewer_scrollbar.set
-        message_viewer_scrollbar.pack(fill=tk.Y, side=tk.LEFT, expand=False, padx=0, pady=0)
+        self._viewer_scrollbar = tk.Scrollbar(master=viewer_scroll_frame, command=self.message_viewer.yview)
+        self.message_viewer['yscrollcommand'] = self._viewer_scrolled
+        self._viewer_scrollbar.pack(fill=tk.Y, side=tk.LEFT, expand=False, padx=0, pady=0)
 
         message_editor_scrollbar = tk.Scrollbar(master=editor_scroll_frame, command=self.message_editor.yview)
         self.message_editor['yscrollcommand'] = message_editor_scrollbar.set
@@ -265,11 +510,12 @@ class Footer(tk.Frame):
     A subclass of tk.Frame that is responsible for drawing all of the widgets
     in the footer portion of the root frame.
     """
-    def __init__(self, root, send_callback=None, add_callback=None):
+    def __init__(self, root, send_callback=None, add_callback=None, search_callback=None):
         tk.Frame.__init__(self, root)
         self.root = root
         self._send_callback = send_callback
         self._add_callback = add_callback
+        self._search_callback = search_callback
 
         # IntVar is a variable class that provides access to special variables
         # for Tkinter widgets. is_online is used to hold the state of the chk_button widget.
@@ -297,6 +543,20 @@ class Footer(tk.Frame):
         if self._send_callback is not None:
             self._send_callback()
 
+    def search_click(self, event=None):
+        """
+        Calls the callback function specified in the search_callback class attribute, if
+        available, when the search button has been clicked or Enter pressed in the search box.
+        """
+        if self._search_callback is not None:
+            self._search_callback()
+
+    def get_search_text(self) -> str:
+        """
+        Returns the text that is currently in the search box.
+        """
+        return self.search_entry.get().strip()
+
     def _draw(self):
         """
         Call only once upon initialization to add widgets to the frame
@@ -310,6 +570,14 @@ class Footer(tk.Frame):
         add_user_button.configure(command=self.add_click)
         add_user_button.pack(fill=tk.BOTH, side=tk.LEFT, padx=10, pady=5)
 
+        self.search_entry = tk.Entry(master=self, width=25)
+        self.search_entry.bind("<Return>", self.search_click)
+        self.search_entry.pack(fill=tk.BOTH, side=tk.LEFT, padx=5, pady=5)
+
+        search_button = tk.Button(master=self, text="Search", width=10)
+        search_button.configure(command=self.search_click)
+        search_button.pack(fill=tk.BOTH, side=tk.LEFT, padx=5, pady=5)
+
 
 class MainApp(tk.Frame):
     """
@@ -334,23 +602,17 @@ class MainApp(tk.Frame):
     def send_message(self):
         """
         Takes the message from the message editor and sends it through the DSP server
-        to the specified username
+        to the specified username. The message goes into the outbox, which sends it in the
+        background, so this returns right away.
         """
-        # May need to plan this to accept an index from a contacts list instead of
-        # passing in a username. 
         message = self.body.get_text_entry()
         self.body.message_editor.delete(0.0, "end")
-        dm_user = DirectMessenger(username=self._current_profile.username,
-                                  password=self._current_profile.password)
-
-        dm_user.send(message, self.body.selected_contact)
+        if self._profile_filename is False or self.body.selected_contact == '':
+            print("Open a profile and select a contact before sending a message.")
+            return
 
-        currentprofile = Profile()
-        if self._profile_filename is not False:
-            currentprofile.load_profile(self._profile_filename)
-            currentprofile.add_msg(dm_user.sent_messages[0])
-            currentprofile.save_profile(self._profile_filename)
-        print("MESSAGE SENT")
+        self.body.send_message(message, self.body.selected_contact)
+        print("MESSAGE QUEUED")
 
     def new_profile(self):
         """
@@ -421,15 +683,9 @@ class MainApp(tk.Frame):
         self._current_profile.username = self.user_input.get("1.0", 'end-1c')
         self._current_profile.password = self.password_input.get("1.0", 'end-1c')
 
-        messenger = DirectMessenger(username=self._current_profile.username, password=self._current_profile.password)
-        username_valid = True
-        try:
-            messenger.retrieve_all()
-        except UnboundLocalError:
-            self._current_profile.username = "dusername123"
-            self._current_profile.password = "dpassword123"
-
-        self._current_profile.save_profile(self._profile_filename)
+        # the sync worker started by update_messages downloads the account's history, and reports it if the server
+        # does not accept the username and password
+        profile_cache.save(self._profile_filename, self._current_profile)
         self.body.update_messages()
         self.newfile_popup.destroy()
 
@@ -442,7 +698,7 @@ class MainApp(tk.Frame):
             print("No filename provided.")
             return
 
-        self._current_profile.load_profile(self._profile_filename)  # Load first
+        self._current_profile = profile_cache.get(self._profile_filename)  # Load first
         contact = self.contact_input.get("1.0", 'end-1c')
 
         # If contact is nothing, do not add
@@ -450,14 +706,14 @@ class MainApp(tk.Frame):
             return
         elif contact not in self.body._contacts:
             self.body.add_contact(contact)
-            self._current_profile._users = self.body.get_contacts()
+            self._current_profile.add_user(contact)
 
             print("CURRENT USERS from MAINAPP: ", self._current_profile._users)
 
         else:
             print("Contact already exists.")
 
-        self._current_profile.save_profile(self._profile_filename)  # Save last
+        profile_persister.mark_dirty(self._profile_filename)  # Save last
         self.add_popup.destroy()
 
     def open_profile(self):
@@ -469,8 +725,7 @@ class MainApp(tk.Frame):
             filename = tk.filedialog.askopenfile(filetypes=[('Distributed Social Profile', '*.dsu')])
             try:
                 self._profile_filename = filename.name
-                self._current_profile = Profile()
-                self._current_profile.load_profile(self._profile_filename)
+                self._current_profile = profile_cache.get(self._profile_filename)
                 self.body.reset_ui()  # Reset UI
                 # self.body.set_messages(self._current_profile._messages)
                 self.body.set_contacts(self._current_profile._users)
@@ -487,10 +742,59 @@ class MainApp(tk.Frame):
 
     def close(self):
         """
-        Closes the program when the 'Close' menu item is clicked.
+        Closes the program when the 'Close' menu item is clicked or the window is closed, after writing the
+        changes to the profile that have not been saved yet.
         """
+        # the worker and the outbox go first, so that the messages of a sync or send that is under way are saved
+        # as well
+        self.body.stop_sync()
+        profile_persister.close()
         self.root.destroy()
 
+    def search_messages(self):
+        """
+        Searches the messages of the open profile (only the selected contact's, if one is selected) for the words
+        in the search box and shows the newest matches in a popup window. A word ending in '*' matches any word
+        that starts with it.
+        """
+        query = self.footer.get_search_text()
+        if self._profile_filename is False or not query:
+            return
+
+        profile = profile_cache.get(self._profile_filename)
+        contact = self.body.selected_contact or None
+        results = profile.search(query, contact=contact, limit=100)
+
+        search_popup = tk.Toplevel()
+        search_popup.title(f"Search: {query}")
+        results_viewer = tk.Text(master=search_popup, height=20, width=60)
+        results_viewer.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
+        if not results:
+            results_viewer.insert('end', "No messages found.")
+        for message in results:
+            when = time.strftime('%Y-%m-%d %H:%M', time.localtime(message['timestamp']))
+            results_viewer.insert('end', f"[{when}] {message['from']} -> {message['recipient']} : "
+                                         f"{message['message']}\n\n")
+        results_viewer.configure(state=tk.DISABLED)
+
+    def archive_history(self):
+        """
+        Moves the older messages of the open DSU file into its compressed archive when the 'Archive old messages'
+        menu item is clicked, and prints how much disk and memory that saved.
+        """
+        if self._profile_filename is False:
+            print("No filename provided")
+            return
+
+        # the archive is made from the file, so it has to hold every change first
+        profile_persister.flush()
+        report = archive_profile(self._profile_filename)
+        self._current_profile = profile_cache.get(self._profile_filename)
+        self.body.current_profile = self._current_profile
+        print(f"Archived {report['messages_archived']} messages in {report['segments_written']} segments, "
+              f"saving {report['disk_bytes_saved']} bytes on disk and about {report['memory_bytes_saved']} bytes "
+              f"of memory.")
+
     def save_profile(self):
         """
         Saves the text currently in the message_editor widget to the active DSU file.
@@ -499,11 +803,15 @@ class MainApp(tk.Frame):
         if self._profile_filename is False:
             print("No filename provided")
             return
+        profile_persister.flush()
 
     def _draw(self):
         """
         Call only once, upon initialization to add widgets to root frame
         """
+        # Closing the window has to go through close as well, so that the last changes are written
+        self.root.protocol("WM_DELETE_WINDOW", self.close)
+
         # Build a menu and add it to the root frame.
         menu_bar = tk.Menu(self.root)
         self.root['menu'] = menu_bar
@@ -511,12 +819,14 @@ class MainApp(tk.Frame):
         menu_bar.add_cascade(menu=menu_file, label='File')
         menu_file.add_command(label='New', command=self.new_profile)
         menu_file.add_command(label='Open...', command=self.open_profile)
+        menu_file.add_command(label='Archive old messages', command=self.archive_history)
         menu_file.add_command(label='Close', command=self.close)
 
         # The Body and Footer classes must be initialized and packed into the root window.
         self.body = Body(self.root, self._current_profile)
         self.body.pack(fill=tk.BOTH, side=tk.TOP, expand=True)
-        self.footer = Footer(self.root, send_callback=self.send_message, add_callback=self.add_user_window)
+        self.footer = Footer(self.root, send_callback=self.send_message, add_callback=self.add_user_window,
+                             search_callback=self.search_messages)
         self.footer.pack(fill=tk.BOTH, side=tk.BOTTOM)
 
 
@@ -16,9 +16,15 @@
 # YOU DO NOT NEED TO READ OR UNDERSTAND THE JSON SERIALIZATION ASPECTS OF THIS CODE RIGHT NOW, 
 # though can you certainly take a look at it if you are curious.
 #
-import json, time, os
+import atexit, functools, heapq, json, math, time, os, shutil, threading, weakref
+from array import array
+from bisect import bisect_left, bisect_right
 from pathlib import Path
 from ds_messenger import DirectMessage
+from history_archive import HistoryArchive, archive_path
+from message_store import ContactTable, MessageStore
+from post_timeline import PostTimeline
+from search_index import SearchIndex, matches, query_terms, read_search_header, search_index_path
 
 """
 DsuFileError is a custom exception handler that you should catch in your own code. It
@@ -51,8 +57,12 @@ class Post(dict):
 
     """
 
+    # the values already live in the dict itself, so instances skip the per-object __dict__
+    __slots__ = ('_entry', '_timestamp', '_id')
+
     def __init__(self, entry: str = None, timestamp: float = 0):
         self._timestamp = timestamp
+        self._id = None
         self.set_entry(entry)
 
         # Subclass dict to expose Post properties for serialization
@@ -77,6 +87,13 @@ class Post(dict):
     def get_time(self):
         return self._timestamp
 
+    def get_id(self):
+        """
+        returns the id the post was given when it was added to a Profile (see Profile.del_post_by_id), or None. Ids
+        only last as long as the Profile object, they are not saved.
+        """
+        return self._id
+
     """
 
     The property method is used to support get and set capability for entry and time values.
@@ -86,6 +103,226 @@ class Post(dict):
     """
     entry = property(get_entry, set_entry)
     timestamp = property(get_time, set_time)
+    id = property(get_id)
+
+
+def message_key(message: dict) -> tuple:
+    """
+    returns the identity of a message: who sent it, who received it, when, and what it says. Two messages with the
+    same key are treated as the same message.
+    """
+    return message['from'], message['recipient'], float(message['timestamp']), message['message']
+
+
+def journal_path(path) -> Path:
+    """
+    returns the path of the append-only journal that belongs to the DSU file at path
+    """
+    p = Path(path)
+    return p.with_name(p.name + '.journal')
+
+
+def chat_index_path(path) -> Path:
+    """
+    returns the path of the chat index that belongs to the DSU file at path. The index records where the header of
+    the file ends and where each chat's messages are in it, so that a profile can be opened lazily.
+    """
+    p = Path(path)
+    return p.with_name(p.name + '.idx')
+
+
+def read_ndjson(path, stats: dict = None):
+    """
+    yields the entries of an NDJSON file written by Profile.export_ndjson, reading it one line at a time. Every entry
+    is either {'msg': message} or {'post': post}; messages are returned with a 'from' key even if the line used
+    'frm'. Lines that are not such an entry are skipped, and counted in stats['skipped'] if stats is given.
+
+    Raises OSError
+    """
+    with open(path, 'rb') as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+                if 'msg' in entry:
+                    message = entry['msg']
+                    entry = {'msg': {'from': message['from'] if 'from' in message else message['frm'],
+                                     'recipient': message['recipient'], 'timestamp': float(message['timestamp']),
+                                     'message': message['message']}}
+                elif 'post' in entry:
+                    post = entry['post']
+                    entry = {'post': {'entry': post['entry'], 'timestamp': float(post['timestamp'])}}
+                else:
+                    raise KeyError('msg')
+            except (ValueError, UnicodeDecodeError, KeyError, TypeError):
+                if line.strip() and stats is not None:
+                    stats['skipped'] = stats.get('skipped', 0) + 1
+                continue
+            yield entry
+
+
+def _read_chat_index(path):
+    """
+    returns the chat index of the DSU file at path, or None if there is none or it was written for an older version
+    of the file
+    """
+    try:
+        with open(chat_index_path(path), 'r') as f:
+            index = json.load(f)
+        stat = os.stat(path)
+    except (OSError, ValueError):
+        return None
+    if index.get('base') != [stat.st_mtime_ns, stat.st_size]:
+        return None
+    return index
+
+
+# One lock per DSU file, shared by every Profile in the process, so that appends, loads and compaction of the same
+# file never interleave.
+_file_locks = {}
+_file_locks_guard = threading.Lock()
+_compacting = set()
+
+# every ProfileCache in the process, so that compaction can tell them the file it rewrote still holds the same profile
+_caches = weakref.WeakSet()
+
+
+def _file_lock(path) -> threading.RLock:
+    key = os.path.abspath(path)
+    with _file_locks_guard:
+        return _file_locks.setdefault(key, threading.RLock())
+
+
+def compact_profile(path) -> None:
+    """
+    folds the journal of the DSU file at path into a new base snapshot and removes the journal
+
+    Raises DsuProfileError, DsuFileError
+    """
+    with _file_lock(path):
+        before = _file_signature(path)
+        profile = Profile()
+        profile.load_profile(path)
+        profile._write_snapshot(Path(path))
+        after = _file_signature(path)
+    # The file holds the same profile as before, so a cached profile that was up to date with it still is and must
+    # not be loaded again (losing whatever it has not saved yet). Done after letting go of the file lock, since
+    # ProfileCache takes its own lock before the file's.
+    for cache in list(_caches):
+        cache._rewritten(path, before, after)
+
+
+def _compact_in_background(path) -> None:
+    key = os.path.abspath(path)
+    with _file_locks_guard:
+        if key in _compacting:
+            return
+        _compacting.add(key)
+
+    def run():
+        try:
+            compact_profile(path)
+        except (DsuFileError, DsuProfileError) as ex:
+            print("Unable to compact the DSU journal:", ex)
+        finally:
+            with _file_locks_guard:
+                _compacting.discard(key)
+
+    threading.Thread(target=run, name="DsuCompaction", daemon=True).start()
+
+
+class _JsonChatSource:
+    """
+    Reads single chats out of a DSU file for a lazily loaded Profile, using the file's chat index.
+    """
+
+    def __init__(self, path, index: dict):
+        self.path = os.path.abspath(path)
+        self._index = index
+
+    def peers(self) -> list:
+        return [chat[0] for chat in self._index['chats']]
+
+    def count(self, username) -> int:
+        return sum(chat[3] for chat in self._index['chats'] if chat[0] == username)
+
+    def read_chat(self, username):
+        """
+        returns the messages of the chat with username as (from, recipient, timestamp, message) tuples, or None if
+        the file was rewritten without a chat index and single chats can no longer be found in it
+        """
+        with _file_lock(self.path):
+            # the file may have been compacted since it was opened, in which case it has a new index (or none)
+            index = _read_chat_index(self.path)
+            if index is None:
+                return None
+            self._index = index
+            messages = []
+            with open(self.path, 'rb') as f:
+                for peer, start, end, *rest in index['chats']:
+                    if peer == username:
+                        f.seek(start)
+                        messages = json.loads('[' + f.read(end - start).decode() + ']')
+
+        return [(message["frm"], message["recipient"], float(message["timestamp"]), message["message"])
+                for message in messages]
+
+    def read_range(self, username, since: float = None, until: float = None, limit: int = None):
+        """
+        returns the messages of the chat with username with since <= timestamp < until (only the latest `limit` of
+        them, if given) as (from, recipient, timestamp, message) tuples, sorted by timestamp. Only the blocks of the
+        chat that can hold them are read, using the block offsets in the chat index. Returns None if the index has
+        no block offsets (it was written by an older version) or single chats can no longer be found in the file.
+        """
+        with _file_lock(self.path):
+            index = _read_chat_index(self.path)
+            if index is None:
+                return None
+            self._index = index
+            chat = next((chat for chat in index['chats'] if chat[0] == username), None)
+            if chat is None:
+                return []
+            if len(chat) < 5:
+                return None
+
+            peer, start, end, count, blocks = chat
+            found = []
+            with open(self.path, 'rb') as f:
+                for i in range(len(blocks) - 1, -1, -1):
+                    offset, first = blocks[i]
+                    if until is not None and first >= until:
+                        continue
+                    f.seek(offset)
+                    text = f.read((blocks[i + 1][0] if i + 1 < len(blocks) else end) - offset).decode()
+                    keys = [(message["frm"], message["recipient"], float(message["timestamp"]), message["message"])
+                            for message in json.loads('[' + text.lstrip(', ') + ']')]
+                    found[:0] = [key for key in keys
+                                 if (since is None or key[2] >= since) and (until is None or key[2] < until)]
+                    # the blocks before this one only hold messages at or before its first timestamp
+                    if (limit is not None and len(found) >= limit) or (since is not None and first < since):
+                        break
+        return found if limit is None else found[max(0, len(found) - limit):]
+
+    def read_all(self) -> list:
+        """
+        returns every message in the file as (from, recipient, timestamp, message) tuples
+        """
+        with _file_lock(self.path):
+            with open(self.path, 'r') as f:
+                messages = json.load(f)['_messages']
+        return [(message["frm"], message["recipient"], float(message["timestamp"]), message["message"])
+                for message in messages]
+
+    def close(self) -> None:
+        pass
+
+
+def _locked(method):
+    """makes a Profile method hold the profile's lock, see Profile._lock"""
+    @functools.wraps(method)
+    def locked(self, *args, **kwargs):
+        with self._lock:
+            return method(self, *args, **kwargs)
+    return locked
 
 
 class Profile:
@@ -106,96 +343,544 @@ class Profile:
         self.username = username  # REQUIRED
         self.password = password  # REQUIRED
         self.bio = ''  # OPTIONAL
-        self._posts = []  # OPTIONAL
+        self._posts = PostTimeline()  # OPTIONAL, kept sorted by timestamp
+
+        # The usernames of users that you have messages with, in the order they were added. Every username the
+        # profile sees is interned here, and messages refer to their sender and recipient by its id.
+        self._users = ContactTable()
+
+        # all messages, stored column by column (see message_store.MessageStore) and read back as dict-like views
+        self._messages = MessageStore(self._users)
+
+        # The latest server timestamp seen from each user, and when the profile last synced with the server. Used by
+        # DirectMessenger.sync to fetch only what the profile does not have yet.
+        self._sync_cursor = {}
+        self._last_sync = 0
+
+        # Every chat's messages (as rows of self._messages) sorted by timestamp, kept next to an array of just the
+        # timestamps so that a range of the chat, or a message add_msg may already have, can be found with a binary
+        # search. Rebuilt on load and never saved.
+        self._chats = {}
+        self._chat_times = {}
+
+        # What the DSU file and its journal on disk already hold, so save_profile only has to append what changed
+        # since, and the rows of self._messages added since then. A _journal_state of None means the file has to be
+        # rewritten from scratch on the next save.
+        self._journal_state = None
+        self._unsaved = []
+        self._unsaved_posts = []
+
+        # When the profile was loaded lazily, the chats that have not been read from the file yet, each with the
+        # messages for it found in the journal, and the source they are read from (see _JsonChatSource).
+        self._lazy_chats = {}
+        self._lazy_source = None
 
-        self._messages = []
+        # the archive of older messages that belongs to the profile's file, if it has one (see history_archive)
+        self._archive = None
 
-        self._users = []  # This list used to store the usernames of users that you have messages with
+        # The full-text index behind search, kept up to date by add_msg once it exists. It is saved next to the file
+        # with every new base file, and built from the messages the first time search needs it if there is none.
+        # A saved index is only read when search first needs it; until then _search_pending holds its path and base
+        # and the messages that are not in it yet, as (peer, timestamp, text).
+        self._search_index = None
+        self._search_pending = None
+
+        # Held by the methods that change the profile (or read chats into it) and by save_profile, so that a profile
+        # can be saved on a background thread (see ProfilePersister) while the program keeps using it.
+        self._lock = threading.RLock()
+
+    # attributes that only exist in memory and are left out of the saved DSU file
+    _RUNTIME_FIELDS = ('_chats', '_chat_times', '_journal_state', '_unsaved', '_unsaved_posts', '_lazy_chats',
+                       '_lazy_source', '_archive', '_search_index', '_search_pending', '_lock')
+
+    # attributes that are saved as a whole whenever one of them changes
+    _HEADER_FIELDS = ('dsuserver', 'username', 'password', 'bio', '_last_sync')
+
+    # once the journal grows past this many bytes, a save folds it into the base file on a background thread
+    journal_compact_bytes = 1024 * 1024
+
+    # how many messages of a chat the chat index of a DSU file finds at a time
+    chat_block_messages = 1000
 
     #  Done: Write a function that goes through all the messages and returns a list of all the posts to/from a specific
     #   user. You should be able to enter a username into the function as a parameter and get a list of all their
     #   sent/received messages.
 
-    def get_chat_messages(self, username: str) -> list:
+    @_locked
+    def get_chat_messages(self, username: str, since: float = None, until: float = None, limit: int = None) -> list:
         """
-        accepts a username and returns a list of all the messages in the chat with that user
+        accepts a username and returns a list of the messages in the chat with that user, sorted by timestamp
+
+        :param since: only return messages sent at or after this timestamp
+        :param until: only return messages sent before this timestamp
+        :param limit: only return the latest `limit` messages of the range, so that older pages can be fetched by
+                      passing the timestamp of the oldest message already shown as `until`
+
+        Messages that were moved to the profile's archive (see history_archive.archive_profile) are only read back
+        when the range reaches back to them, or the limit cannot be filled with newer messages.
+
+        If the profile was loaded lazily and has not read the chat yet, a query with since or limit only reads the
+        part of the chat it needs from the file (see _peek_chat), and leaves the chat unread.
+        """
+        if username in self._lazy_chats and (since is not None or limit is not None):
+            messages = self._peek_chat(username, since, until, limit)
+            if messages is not None:
+                return messages
+        self._load_chat(username)
+        rows = self._chats.get(username, ())
+        times = self._chat_times.get(username, ())
+
+        start = 0 if since is None else bisect_left(times, since)
+        end = len(times) if until is None else bisect_left(times, until)
+        if limit is not None:
+            # older messages of the chat cannot make it into the result, so they are never turned into views
+            start = max(start, end - limit)
+        messages = [self._messages[row] for row in rows[start:end]]
+
+        if self._archive is not None and self._archive.segments(username):
+            older = self._archive.messages(username, since, until, limit, times[start:end])
+            if older:
+                # messages that arrived late can be older than the newest archived ones
+                messages = sorted(older + messages, key=lambda message: message['timestamp'])
+        if limit is not None:
+            messages = messages[max(0, len(messages) - limit):]
+        return messages
+
+    def _peek_chat(self, username, since, until, limit):
+        """
+        returns what get_chat_messages would for a chat that has not been read from the file yet, reading just the
+        messages in the range from the file, or None if the chat's source cannot do that (or the chat has archived
+        messages, which are left to get_chat_messages)
+        """
+        read_range = getattr(self._lazy_source, 'read_range', None)
+        if read_range is None or (self._archive is not None and self._archive.segments(username)):
+            return None
+        keys = read_range(username, since, until, limit)
+        if keys is None:
+            return None
+
+        pending = [key for key in self._lazy_chats[username]
+                   if (since is None or key[2] >= since) and (until is None or key[2] < until)]
+        if pending:
+            keys = sorted(dict.fromkeys(keys + pending), key=lambda key: key[2])
+        if limit is not None:
+            keys = keys[max(0, len(keys) - limit):]
+        # the messages are handed out as views like the profile's own, but are not added to it
+        store = MessageStore(self._users)
+        return [store[store.append_fields(*key)] for key in keys]
+
+    @_locked
+    def chat_count(self, username: str) -> int:
+        """
+        returns how many messages the chat with username has, without reading the chat from the file if the profile
+        was loaded lazily (messages that appear twice in the file may be counted twice)
+        """
+        count = len(self._chats.get(username, ()))
+        if username in self._lazy_chats:
+            count += len(self._lazy_chats[username]) + self._lazy_source.count(username)
+        if self._archive is not None:
+            count += self._archive.count(username)
+        return count
+
+    def _chat_peer(self, frm, recipient):
+        """
+        returns the user whose chat a message between frm and recipient belongs to: the recipient for messages the
+        profile's user sent, and the sender for everything else
         """
+        return recipient if frm == self.username else frm
 
-        chat_messages = []
+    def _has_msg(self, key: tuple) -> bool:
+        """
+        returns True if the profile already has the message with the given message_key, found with a binary search
+        on the timestamp in the message's chat
+        """
+        frm, recipient, timestamp, _ = key
+        peer = self._chat_peer(frm, recipient)
+        self._load_chat(peer)
+        rows = self._chats.get(peer)
+        if rows is not None:
+            times = self._chat_times[peer]
+            for index in range(bisect_left(times, timestamp), bisect_right(times, timestamp)):
+                if self._messages.row(rows[index]) == key:
+                    return True
+        return self._archive is not None and self._archive.has(peer, key)
+
+    def _drop_messages(self, keep) -> None:
+        """
+        rebuilds the message store with only the given rows of it, e.g. once the others have been archived
+        """
+        messages = [self._messages.row(row) for row in sorted(keep)]
+        self._messages = MessageStore(self._users)
+        self._chats = {}
+        self._chat_times = {}
+        self._unsaved = []
+        for key in messages:
+            self._index_chat(self._messages.append_fields(*key))
+        self._journal_state = None
+
+    def _index_chat(self, row: int) -> None:
+        """
+        adds a row of self._messages to the chat it belongs to, keeping the chat sorted by timestamp
+        """
+        frm, recipient, timestamp, _ = self._messages.row(row)
+        peer = self._chat_peer(frm, recipient)
+        rows = self._chats.get(peer)
+        if rows is None:
+            rows = self._chats[peer] = array('l')
+            self._chat_times[peer] = array('d')
+        times = self._chat_times[peer]
+        index = bisect_right(times, timestamp)
+        times.insert(index, timestamp)
+        rows.insert(index, row)
+
+    def get_sync_cursor(self, username: str) -> float:
+        """
+        returns the latest server timestamp seen in a message from username, or 0 if there is none
+        """
+        return self._sync_cursor.get(username, 0)
 
-        for message in self._messages:
-            if (message['from'] == username or message['recipient'] == username):
-                chat_messages.append(message)
+    def get_last_sync(self) -> float:
+        """
+        returns when the profile last synced with the server, or 0 if it never has
+        """
+        return self._last_sync
 
-        return chat_messages
+    @_locked
+    def set_last_sync(self, timestamp: float) -> None:
+        """
+        records that the profile synced with the server at timestamp
+        """
+        self._last_sync = timestamp
 
-    def add_post(self, post: Post) -> None:
+    @_locked
+    def update_sync_cursor(self, username: str, timestamp: float) -> None:
+        """
+        moves the sync cursor for username forward to timestamp (it never moves back)
         """
+        if timestamp > self._sync_cursor.get(username, 0):
+            self._sync_cursor[username] = timestamp
 
-        add_post accepts a Post object as parameter and appends it to the posts list. Posts are stored in a
-        list object in the order they are added. So if multiple Posts objects are created, but added to the
-        Profile in a different order, it is possible for the list to not be sorted by the Post.timestamp property.
-        So take caution as to how you implement your add_post code.
+    @_locked
+    def add_post(self, post: Post) -> int:
+        """
+
+        add_post accepts a Post object as parameter and adds it to the posts, which are kept sorted by the
+        Post.timestamp property no matter in which order they are added. Returns the id the post was given (also
+        available as post.id).
 
         """
-        self._posts.append(post)
+        self._unsaved_posts.append(post)
+        return self._posts.add(post)
 
-    def add_msg(self, message: DirectMessage) -> None:
+    @_locked
+    def add_posts(self, posts) -> list:
+        """
+        adds many Post objects at once, in any order, and returns their ids. Cheaper than calling add_post for each
+        when the batch is large.
         """
+        posts = list(posts)
+        self._unsaved_posts.extend(posts)
+        return self._posts.extend(posts)
 
-        add_msg accepts a DirectMessage object as parameter and appends it to the messages list.
+    @_locked
+    def get_posts_between(self, start: float = None, end: float = None) -> list:
+        """
+        returns the posts with start <= timestamp < end, sorted by timestamp. Either bound may be None.
+        """
+        return self._posts.between(start, end)
 
+    @_locked
+    def latest_posts(self, n: int) -> list:
         """
-        # Done: Add code that checks both the frm and recipient instances of the message and adds the username to the
-        #  self._users variable IF the username is NOT self.username AND is NOT already on the list.
-        message_recipient = message['recipient']
-        message_from = message['from']
+        returns the n newest posts, sorted by timestamp
+        """
+        return self._posts.latest(n)
 
-        message_recipient_exists = False
-        message_from_exists = False
+    @_locked
+    def add_msg(self, message: DirectMessage) -> bool:
+        """
 
-        for usr in self._users:
-            if usr == message_recipient:
-                message_recipient_exists = True
-            if usr == message_from:
-                message_from_exists = True
+        add_msg accepts a DirectMessage object as parameter and appends it to the messages list. Adding a message
+        the profile already has does nothing, and the return value tells the two cases apart (True if the message
+        was new).
 
-        if message_recipient_exists == False and message_recipient != self.username:
-            self._users.append(message_recipient)
-        if message_from_exists == False and message_from != self.username:
-            self._users.append(message_from)
+        """
+        if self._has_msg(message_key(message)):
+            return False
 
-        self._messages.append(message)
+        # Done: Add code that checks both the frm and recipient instances of the message and adds the username to the
+        #  self._users variable IF the username is NOT self.username AND is NOT already on the list.
+        self.add_user(message['recipient'])
+        self.add_user(message['from'])
+
+        row = self._messages.append(message)
+        self._index_chat(row)
+        self._unsaved.append(row)
+        self._index_text(self._chat_peer(message['from'], message['recipient']), message['timestamp'],
+                         message['message'])
+        return True
+
+    @_locked
+    def search(self, query: str, contact: str = None, limit: int = 50) -> list:
+        """
+        returns the messages whose text contains every word of query, newest first. A word ending in '*' matches
+        any word that starts with it, e.g. 'meet* tomorrow'.
 
+        :param contact: only search the chat with this user
+        :param limit: return at most this many messages (None for all of them)
+        """
+        self._open_search_index()
+        terms = query_terms(query)
+        found = []
+        seen = set()
+        for doc in self._search_index.search(query, contact, limit):
+            peer, timestamp = self._search_index.document(doc)
+            for message in self.get_chat_messages(peer, since=timestamp, until=math.nextafter(timestamp, math.inf)):
+                key = message_key(message)
+                if key not in seen and matches(terms, message['message']):
+                    seen.add(key)
+                    found.append(message)
+        return found if limit is None else found[:limit]
+
+    def _build_search_index(self) -> None:
+        """
+        indexes every message of the profile, archived ones included, and saves the index next to the profile's
+        file if the file holds everything the profile does
+        """
+        self._load_all_chats()
+        messages = self._messages
+
+        def live():
+            for row in sorted(range(len(messages)), key=messages.timestamp):
+                frm, recipient, timestamp, message = messages.row(row)
+                yield timestamp, self._chat_peer(frm, recipient), message
+
+        def archived(peer):
+            for message in self._archive.messages(peer):
+                yield message['timestamp'], peer, message['message']
+
+        # in timestamp order, which lets the index answer queries with a limit from the newest end
+        sources = [live()]
+        if self._archive is not None:
+            sources.extend(archived(peer) for peer in self._archive.peers())
+        index = SearchIndex()
+        for timestamp, peer, text in heapq.merge(*sources, key=lambda item: item[0]):
+            index.add(peer, timestamp, text)
+        self._search_index = index
+
+        state = self._journal_state
+        if state is not None and not self._unsaved and os.path.exists(state['path']):
+            p = Path(state['path'])
+            journal = journal_path(p)
+            with _file_lock(p):
+                self._save_search_index(p, journal.stat().st_size if journal.exists() else 0)
+
+    def _index_text(self, peer, timestamp, text) -> None:
+        """adds a message to the search index, or to the messages waiting for the saved index to be read"""
+        if self._search_index is not None:
+            self._search_index.add(peer, timestamp, text)
+        elif self._search_pending is not None:
+            self._search_pending[2].append((peer, timestamp, text))
+
+    def _open_search_index(self) -> None:
+        """makes sure self._search_index exists, reading the saved index or building a new one"""
+        if self._search_index is not None:
+            return
+        if self._search_pending is not None:
+            path, base, pending = self._search_pending
+            self._search_pending = None
+            self._search_index = SearchIndex.load(path, base)
+            if self._search_index is not None:
+                for peer, timestamp, text in pending:
+                    self._search_index.add(peer, timestamp, text)
+                return
+        self._build_search_index()
+
+    def _save_search_index(self, p: Path, journal_bytes: int = 0) -> None:
+        if self._search_pending is not None:
+            # the saved index will not match the new file, so carry it over now
+            self._open_search_index()
+        if self._search_index is not None:
+            stat = os.stat(p)
+            self._search_index.save(search_index_path(p), [stat.st_mtime_ns, stat.st_size], journal_bytes)
+
+    def _find_search_index(self, p: Path):
+        """
+        looks for a saved search index that was written for the file at p as it is now, and returns how much of the
+        file's journal it already covers (or None if there is no such index)
+        """
+        stat = os.stat(p)
+        base = [stat.st_mtime_ns, stat.st_size]
+        header = read_search_header(search_index_path(p), base)
+        if header is None:
+            return None
+        self._search_pending = (search_index_path(p), base, [])
+        return header['journal']
+
+    @_locked
     def del_post(self, index: int) -> bool:
         """
 
         del_post removes a Post at a given index and returns True if successful and False if an invalid
         index was supplied.
 
-        To determine which post to delete you must implement your own search operation on the posts
-        returned from the get_posts function to find the correct index.
+        The index is a position in the list returned by get_posts, which is sorted by timestamp. To delete a post
+        by its timestamp or its id, use del_post_by_time or del_post_by_id.
 
         """
         try:
-            del self._posts[index]
-            return True
+            self._posts.pop(index)
         except IndexError:
             return False
+        # a journal can only grow, so removing a post means rewriting the whole file on the next save
+        self._journal_state = None
+        return True
+
+    @_locked
+    def del_post_by_id(self, post_id: int) -> bool:
+        """
+        removes the post with the given id (see Post.id), returning False if there is none
+        """
+        if self._posts.remove_id(post_id) is None:
+            return False
+        self._journal_state = None
+        return True
+
+    @_locked
+    def del_post_by_time(self, timestamp: float) -> bool:
+        """
+        removes the posts with the given timestamp, returning False if there are none
+        """
+        if not self._posts.remove_time(timestamp):
+            return False
+        self._journal_state = None
+        return True
 
+    @_locked
+    def add_user(self, username: str) -> bool:
+        """
+        adds username to the users the profile has chats with, returning False if it was already there
+        """
+        if username in self._users or username == self.username:
+            return False
+        self._users.append(username)
+        return True
+
+    @_locked
     def get_posts(self) -> list:
         """
 
-        get_posts returns the list object containing all posts that have been added to the Profile object
+        get_posts returns a list of all posts that have been added to the Profile object, sorted by timestamp
 
         """
-        return self._posts
+        return list(self._posts)
 
+    @_locked
+    def export_ndjson(self, path: str) -> dict:
+        """
+        writes the profile's posts and messages, archived messages included, to path as NDJSON: one JSON object per
+        line, either {"post": {"entry": ..., "timestamp": ...}} or {"msg": {"from": ..., "recipient": ...,
+        "timestamp": ..., "message": ...}}. Messages are written one chat at a time, oldest first.
+
+        Chats that the profile has not read from its file yet (see load_profile with lazy=True) are streamed from the
+        file without being kept, and archived segments are read one at a time, so exporting a lazily loaded profile
+        only ever holds one chat in memory.
+
+        Returns the number of messages and posts written, as {'messages': ..., 'posts': ...}.
+
+        Raises DsuFileError
+        """
+        counts = {'messages': 0, 'posts': 0}
+
+        def lines(keys):
+            for frm, recipient, timestamp, message in keys:
+                counts['messages'] += 1
+                yield json.dumps({'msg': {'from': frm, 'recipient': recipient, 'timestamp': timestamp,
+                                          'message': message}}) + '\n'
+
+        def chat(peer):
+            if self._archive is not None:
+                yield from self._archive.rows(peer)
+            if peer in self._lazy_chats:
+                keys = self._lazy_source.read_chat(peer)
+                if keys is not None:
+                    yield from keys
+                    yield from self._lazy_chats[peer]
+                    return
+                # the file can no longer be read a chat at a time
+                self._load_all_chats()
+            for row in self._chats.get(peer, ()):
+                yield self._messages.row(row)
+
+        peers = list(self._chats) + list(self._lazy_chats)
+        if self._archive is not None:
+            peers += self._archive.peers()
+        try:
+            with open(path, 'w', encoding='utf-8') as f:
+                for post in self._posts:
+                    f.write(json.dumps({'post': {'entry': post.entry, 'timestamp': post.timestamp}}) + '\n')
+                    counts['posts'] += 1
+                for peer in dict.fromkeys(peers):
+                    batch = []
+                    for line in lines(chat(peer)):
+                        batch.append(line)
+                        if len(batch) == 10000:
+                            f.write(''.join(batch))
+                            batch = []
+                    f.write(''.join(batch))
+        except OSError as ex:
+            raise DsuFileError("An error occurred while attempting to write the NDJSON file.", ex)
+        return counts
+
+    @_locked
+    def import_ndjson(self, path: str) -> dict:
+        """
+        adds the posts and messages of an NDJSON file (see export_ndjson) to the profile, reading the file one line
+        at a time. Messages the profile already has, and posts with the same timestamp and entry as one it already
+        has, are skipped, and so are lines that are not entries.
+
+        The file is never held in memory, but the messages it adds are, like all of a Profile's messages. For a
+        history too big for that, import into a SqliteProfile instead.
+
+        Returns {'messages': ..., 'posts': ..., 'duplicates': ..., 'skipped': ...}: the messages and posts added,
+        the entries the profile already had, and the lines that were not entries.
+
+        Raises DsuFileError
+        """
+        counts = {'messages': 0, 'posts': 0, 'duplicates': 0, 'skipped': 0}
+        posts = {(post.timestamp, post.entry) for post in self._posts}
+        try:
+            for entry in read_ndjson(path, counts):
+                if 'msg' in entry:
+                    if self.add_msg(entry['msg']):
+                        counts['messages'] += 1
+                    else:
+                        counts['duplicates'] += 1
+                else:
+                    post = entry['post']
+                    if (post['timestamp'], post['entry']) in posts:
+                        counts['duplicates'] += 1
+                    else:
+                        posts.add((post['timestamp'], post['entry']))
+                        self.add_post(Post(post['entry'], post['timestamp']))
+                        counts['posts'] += 1
+        except OSError as ex:
+            raise DsuFileError("An error occurred while attempting to read the NDJSON file.", ex)
+        return counts
+
+    @_locked
     def save_profile(self, path: str) -> None:
         """
 
         save_profile accepts an existing dsu file to save the current instance of Profile to the file system.
 
+        If the profile was loaded from (or last saved to) the same file, only the messages, posts, users and settings
+        that changed since are appended to the file's journal, so a save costs as much as the change rather than the
+        whole history. Otherwise the whole profile is written as a new base file. Once the journal grows past
+        journal_compact_bytes it is folded into the base file on a background thread.
+
+        An existing .dsb file is always rewritten as a whole, in the binary format (see binary_profile).
+
         Example usage:
 
         profile = Profile()
@@ -209,20 +894,175 @@ class Profile:
 
         p = Path(path)
 
-        if os.path.exists(p) and p.suffix == '.dsu':
+        if os.path.exists(p) and p.suffix == '.dsb':
+            from binary_profile import write_binary
+            try:
+                with _file_lock(p):
+                    self._carry_archive(p)
+                    write_binary(self, p)
+                    self._save_search_index(p)
+                self._mark_saved(p)
+            except Exception as ex:
+                raise DsuFileError("An error occurred while attempting to process the DSB file.", ex)
+        elif os.path.exists(p) and p.suffix == '.dsu':
             try:
-                f = open(p, 'w')
-                json.dump(self.__dict__, f)
-                f.close()
+                with _file_lock(p):
+                    self._carry_archive(p)
+                    if self._can_append_journal(p):
+                        self._append_journal(p)
+                    else:
+                        self._write_snapshot(p)
+                    journal = journal_path(p)
+                    compact = journal.exists() and journal.stat().st_size > self.journal_compact_bytes
             except Exception as ex:
                 raise DsuFileError("An error occurred while attempting to process the DSU file.", ex)
+            if compact:
+                _compact_in_background(p)
         else:
             raise DsuFileError("Invalid DSU file path or type")
 
-    def load_profile(self, path: str) -> None:
+    def _to_json_dict(self) -> dict:
+        """
+        returns the attributes of the profile that are saved to the DSU file, except for the messages, which
+        _write_snapshot writes one batch at a time
+        """
+        obj = {name: value for name, value in self.__dict__.items()
+               if name not in self._RUNTIME_FIELDS and name != '_messages'}
+        obj['_users'] = list(self._users)
+        obj['_posts'] = list(self._posts)
+        return obj
+
+    def _write_snapshot(self, p: Path) -> None:
+        """
+        writes the whole profile to p as a new base file, together with its chat index, and removes the journal it
+        replaces
+        """
+        self._load_all_chats()
+
+        # The messages go last, one chat after another, so that they never have to exist as one big list of
+        # dictionaries and each chat can be read back on its own. Everything json.dumps writes is ASCII, so the
+        # length of the text written so far is also the byte offset in the file.
+        header = json.dumps(self._to_json_dict())[:-1]
+        chats = []
+        # written next to p and then moved over it, so a crash part way through never leaves a truncated file
+        temp = p.with_name(p.name + '.tmp')
+        f = open(temp, 'w')
+        f.write(header + ', "_messages": [')
+        position = len(header) + len(', "_messages": [')
+        for peer, rows in self._chats.items():
+            if not rows:
+                continue
+            if chats:
+                f.write(', ')
+                position += 2
+            start = position
+            # the offset and first timestamp of every block of chat_block_messages messages, so that part of a chat
+            # can be read without the rest (see _JsonChatSource.read_range)
+            blocks = []
+            for batch in range(0, len(rows), self.chat_block_messages):
+                blocks.append([position, self._messages.timestamp(rows[batch])])
+                text = ', '.join(json.dumps(dict(self._messages[row]))
+                                 for row in rows[batch:batch + self.chat_block_messages])
+                if batch:
+                    text = ', ' + text
+                f.write(text)
+                position += len(text)
+            chats.append([peer, start, position, len(rows), blocks])
+        f.write(']}')
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+        os.replace(temp, p)
+
+        stat = os.stat(p)
+        with open(chat_index_path(p), 'w') as f:
+            json.dump({'base': [stat.st_mtime_ns, stat.st_size], 'header_end': len(header), 'chats': chats}, f)
+        self._save_search_index(p)
+
+        journal = journal_path(p)
+        if journal.exists():
+            os.remove(journal)
+        self._mark_saved(p)
+
+    def _can_append_journal(self, p: Path) -> bool:
+        state = self._journal_state
+        return (state is not None and state['path'] == os.path.abspath(p) and os.path.exists(p)
+                and len(self._users) >= state['users'])
+
+    def _append_journal(self, p: Path) -> None:
+        """
+        appends everything that changed since the profile was loaded or last saved to the journal of p
+        """
+        state = self._journal_state
+        entries = []
+
+        header = {name: getattr(self, name) for name in self._HEADER_FIELDS
+                  if getattr(self, name) != state['header'][name]}
+        if header:
+            entries.append({'header': header})
+        cursor = {user: timestamp for user, timestamp in self._sync_cursor.items()
+                  if state['cursor'].get(user) != timestamp}
+        if cursor:
+            entries.append({'cursor': cursor})
+        for user in self._users[state['users']:]:
+            entries.append({'user': user})
+        for post in self._unsaved_posts:
+            entries.append({'post': post})
+        for row in self._unsaved:
+            entries.append({'msg': dict(self._messages[row])})
+
+        if entries:
+            text = ''.join(json.dumps(entry) + '\n' for entry in entries)
+            with open(journal_path(p), 'ab+') as f:
+                # a save that crashed part way may have left a torn line behind, which must not swallow this one
+                end = f.seek(0, os.SEEK_END)
+                if end > 0:
+                    f.seek(end - 1)
+                    if f.read(1) != b'\n':
+                        text = '\n' + text
+                f.write(text.encode())
+                f.flush()
+                os.fsync(f.fileno())
+        self._mark_saved(p)
+
+    @_locked
+    def _has_unsaved_changes(self) -> bool:
+        """
+        returns True if the profile holds changes that have not been saved to its file yet
+        """
+        state = self._journal_state
+        if state is None:
+            return True
+        return bool(self._unsaved or self._unsaved_posts or len(self._users) > state['users']
+                    or self._sync_cursor != state['cursor']
+                    or any(getattr(self, name) != state['header'][name] for name in self._HEADER_FIELDS))
+
+    def _mark_saved(self, p: Path) -> None:
+        """
+        records that the file at p (together with its journal) now holds everything in the profile
+        """
+        self._unsaved = []
+        self._unsaved_posts = []
+        self._journal_state = {
+            'path': os.path.abspath(p),
+            'users': len(self._users),
+            'header': {name: getattr(self, name) for name in self._HEADER_FIELDS},
+            'cursor': dict(self._sync_cursor),
+        }
+
+    def load_profile(self, path: str, lazy: bool = False) -> None:
         """
 
-        load_profile will populate the current instance of Profile with data stored in a DSU file.
+        load_profile will populate the current instance of Profile with data stored in a DSU file, replaying the
+        file's journal on top of it if there is one. Plain DSU files without a journal load as before.
+
+        With lazy=True only the header of the file is read (username, server, bio, contacts, posts and how many
+        messages each chat has, see chat_count), and each chat is read from the file the first time it is needed,
+        e.g. by get_chat_messages. This needs the chat index that save_profile writes next to the file; without an
+        up to date one the whole file is read as usual.
+
+        A binary profile (a .dsb file, see binary_profile) is memory-mapped instead of parsed, and its chats are
+        decoded from the mapping when they are first needed; with lazy=False they are all decoded right away.
 
         Example usage:
 
@@ -234,25 +1074,355 @@ class Profile:
         """
         p = Path(path)
 
-        if os.path.exists(p) and p.suffix == '.dsu':
+        if os.path.exists(p) and p.suffix == '.dsb':
+            from binary_profile import BinaryProfileReader
+            reader = BinaryProfileReader(p)
             try:
-                f = open(p, 'r')
-                obj = json.load(f)
-                self.username = obj['username']
-                self.password = obj['password']
-                self.dsuserver = obj['dsuserver']
-                self.bio = obj['bio']
-                for post_obj in obj['_posts']:
-                    post = Post(post_obj['entry'], post_obj['timestamp'])
-                    self._posts.append(post)
-                for message in obj['_messages']:
-                    msg = DirectMessage(message=message["message"], timestamp=message["timestamp"],
-                                        recipient=message["recipient"], frm=message["frm"])
-                    self._messages.append(msg)
-                for user in obj['_users']:
-                    self._users.append(user)
-                f.close()
+                self._open_archive(p)
+                self._find_search_index(p)
+                obj = dict(reader.header, _messages=[])
+                self._lazy_source = reader
+                self._lazy_chats = {peer: [] for peer in reader.peers()}
+                self._apply_header(obj)
+                if not lazy:
+                    self._load_all_chats()
+                if self._lazy_source is not None and not self._lazy_chats:
+                    reader.close()
+                    self._lazy_source = None
+                self._mark_saved(p)
+            except Exception as ex:
+                raise DsuProfileError(ex)
+        elif os.path.exists(p) and p.suffix == '.dsu':
+            try:
+                with _file_lock(p):
+                    self._open_archive(p)
+                    indexed = self._find_search_index(p)
+                    index = _read_chat_index(p) if lazy else None
+                    if index is not None:
+                        with open(p, 'rb') as f:
+                            obj = json.loads(f.read(index['header_end']).decode() + '}')
+                        obj['_messages'] = []
+                        self._lazy_source = _JsonChatSource(p, index)
+                        self._lazy_chats = {peer: [] for peer in self._lazy_source.peers()}
+                    else:
+                        f = open(p, 'r')
+                        obj = json.load(f)
+                        f.close()
+                    self._apply_header(obj)
+
+                    self._replay_journal(journal_path(p), indexed)
+                    self._mark_saved(p)
             except Exception as ex:
                 raise DsuProfileError(ex)
         else:
             raise DsuFileError()
+
+    def _open_archive(self, p: Path) -> None:
+        directory = archive_path(p)
+        self._archive = HistoryArchive(directory, self._users) if directory.exists() else None
+
+    def _carry_archive(self, p: Path) -> None:
+        """
+        copies the profile's archive next to p when the profile is saved to a different file than the archive
+        belongs to, so that the new file does not lose the archived messages
+        """
+        target = archive_path(p)
+        if self._archive is not None and self._archive.path != Path(os.path.abspath(target)):
+            shutil.copytree(self._archive.path, target, dirs_exist_ok=True)
+            self._archive = HistoryArchive(target, self._users)
+
+    def _apply_header(self, obj: dict) -> None:
+        """fills in the profile from the dictionary form of a saved profile"""
+        self.username = obj['username']
+        self.password = obj['password']
+        self.dsuserver = obj['dsuserver']
+        self.bio = obj['bio']
+        # files written before posts were kept sorted may have them in any order
+        self._posts.extend(Post(post_obj['entry'], post_obj['timestamp']) for post_obj in obj['_posts'])
+        for message in obj['_messages']:
+            self._load_msg(message)
+        for user in obj['_users']:
+            self._users.append(user)
+        self._sync_cursor = dict(obj.get('_sync_cursor', {}))
+        self._last_sync = obj.get('_last_sync', 0)
+
+    def _load_msg(self, message: dict) -> None:
+        """
+        adds a message read from a DSU file, skipping it if the profile already has it
+        """
+        key = (message["frm"], message["recipient"], float(message["timestamp"]), message["message"])
+        pending = self._lazy_chats.get(self._chat_peer(key[0], key[1]))
+        if pending is not None:
+            # the chat has not been read from the file yet, the message joins it when it is
+            pending.append(key)
+        elif not self._has_msg(key):
+            self._index_chat(self._messages.append_fields(*key))
+
+    def _load_chat(self, username) -> None:
+        """
+        reads the chat with username from the file, if the profile was loaded lazily and has not read it yet
+        """
+        if username not in self._lazy_chats:
+            return
+
+        keys = self._lazy_source.read_chat(username)
+        if keys is None:
+            # the source cannot find single chats any more, so read everything that is left in one go
+            keys = self._lazy_source.read_all()
+            for pending in self._lazy_chats.values():
+                keys.extend(pending)
+            self._lazy_chats = {}
+        else:
+            keys.extend(self._lazy_chats.pop(username))
+
+        for key in keys:
+            if not self._has_msg(key):
+                self._index_chat(self._messages.append_fields(*key))
+
+        if not self._lazy_chats:
+            self._lazy_source.close()
+            self._lazy_source = None
+
+    def _load_all_chats(self) -> None:
+        for username in list(self._lazy_chats):
+            self._load_chat(username)
+
+    def _replay_journal(self, journal: Path, indexed: int = None) -> None:
+        """
+        applies the entries of a DSU journal in order. Torn lines, left by a crash in the middle of a save, are
+        skipped. If the profile has a saved search index that covers the first `indexed` bytes of the journal, the
+        messages after them are added to it.
+        """
+        if not journal.exists():
+            return
+
+        posts = {(post['timestamp'], post['entry']) for post in self._posts}
+        position = 0
+        with open(journal, 'rb') as f:
+            for line in f:
+                start = position
+                position += len(line)
+                try:
+                    entry = json.loads(line)
+                except (json.JSONDecodeError, UnicodeDecodeError):
+                    continue
+                if 'msg' in entry:
+                    message = entry['msg']
+                    self._load_msg(message)
+                    if indexed is not None and start >= indexed:
+                        self._index_text(self._chat_peer(message['frm'], message['recipient']),
+                                         message['timestamp'], message['message'])
+                elif 'post' in entry:
+                    post_obj = entry['post']
+                    if (post_obj['timestamp'], post_obj['entry']) not in posts:
+                        posts.add((post_obj['timestamp'], post_obj['entry']))
+                        self._posts.add(Post(post_obj['entry'], post_obj['timestamp']))
+                elif 'user' in entry:
+                    if entry['user'] not in self._users:
+                        self._users.append(entry['user'])
+                elif 'header' in entry:
+                    for name, value in entry['header'].items():
+                        setattr(self, name, value)
+                elif 'cursor' in entry:
+                    self._sync_cursor.update(entry['cursor'])
+
+
+def _file_signature(path) -> tuple:
+    """
+    returns the modification time and size of a DSU file and of its journal, which change whenever either is written
+    """
+    signature = []
+    for p in (Path(path), journal_path(path)):
+        try:
+            stat = os.stat(p)
+            signature.append((stat.st_mtime_ns, stat.st_size))
+        except FileNotFoundError:
+            signature.append(None)
+    return tuple(signature)
+
+
+class ProfileCache:
+    """
+    The ProfileCache class hands out one shared, in-memory Profile per DSU file, so that parts of the program that
+    need the same profile do not each parse the file again. A cached profile is only loaded again once the file (or
+    its journal) has been changed by someone else, which is noticed by its modification time and size.
+
+    Changes should be made to the cached profile and written with ProfileCache.save, so that they are not lost to
+    another copy of the profile saving over them. Compacting the journal (compact_profile) does not count as a
+    change, and a cached profile with unsaved changes is never simply thrown away (see get).
+    """
+
+    def __init__(self, lazy: bool = False):
+        self.lazy = lazy  # whether profiles are loaded with load_profile(path, lazy=True)
+        self._entries = {}  # absolute path -> (profile, file signature when it was loaded or saved)
+        self._lock = threading.RLock()
+        _caches.add(self)
+
+    def get(self, path: str) -> Profile:
+        """
+        returns the cached profile for path, loading it first if it is not cached or the file changed on disk
+
+        If the file changed while the cached profile has unsaved changes (e.g. history_archive.archive_profile
+        rewrote it), the changes are appended to the file's journal first, so the profile loaded again still has
+        them. Changes that can only be saved by rewriting the whole file would overwrite the other change instead,
+        so then the cached profile is kept as it is.
+
+        Raises DsuProfileError, DsuFileError
+        """
+        key = os.path.abspath(path)
+        with self._lock:
+            with _file_lock(path):
+                signature = _file_signature(path)
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] == signature:
+                return entry[0]
+
+            if entry is not None and entry[0]._has_unsaved_changes():
+                cached = entry[0]
+                p = Path(path)
+                if p.suffix != '.dsu' or not cached._can_append_journal(p):
+                    return cached
+                cached.save_profile(path)
+
+            profile = Profile()
+            profile.load_profile(path, lazy=self.lazy)
+            self._entries[key] = (profile, _file_signature(path))
+            return profile
+
+    def apply(self, path: str, change):
+        """
+        calls change(profile) with the profile cached for path (see get) and returns what it returns. The profile is
+        locked while change runs, and cannot be replaced by another load of the file until it is done.
+
+        Code that holds on to a cached profile during something slow, like a call to the server, should make its
+        changes through apply afterwards: the file may have been loaded again in the meantime, and changes made to
+        the profile that was replaced would never be saved.
+
+        Raises DsuProfileError, DsuFileError
+        """
+        with self._lock:
+            profile = self.get(path)
+            with profile._lock:
+                return change(profile)
+
+    def save(self, path: str, profile: Profile = None) -> None:
+        """
+        saves profile (by default the one cached for path) to path and makes it the cached profile for that file
+
+        Raises DsuFileError
+        """
+        key = os.path.abspath(path)
+        with self._lock:
+            if profile is None:
+                profile = self._entries[key][0]
+            profile.save_profile(path)
+            self._entries[key] = (profile, _file_signature(path))
+
+    def _rewritten(self, path, before: tuple, after: tuple) -> None:
+        """
+        records that the file at path was rewritten (from signature before to after) without changing the profile
+        it holds, so a cached profile that was up to date with the file stays cached
+        """
+        key = os.path.abspath(path)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] == before:
+                self._entries[key] = (entry[0], after)
+
+    def invalidate(self, path: str = None) -> None:
+        """
+        drops the cached profile for path, or every cached profile if no path is given
+        """
+        with self._lock:
+            if path is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(os.path.abspath(path), None)
+
+
+class ProfilePersister:
+    """
+    The ProfilePersister class saves profiles in the background ("write-behind"). Instead of saving a profile after
+    every change, callers mark its file dirty, and a background thread saves it through the ProfileCache once
+    `interval` seconds have passed since the first change that has not been saved yet. However many changes come in
+    during that time, they cost one write.
+
+    flush saves everything that is dirty right away. close does a last flush and stops the thread; it also runs when
+    the program exits, so nothing that was marked dirty is lost on a normal exit.
+
+    :param cache: The ProfileCache whose profiles are saved.
+
+    :param interval: Seconds to wait after the first unsaved change before writing.
+    """
+
+    def __init__(self, cache: ProfileCache, interval: float = 2.0):
+        self.cache = cache
+        self.interval = interval
+        self.writes = 0  # how many times a profile was written
+        self._dirty = {}  # absolute path -> (path, profile, or None for the one cached for the path)
+        self._condition = threading.Condition()
+        self._thread = None
+        self._closed = False
+
+    def mark_dirty(self, path: str, profile: Profile = None) -> None:
+        """
+        records that profile (by default the one cached for path) has changes that should be saved to path
+        """
+        with self._condition:
+            if not self._closed:
+                self._dirty[os.path.abspath(path)] = (path, profile)
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="ProfilePersister", daemon=True)
+                    self._thread.start()
+                    atexit.register(self.close)
+                self._condition.notify_all()
+                return
+        # after close there is no thread left to write it later
+        self._write({path: (path, profile)})
+
+    def dirty(self) -> bool:
+        """returns True if there are changes that have not been written yet"""
+        with self._condition:
+            return bool(self._dirty)
+
+    def flush(self) -> None:
+        """saves every dirty profile now, on the calling thread"""
+        with self._condition:
+            dirty, self._dirty = self._dirty, {}
+        self._write(dirty)
+
+    def close(self) -> None:
+        """writes whatever is still dirty and stops the background thread"""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+        self.flush()
+
+    def _write(self, dirty: dict) -> None:
+        for path, profile in dirty.values():
+            try:
+                self.cache.save(path, profile)
+                self.writes += 1
+            except (DsuFileError, KeyError) as ex:
+                print("Unable to save the DSU file:", ex)
+
+    def _run(self) -> None:
+        while True:
+            with self._condition:
+                while not self._dirty and not self._closed:
+                    self._condition.wait()
+                # let the changes that follow the first one join the same write
+                self._condition.wait_for(lambda: self._closed, timeout=self.interval)
+                if self._closed:
+                    # close writes the rest
+                    return
+            self.flush()
+
+
+# the cache shared by the whole program, which only reads the chats that are actually opened
+profile_cache = ProfileCache(lazy=True)
+
+# writes the changes to the profiles in profile_cache in the background
+profile_persister = ProfilePersister(profile_cache)
@@ -0,0 +1,218 @@
+import json
+import mmap
+import os
+import struct
+from bisect import bisect_left
+from pathlib import Path
+
+from message_store import NameTable
+
+"""
+The binary_profile module contains the binary profile format (.dsb), which a Profile can open with mmap instead of
+parsing a whole JSON document.
+
+A .dsb file is laid out as follows (all numbers little-endian):
+
+- a fixed 16 byte header: the magic b'DSB1', the format version (H), two reserved bytes, the length of the JSON
+  header (I) and the number of chats (I)
+- the JSON header: the profile's username, password, server, bio, posts, contacts and sync cursor, plus the table of
+  usernames that messages refer to by id
+- the offset table: for every chat, the id of the user it is with (i), the offset of its block (Q) and its number of
+  messages (I)
+- one block per chat, 8-byte aligned: the timestamps of its messages in order (d each), the offset of each message
+  record (Q each), and then the records themselves: the length of the text in bytes (I), the timestamp (d), the
+  sender and recipient ids (i each) and the UTF-8 text (lone surrogates, which JSON allows in a message, are kept
+  with the 'surrogatepass' error handler)
+
+Because every chat carries a sorted array of its timestamps, a range of a chat is found with a binary search on the
+mapped file, and only the records in it are decoded.
+"""
+
+MAGIC = b'DSB1'
+VERSION = 1
+
+_FILE_HEADER = struct.Struct('<4sHxxII')
+_CHAT_ENTRY = struct.Struct('<iQI')
+_RECORD = struct.Struct('<Idii')
+
+
+class BinaryProfileReader:
+    """
+    The BinaryProfileReader class maps a .dsb file into memory and reads its header, contacts and chats straight
+    from the mapping. It is also the lazy chat source of a Profile opened from a .dsb file.
+
+    Raises DsuProfileError if the file is not a .dsb file.
+    """
+
+    def __init__(self, path):
+        from Profile import DsuProfileError
+
+        self.path = os.path.abspath(path)
+        self._file = open(path, 'rb')
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            self._file.close()
+            raise DsuProfileError("The DSB file is empty")
+        self._view = memoryview(self._map)
+
+        magic, version, header_length, chat_count = _FILE_HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or version != VERSION:
+            self.close()
+            raise DsuProfileError("Not a DSB file, or a DSB file of an unknown version")
+
+        start = _FILE_HEADER.size
+        self.header = json.loads(bytes(self._view[start:start + header_length]))
+        self._names = self.header.pop('names')
+
+        self._chats = {}  # username -> (offset of the chat's block, number of messages)
+        table = start + header_length
+        for i in range(chat_count):
+            name_id, offset, count = _CHAT_ENTRY.unpack_from(self._map, table + i * _CHAT_ENTRY.size)
+            self._chats[self._names[name_id]] = (offset, count)
+
+    def peers(self) -> list:
+        return list(self._chats)
+
+    def count(self, username) -> int:
+        return self._chats.get(username, (0, 0))[1]
+
+    def chat_times(self, username):
+        """returns the sorted timestamps of the chat with username as a memoryview of doubles into the mapping"""
+        offset, count = self._chats.get(username, (0, 0))
+        return self._view[offset:offset + count * 8].cast('d')
+
+    def read_chat(self, username, since: float = None, until: float = None) -> list:
+        """
+        returns the messages of the chat with username (optionally only those with since <= timestamp < until) as
+        (from, recipient, timestamp, message) tuples, decoded from the mapping
+        """
+        offset, count = self._chats.get(username, (0, 0))
+        times = self.chat_times(username)
+        start = 0 if since is None else bisect_left(times, since)
+        end = count if until is None else bisect_left(times, until)
+        return self._read_rows(username, start, end)
+
+    def read_range(self, username, since: float = None, until: float = None, limit: int = None) -> list:
+        """
+        returns the messages of the chat with username with since <= timestamp < until, and only the latest `limit`
+        of them if given, like read_chat. Only the records in the range are decoded.
+        """
+        times = self.chat_times(username)
+        start = 0 if since is None else bisect_left(times, since)
+        end = len(times) if until is None else bisect_left(times, until)
+        if limit is not None:
+            start = max(start, end - limit)
+        return self._read_rows(username, start, end)
+
+    def _read_rows(self, username, start: int, end: int) -> list:
+        """decodes the messages at positions start to end (exclusive) of the chat with username"""
+        offset, count = self._chats.get(username, (0, 0))
+        records = self._view[offset + count * 8:offset + count * 16].cast('Q')
+
+        names = self._names
+        messages = []
+        for i in range(start, end):
+            record = records[i]
+            length, timestamp, sender, recipient = _RECORD.unpack_from(self._map, record)
+            text_start = record + _RECORD.size
+            messages.append((names[sender], names[recipient], timestamp,
+                             str(self._view[text_start:text_start + length], 'utf-8', 'surrogatepass')))
+        return messages
+
+    def read_all(self) -> list:
+        messages = []
+        for username in self._chats:
+            messages.extend(self.read_chat(username))
+        return messages
+
+    def close(self) -> None:
+        try:
+            self._view.release()
+            self._map.close()
+        except BufferError:
+            # a view into the mapping (e.g. from chat_times) is still in use; the mapping goes away with it
+            pass
+        self._file.close()
+
+
+def write_binary(profile, path, archived: bool = False) -> None:
+    """
+    writes the whole profile to path in the .dsb format. The file is written next to path first and then moved over
+    it, so a reader that still has the old file mapped keeps seeing the old contents.
+
+    The messages in the profile's archive (see history_archive) stay in the archive, unless archived is True, in
+    which case they are written into the chats of the .dsb file as well.
+    """
+    profile._load_all_chats()
+    names = NameTable()
+    chats = []
+    peers = list(profile._chats)
+    if archived and profile._archive is not None:
+        peers.extend(peer for peer in profile._archive.peers() if peer not in profile._chats)
+    for peer in peers:
+        messages = [profile._messages.row(row) for row in profile._chats.get(peer, ())]
+        if archived and profile._archive is not None and profile._archive.segments(peer):
+            messages = sorted([tuple(row) for row in profile._archive.rows(peer)] + messages,
+                              key=lambda message: message[2])
+        if messages:
+            chats.append((names.intern(peer), messages))
+    for chat_id, messages in chats:
+        for frm, recipient, timestamp, message in messages:
+            names.intern(frm)
+            names.intern(recipient)
+
+    header = profile._to_json_dict()
+    header['names'] = names._names
+    header_bytes = json.dumps(header).encode()
+
+    temp = Path(str(path) + '.tmp')
+    with open(temp, 'wb') as f:
+        f.write(_FILE_HEADER.pack(MAGIC, VERSION, len(header_bytes), len(chats)))
+        f.write(header_bytes)
+        table_start = f.tell()
+        f.write(b'\0' * (len(chats) * _CHAT_ENTRY.size))
+
+        table = []
+        for chat_id, messages in chats:
+            f.write(b'\0' * (-f.tell() % 8))
+            block_start = f.tell()
+            records = bytearray()
+            offsets = []
+            record_start = block_start + len(messages) * 16
+            for frm, recipient, timestamp, message in messages:
+                text = message.encode('utf-8', 'surrogatepass')
+                offsets.append(record_start + len(records))
+                records += _RECORD.pack(len(text), timestamp, names.intern(frm), names.intern(recipient))
+                records += text
+            f.write(struct.pack(f'<{len(messages)}d', *(message[2] for message in messages)))
+            f.write(struct.pack(f'<{len(offsets)}Q', *offsets))
+            f.write(records)
+            table.append(_CHAT_ENTRY.pack(chat_id, block_start, len(messages)))
+
+        f.seek(table_start)
+        f.write(b''.join(table))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp, path)
+
+
+def dsu_to_dsb(dsu_path, dsb_path) -> None:
+    """converts the DSU file at dsu_path (and its journal and archive) into a .dsb file at dsb_path"""
+    from Profile import Profile
+
+    profile = Profile()
+    profile.load_profile(dsu_path)
+    write_binary(profile, dsb_path, archived=True)
+
+
+def dsb_to_dsu(dsb_path, dsu_path) -> None:
+    """converts the .dsb file at dsb_path into a DSU file at dsu_path, creating it if needed"""
+    from Profile import Profile
+
+    profile = Profile()
+    profile.load_profile(dsb_path)
+    if not os.path.exists(dsu_path):
+        open(dsu_path, 'w').close()
+    profile._journal_state = None
+    profile.save_profile(dsu_path)
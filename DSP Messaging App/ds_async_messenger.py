@@ -0,0 +1,186 @@
+import asyncio
+
+import ds_protocol as dsp
+from ds_messenger import DirectMessage, messages_from_response
+
+"""
+The ds_async_messenger module contains an asyncio version of DirectMessenger, so that one event loop can keep sessions
+open for many accounts at once instead of needing a thread for each of them.
+"""
+
+
+class AsyncDirectMessenger:
+    """
+    The AsyncDirectMessenger class has the same API as DirectMessenger (join, send, retrieve_new and retrieve_all), but
+    every method is a coroutine and talks to the server over asyncio streams.
+
+    :param dsuserver: The IP address of the dsu server you would like to communicate with.
+
+    :param username: The username to be assigned to the message.
+
+    :param password: The password associated with the username
+
+    :param port: The port used to connect to the server.
+
+    :param timeout: The default number of seconds a single request may take. Every method also accepts its own
+     timeout, which takes precedence over this one.
+
+    Like DirectMessenger, the messenger joins once and keeps its session and token for all later requests. A session
+    that breaks is reopened and joined again on the next request.
+    """
+
+    def __init__(self, dsuserver="168.235.86.101", username=None, password=None, port=3021, timeout=10.0):
+        self.token = None
+        self.dsuserver = dsuserver
+        self.port = port
+        self.username = username
+        self.password = password
+        self.timeout = timeout
+        self.join_ok = False
+        self.sent_messages = []
+        self.joins = 0
+        self.round_trips_saved = 0
+
+        self._reader = None
+        self._writer = None
+        # requests on one session have to be answered in order, so only one may be in flight at a time
+        self._lock = asyncio.Lock()
+
+    async def join(self, timeout=None) -> bool:
+        """
+        Opens a session with the server and joins it, returning True if the username and password were accepted.
+        """
+        async with self._lock:
+            await self._ensure_session(timeout)
+            return self.join_ok
+
+    async def send(self, message, recipient, timeout=None) -> bool:
+        """
+        Takes a message (as a string) and recipient (as a string) and asks the server to send the message to the
+        recipient. Returns True if the message was sent.
+        """
+        server_response = await self._request("send", message, recipient, timeout)
+        if server_response is None or server_response["response"].get("message") != "Direct message sent":
+            return False
+
+        msgdict = dsp.get_msg_dict(message=message, recipient=recipient)
+        dm = DirectMessage(timestamp=msgdict["timestamp"], message=msgdict["message"], recipient=msgdict["recipient"], frm=self.username)
+        self.sent_messages.append(dm)
+        return True
+
+    async def retrieve_new(self, timeout=None) -> list:
+        """
+        returns a list of DirectMessage objects containing all new messages
+        """
+        server_response = await self._request("new", timeout=timeout)
+        if server_response is None:
+            return []
+        return messages_from_response(server_response, self.username)
+
+    async def retrieve_all(self, timeout=None) -> list:
+        """
+        returns a list of DirectMessage objects containing all messages
+        """
+        server_response = await self._request("all", timeout=timeout)
+        if server_response is None:
+            return []
+        return messages_from_response(server_response, self.username)
+
+    async def close(self) -> None:
+        """Closes the messenger's session with the server. The next request will connect and join again."""
+        writer = self._writer
+        self._reader = None
+        self._writer = None
+        self.join_ok = False
+        if writer is not None:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except OSError:
+                pass
+
+    async def _request(self, taip, message=None, recipient=None, timeout=None):
+        """
+        Sends a single request over the session, joining first if needed. Returns the server's response as a
+        dictionary, or None if the server rejected the username and password, or if the reply to a send was lost.
+
+        A request that times out closes the session and raises asyncio.TimeoutError. As in DirectMessenger, a
+        request is only retried (once, on a fresh session) if it failed before it was written: the server may have
+        handled a request that was written, so a send whose reply is lost is reported as failed rather than being
+        sent twice, and a lost retrieve raises the OSError. A reply that does not fit its request closes the session
+        and raises ValueError.
+        """
+        async with self._lock:
+            for attempt in range(2):
+                if self._writer is not None and (self._reader.at_eof() or self._writer.is_closing()):
+                    # the server closed the session while it was idle
+                    await self.close()
+                reused = self._writer is not None
+                written = False
+                try:
+                    await self._ensure_session(timeout)
+                    if not self.join_ok:
+                        dsp.incorrectlogin_response()
+                        return None
+                    if taip == "send":
+                        msg = dsp.get_sendmsg(self.token, message, recipient)
+                    else:
+                        msg = dsp.get_rtrmsg(self.token, taip)
+                    written = True
+                    server_response = await self._exchange(msg, timeout, taip)
+                except asyncio.TimeoutError:
+                    await self.close()
+                    raise
+                except OSError:
+                    await self.close()
+                    if written and taip == "send":
+                        return None
+                    if written or attempt == 1:
+                        raise
+                    continue
+                except ValueError:
+                    await self.close()
+                    raise
+
+                if reused:
+                    self.round_trips_saved += 1
+                return server_response
+
+    async def _ensure_session(self, timeout) -> None:
+        """Connects and joins if there is no open session, caching the token."""
+        if self._writer is not None:
+            return
+        try:
+            self._reader, self._writer = await asyncio.wait_for(
+                asyncio.open_connection(self.dsuserver, self.port), self._timeout(timeout))
+            joinresponse = await self._exchange(dsp.get_joinmsg(self.username, self.password), timeout, "join")
+        except BaseException:
+            await self.close()
+            raise
+        self.joins += 1
+
+        if dsp.get_responseType(joinresponse) == "ok":
+            self.token = dsp.get_token(joinresponse)
+            self.join_ok = True
+        else:
+            await self.close()
+
+    async def _exchange(self, msg, timeout, typ) -> dict:
+        """
+        Writes one request line and waits for the reply line, within the request's timeout. Raises ValueError if
+        the reply cannot be parsed or does not fit a request of type typ (see ds_protocol.check_reply).
+        """
+        async def exchange():
+            self._writer.write((msg + '\r\n').encode())
+            await self._writer.drain()
+            return await self._reader.readline()
+
+        srv_msg = await asyncio.wait_for(exchange(), self._timeout(timeout))
+        if not srv_msg:
+            raise ConnectionResetError("The DSP server closed the connection.")
+        msg_dict = dsp.load_srvmsg(srv_msg)
+        dsp.check_reply(msg_dict, typ)
+        return msg_dict
+
+    def _timeout(self, timeout):
+        return self.timeout if timeout is None else timeout
@@ -0,0 +1,716 @@
+import asyncio
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+from binary_profile import write_binary
+from ds_async_messenger import AsyncDirectMessenger
+from ds_messenger import DirectMessage, DirectMessenger, messages_from_response
+from message_store import MessageStore
+from Profile import Post, Profile, ProfileCache, ProfilePersister
+from sqlite_profile import SqliteProfile
+from ds_server import DSPServer
+from history_archive import archive_profile
+from ds_sync import AdaptivePoll, FixedPoll, Outbox, SyncWorker
+
+"""
+The ds_bench module contains benchmarks for the messaging code. Every benchmark runs against a local DSPServer, so the
+numbers can be repeated offline. Run it directly to run all of them.
+"""
+
+
+def bench_async_accounts(accounts: int = 500) -> dict:
+    """
+    Drives `accounts` AsyncDirectMessengers from one event loop. Every account joins, sends one message to the next
+    account and then retrieves its new messages.
+    """
+    async def run():
+        server = DSPServer()
+        await server.start()
+        messengers = [AsyncDirectMessenger("127.0.0.1", f"user{i}", "password", server.port, timeout=30)
+                      for i in range(accounts)]
+
+        async def session(i):
+            messenger = messengers[i]
+            await messenger.join()
+            await messenger.send(f"hello from user{i}", f"user{(i + 1) % accounts}")
+
+        start = time.perf_counter()
+        await asyncio.gather(*(session(i) for i in range(accounts)))
+        received = await asyncio.gather(*(messenger.retrieve_new() for messenger in messengers))
+        elapsed = time.perf_counter() - start
+
+        await asyncio.gather(*(messenger.close() for messenger in messengers))
+        await server.close()
+        return elapsed, sum(len(messages) for messages in received)
+
+    elapsed, received = asyncio.run(run())
+    return {"accounts": accounts, "seconds": elapsed, "requests_per_second": accounts * 3 / elapsed,
+            "messages_received": received}
+
+
+def bench_session(requests: int = 200, latency: float = 0.002) -> dict:
+    """
+    Compares a DirectMessenger that keeps its session against creating a new messenger (and so a new connection and
+    join) for every retrieve_new, which is what the GUI used to do.
+    """
+    server = DSPServer(latency=latency)
+    port = server.start_in_thread()
+
+    start = time.perf_counter()
+    for _ in range(requests):
+        messenger = DirectMessenger("127.0.0.1", "fresh", "password", port)
+        messenger.retrieve_new()
+        messenger.close()
+    fresh_seconds = time.perf_counter() - start
+    fresh_joins = server.joins
+
+    messenger = DirectMessenger("127.0.0.1", "session", "password", port)
+    start = time.perf_counter()
+    for _ in range(requests):
+        messenger.retrieve_new()
+    session_seconds = time.perf_counter() - start
+    messenger.close()
+    session_joins = server.joins - fresh_joins
+
+    server.stop_thread()
+    return {"requests": requests, "fresh_seconds": fresh_seconds, "fresh_joins": fresh_joins,
+            "session_seconds": session_seconds, "session_joins": session_joins,
+            "round_trips_saved": messenger.round_trips_saved}
+
+
+def bench_send_many(batch_sizes=(1, 10, 100, 1000), latency: float = 0.005) -> dict:
+    """Measures messages per second sent with send_many for each batch size, against a server with `latency`."""
+    server = DSPServer(latency=latency)
+    port = server.start_in_thread()
+    messenger = DirectMessenger("127.0.0.1", "sender", "password", port)
+    messenger.send_many([("warm up", "receiver")])
+
+    results = {}
+    for size in batch_sizes:
+        batch = [(f"message {i}", "receiver") for i in range(size)]
+        start = time.perf_counter()
+        sent = messenger.send_many(batch)
+        elapsed = time.perf_counter() - start
+        results[size] = {"sent": sum(sent), "messages_per_second": size / elapsed}
+
+    messenger.close()
+    server.stop_thread()
+    return results
+
+
+def bench_merge(history: int = 1000000, new: int = 10000) -> dict:
+    """
+    Merges `new` messages (plus the same number of duplicates) into a profile that already holds `history` messages.
+    """
+    profile = Profile(username="me")
+    for i in range(history):
+        profile.add_msg(DirectMessage(f"old {i}", i, "me", f"user{i % 100}"))
+
+    incoming = [DirectMessage(f"new {i}", history + i, "me", f"user{i % 100}") for i in range(new)]
+    start = time.perf_counter()
+    added = sum(profile.add_msg(message) for message in incoming + incoming)
+    elapsed = time.perf_counter() - start
+    return {"history": history, "merged": len(incoming) * 2, "added": added, "seconds": elapsed}
+
+
+def bench_save(history: int = 100000, saves: int = 100) -> dict:
+    """
+    Compares rewriting a DSU file with `history` messages on every save against appending one message per save to
+    its journal.
+    """
+    profile = Profile(username="me")
+    for i in range(history):
+        profile.add_msg(DirectMessage(f"old {i}", i, "me", f"user{i % 100}"))
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "bench.dsu")
+        open(path, 'w').close()
+
+        start = time.perf_counter()
+        for i in range(saves):
+            profile.add_msg(DirectMessage(f"snapshot {i}", history + i, "user0", "me"))
+            profile._write_snapshot(Path(path))
+        snapshot_seconds = (time.perf_counter() - start) / saves
+
+        start = time.perf_counter()
+        for i in range(saves):
+            profile.add_msg(DirectMessage(f"journal {i}", history + saves + i, "user0", "me"))
+            profile.save_profile(path)
+        journal_seconds = (time.perf_counter() - start) / saves
+
+    return {"history": history, "snapshot_ms_per_save": snapshot_seconds * 1000,
+            "journal_ms_per_save": journal_seconds * 1000}
+
+
+def bench_backends(sizes=(10000, 100000, 1000000), contacts: int = 100) -> dict:
+    """
+    Compares the JSON Profile with SqliteProfile at each history size: adding every message and saving, loading the
+    file again, and reading the latest 50 messages of one chat.
+    """
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for size in sizes:
+            messages = [DirectMessage(f"message {i}", i, "me", f"user{i % contacts}") for i in range(size)]
+            for name, backend, suffix in (("json", Profile, ".dsu"), ("sqlite", SqliteProfile, ".dsdb")):
+                path = os.path.join(directory, f"{name}{size}{suffix}")
+                open(path, 'w').close()
+                timings = {}
+
+                start = time.perf_counter()
+                profile = backend(username="me")
+                for message in messages:
+                    profile.add_msg(message)
+                profile.save_profile(path)
+                timings["add_and_save"] = time.perf_counter() - start
+
+                start = time.perf_counter()
+                profile = backend()
+                profile.load_profile(path)
+                timings["load"] = time.perf_counter() - start
+
+                start = time.perf_counter()
+                profile.get_chat_messages("user7", limit=50)
+                timings["chat_page"] = time.perf_counter() - start
+
+                results[(name, size)] = timings
+    return results
+
+
+def bench_memory(count: int = 1000000, contacts: int = 100) -> dict:
+    """
+    Measures with tracemalloc how many bytes `count` messages take as a list of DirectMessage objects and as a
+    MessageStore, message texts included.
+    """
+    def measure(build):
+        tracemalloc.start()
+        container = build()
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del container
+        return size
+
+    def dicts():
+        return [DirectMessage(f"message {i}", i, "me", f"user{i % contacts}") for i in range(count)]
+
+    def store():
+        messages = MessageStore()
+        for i in range(count):
+            messages.append_fields(f"user{i % contacts}", "me", i, f"message {i}")
+        return messages
+
+    dict_bytes = measure(dicts)
+    store_bytes = measure(store)
+    return {"messages": count, "direct_message_bytes": dict_bytes, "message_store_bytes": store_bytes,
+            "ratio": dict_bytes / store_bytes}
+
+
+def bench_lazy_open(history: int = 1000000, contacts: int = 100) -> dict:
+    """
+    Compares opening a DSU file with `history` messages fully and lazily, and the cost of then reading one chat.
+    """
+    profile = Profile(username="me")
+    for i in range(history):
+        profile.add_msg(DirectMessage(f"message {i}", i, "me", f"user{i % contacts}"))
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "bench.dsu")
+        open(path, 'w').close()
+        profile.save_profile(path)
+        del profile
+
+        start = time.perf_counter()
+        Profile().load_profile(path)
+        full_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        lazy = Profile()
+        lazy.load_profile(path, lazy=True)
+        lazy_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        lazy.get_chat_messages("user7")
+        chat_seconds = time.perf_counter() - start
+
+        return {"history": history, "file_bytes": os.path.getsize(path), "full_open_seconds": full_seconds,
+                "lazy_open_seconds": lazy_seconds, "first_chat_seconds": chat_seconds}
+
+
+def bench_binary_load(history: int = 1000000, contacts: int = 100) -> dict:
+    """
+    Compares opening a profile with `history` messages as a JSON DSU file (fully and lazily) and as a memory-mapped
+    .dsb file, and then reading the latest 50 messages of one chat. Each is timed cold, with the file dropped from
+    the page cache first where the system allows it, and warm, right after the cold run.
+    """
+    profile = Profile(username="me")
+    for i in range(history):
+        profile.add_msg(DirectMessage(f"message {i}", i, "me", f"user{i % contacts}"))
+
+    def drop_cache(path):
+        if hasattr(os, "posix_fadvise"):
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+            finally:
+                os.close(fd)
+
+    def open_and_read(path, lazy):
+        start = time.perf_counter()
+        loaded = Profile()
+        loaded.load_profile(path, lazy=lazy)
+        loaded.get_chat_messages("user7", limit=50)
+        return time.perf_counter() - start
+
+    results = {"history": history}
+    with tempfile.TemporaryDirectory() as directory:
+        dsu = os.path.join(directory, "bench.dsu")
+        dsb = os.path.join(directory, "bench.dsb")
+        open(dsu, 'w').close()
+        profile.save_profile(dsu)
+        write_binary(profile, dsb)
+        del profile
+        results["dsu_bytes"] = os.path.getsize(dsu)
+        results["dsb_bytes"] = os.path.getsize(dsb)
+
+        for name, path, lazy in (("json_full", dsu, False), ("json_lazy", dsu, True), ("binary", dsb, True)):
+            drop_cache(path)
+            results[f"{name}_cold_seconds"] = open_and_read(path, lazy)
+            results[f"{name}_warm_seconds"] = open_and_read(path, lazy)
+    return results
+
+
+def bench_archive(history: int = 1000000, contacts: int = 100, keep: int = 1000) -> dict:
+    """
+    Archives all but the latest `keep` messages of every chat of a DSU file with `history` messages, and compares
+    loading it and reading the latest 50 messages of one chat before and after, as well as reading back the chat's
+    oldest page from the archive.
+    """
+    profile = Profile(username="me")
+    for i in range(history):
+        profile.add_msg(DirectMessage(f"message {i}", i, "me", f"user{i % contacts}"))
+
+    def open_and_read(path):
+        start = time.perf_counter()
+        loaded = Profile()
+        loaded.load_profile(path)
+        loaded.get_chat_messages("user7", limit=50)
+        return loaded, time.perf_counter() - start
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "bench.dsu")
+        open(path, 'w').close()
+        profile.save_profile(path)
+        del profile
+
+        before_seconds = open_and_read(path)[1]
+        start = time.perf_counter()
+        report = archive_profile(path, keep=keep)
+        archive_seconds = time.perf_counter() - start
+        loaded, after_seconds = open_and_read(path)
+
+        start = time.perf_counter()
+        loaded.get_chat_messages("user7", until=contacts * 50)
+        oldest_page_seconds = time.perf_counter() - start
+
+    return dict(report, history=history, archive_seconds=archive_seconds, load_and_page_before_seconds=before_seconds,
+                load_and_page_after_seconds=after_seconds, oldest_page_seconds=oldest_page_seconds)
+
+
+def bench_search(history: int = 1000000, contacts: int = 100, queries: int = 100) -> dict:
+    """
+    Builds the search index of a profile with `history` messages and times plain, multi-word, prefix and per-contact
+    queries against it, as well as adding a message to the index.
+    """
+    words = ["lunch", "meeting", "tomorrow", "project", "deadline", "coffee", "weekend", "report", "call", "review"]
+    profile = Profile(username="me")
+    for i in range(history):
+        text = f"{words[i % 10]} {words[i * 7 % 10]} {words[i * 3 % 10]} note{i % 5000}"
+        profile.add_msg(DirectMessage(text, i, "me", f"user{i % contacts}"))
+
+    start = time.perf_counter()
+    profile._build_search_index()
+    results = {"history": history, "build_seconds": time.perf_counter() - start}
+
+    for name, query, contact in (("single_word", "deadline", None), ("two_words", "coffee review", None),
+                                 ("prefix", "note12*", None), ("rare_word", "note4321", None),
+                                 ("one_contact", "lunch meeting", "user7")):
+        start = time.perf_counter()
+        for _ in range(queries):
+            profile.search(query, contact=contact, limit=20)
+        results[f"{name}_ms"] = (time.perf_counter() - start) / queries * 1000
+
+    start = time.perf_counter()
+    for i in range(queries):
+        profile.add_msg(DirectMessage(f"late night {words[i % 10]}", history + i, "me", "user0"))
+    results["add_msg_ms"] = (time.perf_counter() - start) / queries * 1000
+    return results
+
+
+def bench_posts(count: int = 1000000, operations: int = 10000) -> dict:
+    """
+    Fills a profile with `count` posts in random timestamp order (one batch, then one post at a time), and times
+    range queries, latest_posts and deleting posts by id.
+    """
+    shuffled = random.Random(0)
+    timestamps = list(range(count))
+    shuffled.shuffle(timestamps)
+
+    profile = Profile(username="me")
+    start = time.perf_counter()
+    profile.add_posts(Post(f"post {t}", t) for t in timestamps[:count // 2])
+    results = {"posts": count, "bulk_add_seconds": time.perf_counter() - start}
+
+    start = time.perf_counter()
+    ids = [profile.add_post(Post(f"post {t}", t)) for t in timestamps[count // 2:]]
+    results["add_post_us"] = (time.perf_counter() - start) / (count - count // 2) * 1e6
+
+    start = time.perf_counter()
+    for i in range(operations):
+        profile.get_posts_between(i * 37 % count, i * 37 % count + 20)
+    results["range_of_20_us"] = (time.perf_counter() - start) / operations * 1e6
+
+    start = time.perf_counter()
+    for _ in range(operations):
+        profile.latest_posts(20)
+    results["latest_20_us"] = (time.perf_counter() - start) / operations * 1e6
+
+    start = time.perf_counter()
+    for post_id in ids[:operations]:
+        profile.del_post_by_id(post_id)
+    results["delete_by_id_us"] = (time.perf_counter() - start) / operations * 1e6
+    return results
+
+
+def bench_persister(history: int = 100000, changes: int = 2000, interval: float = 0.5) -> dict:
+    """
+    Compares saving a profile with `history` messages after each of `changes` quick changes against marking it dirty
+    with a ProfilePersister: the time the changing thread spends, and how many times the file is written.
+    """
+    results = {"history": history, "changes": changes}
+    with tempfile.TemporaryDirectory() as directory:
+        for name in ("sync", "write_behind"):
+            path = os.path.join(directory, f"{name}.dsu")
+            open(path, 'w').close()
+            cache = ProfileCache()
+            profile = Profile(username="me")
+            for i in range(history):
+                profile.add_msg(DirectMessage(f"old {i}", i, "me", f"user{i % 100}"))
+            cache.save(path, profile)
+            persister = ProfilePersister(cache, interval=interval)
+
+            start = time.perf_counter()
+            for i in range(changes):
+                profile.add_msg(DirectMessage(f"new {i}", history + i, "user0", "me"))
+                if name == "sync":
+                    cache.save(path)
+                else:
+                    persister.mark_dirty(path)
+            results[f"{name}_caller_seconds"] = time.perf_counter() - start
+            persister.close()
+            results[f"{name}_total_seconds"] = time.perf_counter() - start
+            results[f"{name}_writes"] = changes if name == "sync" else persister.writes
+    return results
+
+
+def bench_ndjson(history: int = 1000000, contacts: int = 100) -> dict:
+    """
+    Exports a DSU file with `history` messages to NDJSON from a lazily loaded profile, and imports the file into a
+    .dsdb database and into a Profile, reporting the throughput of each. The export and the .dsdb import are run a
+    second time under tracemalloc for the peak memory Python allocates for them.
+    """
+    profile = Profile(username="me")
+    for i in range(history):
+        profile.add_msg(DirectMessage(f"message {i}", i, "me", f"user{i % contacts}"))
+
+    def export(path):
+        lazy = Profile()
+        lazy.load_profile(dsu, lazy=True)
+        lazy.export_ndjson(path)
+
+    def import_sqlite(path):
+        database = SqliteProfile(username="me")
+        database.save_profile(path)
+        database.import_ndjson(ndjson)
+        database.save_profile(path)
+        database.close()
+
+    def timed(run, *args):
+        start = time.perf_counter()
+        run(*args)
+        return history / (time.perf_counter() - start)
+
+    def traced(run, *args):
+        tracemalloc.start()
+        run(*args)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return peak
+
+    results = {"history": history}
+    with tempfile.TemporaryDirectory() as directory:
+        dsu = os.path.join(directory, "bench.dsu")
+        ndjson = os.path.join(directory, "bench.ndjson")
+        open(dsu, 'w').close()
+        profile.save_profile(dsu)
+        del profile
+
+        results["export_messages_per_second"] = timed(export, ndjson)
+        results["export_peak_bytes"] = traced(export, os.path.join(directory, "traced.ndjson"))
+        results["ndjson_bytes"] = os.path.getsize(ndjson)
+        results["sqlite_import_messages_per_second"] = timed(import_sqlite, os.path.join(directory, "bench.dsdb"))
+        results["sqlite_import_peak_bytes"] = traced(import_sqlite, os.path.join(directory, "traced.dsdb"))
+        results["profile_import_messages_per_second"] = timed(Profile(username="me").import_ndjson, ndjson)
+    return results
+
+def bench_stream_retrieve(inbox: int = 200000) -> dict:
+    """
+    Compares reading an inbox of `inbox` messages with retrieve "all" as one parsed line turned into a list (what
+    retrieve_all used to do) against streaming it with stream_all: time, and the peak memory Python allocates. The
+    server runs in its own process here, so that the memory it uses to build the response is not counted.
+    """
+    server = subprocess.Popen([sys.executable, "ds_server.py", "--port", "0"], stdout=subprocess.PIPE, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)))
+    try:
+        port = int(server.stdout.readline().rsplit(":", 1)[1])
+        sender = DirectMessenger("127.0.0.1", "sender", "password", port)
+        sender.send_many([(f"message {i} from the bench", "reader") for i in range(inbox)])
+        sender.close()
+        messenger = DirectMessenger("127.0.0.1", "reader", "password", port)
+        messenger.retrieve_new()
+
+        def whole_line():
+            response = messenger._communicate_w_server(server="127.0.0.1", port=port, taip="all")
+            return len(messages_from_response(response, "reader"))
+
+        def streamed():
+            return sum(1 for _ in messenger.stream_all())
+
+        results = {"inbox": inbox}
+        for name, run in (("whole_line", whole_line), ("stream", streamed)):
+            start = time.perf_counter()
+            results[f"{name}_messages"] = run()
+            results[f"{name}_seconds"] = time.perf_counter() - start
+            tracemalloc.start()
+            run()
+            results[f"{name}_peak_bytes"] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        messenger.close()
+        return results
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def bench_chat_page(history: int = 1000000, page: int = 200) -> dict:
+    """
+    Times what the GUI's message viewer asks of a lazily opened profile when a contact with `history` messages is
+    opened: its latest `page` messages, and the page before them. Compares a DSU file, a .dsb file and a fully
+    loaded profile.
+    """
+    profile = Profile(username="me")
+    for i in range(history):
+        profile.add_msg(DirectMessage(f"message {i}", i, "me", "friend"))
+
+    results = {"history": history}
+    with tempfile.TemporaryDirectory() as directory:
+        dsu = os.path.join(directory, "bench.dsu")
+        dsb = os.path.join(directory, "bench.dsb")
+        open(dsu, 'w').close()
+        profile.save_profile(dsu)
+        write_binary(profile, dsb)
+
+        def first_pages(loaded):
+            start = time.perf_counter()
+            latest = loaded.get_chat_messages("friend", limit=page)
+            loaded.chat_count("friend")
+            first = time.perf_counter() - start
+            loaded.get_chat_messages("friend", until=latest[0]['timestamp'], limit=page)
+            return first, time.perf_counter() - start - first
+
+        for name, path in (("dsu", dsu), ("dsb", dsb)):
+            loaded = Profile()
+            start = time.perf_counter()
+            loaded.load_profile(path, lazy=True)
+            results[f"{name}_open_ms"] = (time.perf_counter() - start) * 1000
+            first, older = first_pages(loaded)
+            results[f"{name}_first_page_ms"] = first * 1000
+            results[f"{name}_older_page_ms"] = older * 1000
+        first, older = first_pages(profile)
+        results["loaded_first_page_ms"] = first * 1000
+        results["loaded_older_page_ms"] = older * 1000
+    return results
+
+
+def bench_sync_worker(inbox: int = 20000, latency: float = 2.0, seconds: float = 10.0, batch: int = 200) -> dict:
+    """
+    Measures how long the GUI's thread is busy per timer tick while `inbox` messages arrive from a server that takes
+    `latency` seconds to answer each request: once when the tick polls the server itself, as update_messages used
+    to, and once when a SyncWorker polls on its own thread and the tick only takes up to `batch` of the queued
+    messages and reads the newest ones of the chat, like Body.update_messages and render_chat do.
+    """
+    server = DSPServer()
+    port = server.start_in_thread()
+    sender = DirectMessenger("127.0.0.1", "friend", "password", port)
+    sender.send_many([(f"message {i}", "me") for i in range(inbox)])
+    sender.close()
+    server.latency = latency
+
+    results = {"inbox": inbox, "latency": latency}
+    with tempfile.TemporaryDirectory() as directory:
+        cache = ProfileCache()
+        paths = {}
+        for name in ("blocking", "worker"):
+            paths[name] = os.path.join(directory, f"{name}.dsu")
+            open(paths[name], 'w').close()
+            cache.save(paths[name], Profile(username="me", password="password"))
+        persister = ProfilePersister(cache)
+
+        messenger = DirectMessenger("127.0.0.1", "me", "password", port)
+        start = time.perf_counter()
+        messenger.sync(cache.get(paths["blocking"]))
+        results["blocking_tick_seconds"] = time.perf_counter() - start
+        messenger.close()
+
+        path = paths["worker"]
+        worker = SyncWorker(path, cache, persister, FixedPoll(0.1), dsuserver="127.0.0.1", port=port)
+        worker.start()
+        ticks = []
+        received = 0
+        end = time.perf_counter() + seconds
+        while time.perf_counter() < end and received < inbox:
+            start = time.perf_counter()
+            drained = worker.drain(batch)
+            received += sum(1 for kind, _ in drained if kind == 'message')
+            if drained:
+                cache.get(path).get_chat_messages("friend", limit=batch)
+            ticks.append(time.perf_counter() - start)
+            time.sleep(0.001 if worker.pending() else 0.05)
+        worker.stop()
+        persister.close()
+        ticks.sort()
+        results.update(worker_received=received, worker_ticks=len(ticks), worker_max_tick_seconds=ticks[-1],
+                       worker_p99_tick_seconds=ticks[int(len(ticks) * 0.99)])
+    server.stop_thread()
+    return results
+
+
+def bench_outbox(messages: int = 200, latency: float = 0.05) -> dict:
+    """
+    Compares sending `messages` quick messages one at a time with DirectMessenger.send on the caller's thread, as
+    MainApp.send_message used to, against queuing them in an Outbox: the time the caller spends, the time until
+    all of them are sent, and how many send_many batches the outbox needed.
+    """
+    server = DSPServer(latency=latency)
+    port = server.start_in_thread()
+    results = {"messages": messages, "latency": latency}
+
+    messenger = DirectMessenger("127.0.0.1", "blocking", "password", port)
+    start = time.perf_counter()
+    for i in range(messages):
+        messenger.send(f"message {i}", "receiver")
+    results["blocking_caller_seconds"] = time.perf_counter() - start
+    messenger.close()
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "outbox.dsu")
+        open(path, 'w').close()
+        cache = ProfileCache()
+        cache.save(path, Profile(username="outbox", password="password"))
+        persister = ProfilePersister(cache)
+        outbox = Outbox(path, cache, persister, dsuserver="127.0.0.1", port=port)
+        outbox.start()
+
+        start = time.perf_counter()
+        for i in range(messages):
+            outbox.send(f"message {i}", "receiver")
+        results["outbox_caller_seconds"] = time.perf_counter() - start
+        while outbox.entries():
+            time.sleep(0.001)
+        results["outbox_total_seconds"] = time.perf_counter() - start
+        results["outbox_batches"] = outbox.batches
+        outbox.stop()
+        persister.close()
+    server.stop_thread()
+    return results
+
+
+def bench_poll_policy(chat_seconds: float = 5.0, idle_seconds: float = 15.0, interval: float = 1.0,
+                      max_interval: float = 8.0) -> dict:
+    """
+    Runs a SyncWorker with FixedPoll(interval) next to one with an AdaptivePoll (from interval up to max_interval)
+    through the same conversation: a message every second or so for `chat_seconds`, then `idle_seconds` of quiet
+    with a single message in the middle. The default interval is the fixed 1 second the GUI used to poll at, so the
+    fixed worker is the real baseline. Returns the metrics of both workers, so that the polls they made can be
+    compared with how long messages took to arrive.
+    """
+    server = DSPServer()
+    port = server.start_in_thread()
+    policies = {"fixed": FixedPoll(interval), "adaptive": AdaptivePoll(interval, max_interval, seed=1)}
+
+    with tempfile.TemporaryDirectory() as directory:
+        cache = ProfileCache()
+        persister = ProfilePersister(cache)
+        workers = {}
+        for name, policy in policies.items():
+            path = os.path.join(directory, f"{name}.dsu")
+            open(path, 'w').close()
+            cache.save(path, Profile(username=name, password="password"))
+            workers[name] = SyncWorker(path, cache, persister, policy, dsuserver="127.0.0.1", port=port)
+            workers[name].start()
+
+        sender = DirectMessenger("127.0.0.1", "friend", "password", port)
+        rng = random.Random(1)
+        sent = 0
+        start = time.monotonic()
+        while time.monotonic() - start < chat_seconds:
+            for name in workers:
+                sender.send("hello", name)
+            sent += 1
+            time.sleep(rng.uniform(0.5, 1.5))
+        time.sleep(idle_seconds / 2)
+        for name in workers:
+            sender.send("still there?", name)
+        sent += 1
+        time.sleep(idle_seconds / 2)
+        sender.close()
+
+        results = {}
+        for name, worker in workers.items():
+            # the last message counts only once it has arrived
+            deadline = time.monotonic() + max_interval * 2
+            while worker.metrics()["messages"] < sent and time.monotonic() < deadline:
+                time.sleep(0.05)
+            worker.stop()
+            results[name] = worker.metrics()
+        persister.close()
+    server.stop_thread()
+    return results
+
+
+if __name__ == "__main__":
+    print("session:", bench_session())
+    print("send_many:", bench_send_many())
+    print("async accounts:", bench_async_accounts())
+    print("merge:", bench_merge())
+    print("save:", bench_save())
+    print("memory:", bench_memory())
+    print("lazy open:", bench_lazy_open())
+    print("binary load:", bench_binary_load())
+    print("archive:", bench_archive())
+    print("search:", bench_search())
+    print("posts:", bench_posts())
+    print("persister:", bench_persister())
+    print("ndjson:", bench_ndjson())
+    print("stream retrieve:", bench_stream_retrieve())
+    print("chat page:", bench_chat_page())
+    print("sync worker:", bench_sync_worker())
+    print("outbox:", bench_outbox())
+    print("poll policy:", bench_poll_policy())
+    for (backend, size), timings in bench_backends().items():
+        print(f"{backend} backend, {size} messages:", timings)
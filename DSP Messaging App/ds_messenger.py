@@ -3,8 +3,11 @@
 # 93592684
 
 import ds_protocol as dsp
+import itertools
+import select
 import socket
 import json
+import time
 
 
 class DirectMessage(dict):
@@ -20,6 +23,9 @@ class DirectMessage(dict):
 
     """
 
+    # the values already live in the dict itself, so instances skip the per-object __dict__
+    __slots__ = ('_message', '_timestamp', '_recipient', '_frm')
+
     def __init__(self, message: str = None, timestamp: float = 0, recipient: str = None, frm: str = None):
         self._message = message
         self._timestamp = timestamp
@@ -58,7 +64,22 @@ class DirectMessage(dict):
         return self._timestamp
 
 
+def messages_from_response(server_response: dict, username: str) -> list:
+    """
+    Takes the server's response to a "new" or "all" retrieve request and returns the messages in it as a list of
+    DirectMessage objects addressed to username.
+    """
+    messagelist = []
+    for message in server_response["response"]["messages"]:
+        newmessage = DirectMessage(timestamp=message["timestamp"], message=message["message"], recipient=username, frm=message["from"])
+        messagelist.append(newmessage)
+
+    return messagelist
+
 
+def _identity(message: dict) -> tuple:
+    """returns who sent a message, to whom, when and what it says, which together tell messages apart"""
+    return message['from'], message['recipient'], float(message['timestamp']), message['message']
 
 
 class DirectMessenger:
@@ -83,6 +104,9 @@ class DirectMessenger:
 
      DirectMessenger also saves all sent messages to the instance variable self.sent_messages as a List object.
 
+     The connection and token are kept open between calls (see close()), and self.round_trips_saved counts the
+     requests that went over the open session instead of connecting and joining again.
+
 
     """
 
@@ -95,6 +119,18 @@ class DirectMessenger:
         self.join_ok = False
         self.sent_messages = []
 
+        # The connection to the server is opened once and then kept for every later request, so a send or retrieve
+        # only costs the request itself instead of a TCP handshake plus a join round-trip.
+        self._client = None
+        self._send_file = None
+        self._recv_file = None
+        self.joins = 0  # join round-trips actually performed
+        self.round_trips_saved = 0  # requests that reused the open session instead of connecting and joining again
+        self.written = 0  # messages the last send_many wrote to the server, answered or not
+
+        # how many characters of a retrieve response are read at a time (see _stream_from_server)
+        self.chunk_size = 65536
+
     def send(self, message, recipient) -> bool:
         """
         Takes a message (as a string) and recipient (as a string) and sends a message to the server requesting to send
@@ -110,50 +146,150 @@ class DirectMessenger:
         if server_response["response"]["message"] == "Direct message sent":
 
             # saves the message that was successfully sent to the server
-            msgdict = dsp.get_msg_dict(message=message, recipient=recipient)
-            dm = DirectMessage(timestamp=msgdict["timestamp"], message=msgdict["message"], recipient=msgdict["recipient"], frm=self.username)
-            # dm.fill_info_sent(messagedict=messagedict, myusername=self.username)
-            self.sent_messages.append(dm)
+            self._record_sent(message, recipient)
 
             return True
         else:
             return False
 
+    def send_many(self, messages, window: int = 256) -> list:
+        """
+        Takes a list of (message, recipient) pairs and sends all of them over the messenger's session without waiting
+        for each reply. Requests are written in windows of up to `window` messages, and the replies of each window are
+        then read back and matched to the requests in order.
+
+        Returns a list of booleans with one entry per message (True if that message was sent). A session the server
+        has already closed is reopened before anything is written. If the connection breaks once the requests are
+        written, the messages that did not get a reply are reported as False and are not resent, since the server may
+        have handled them anyway. self.written tells how many of the messages, from the first, were written.
+        """
+        messages = list(messages)
+        results = [False] * len(messages)
+        self.written = 0
+        if not messages:
+            return results
+
+        # a session the server already closed is replaced before anything is written; once the requests are
+        # written they are never written again, since the server may have handled them even if no reply came back
+        self._drop_stale_session()
+        reused = self._client is not None
+        if not reused:
+            try:
+                self._open_session(self.dsuserver, self.port)
+            except socket.gaierror:
+                print("Unable to connect to server, please try again with a valid IP address and Port number!")
+                return results
+        if not self.join_ok:
+            dsp.incorrectlogin_response()
+            return results
+
+        replies = 0
+        try:
+            for start in range(0, len(messages), window):
+                batch = messages[start:start + window]
+                # counted before the writes, since a write that fails part way may still reach the server
+                self.written = start + len(batch)
+                for message, recipient in batch:
+                    self._send_file.write(dsp.get_sendmsg(self.token, message, recipient) + '\r\n')
+                self._send_file.flush()
+
+                for offset, (message, recipient) in enumerate(batch):
+                    msg_dict = self._read_reply("send")
+                    replies += 1
+                    if msg_dict["response"].get("message") == "Direct message sent":
+                        self._record_sent(message, recipient)
+                        results[start + offset] = True
+        except OSError:
+            self.close()
+        except ValueError:
+            # a reply that does not fit its request: the session is closed and the rest count as not sent
+            pass
+
+        if replies:
+            # every reply after the first skipped its own request/reply wait, and a reused session skipped the join
+            self.round_trips_saved += replies - 1 + (1 if reused else 0)
+
+        return results
+
+    def _record_sent(self, message, recipient) -> None:
+        """Saves a message that the server accepted to self.sent_messages as a DirectMessage."""
+        msgdict = dsp.get_msg_dict(message=message, recipient=recipient)
+        dm = DirectMessage(timestamp=msgdict["timestamp"], message=msgdict["message"], recipient=msgdict["recipient"], frm=self.username)
+        self.sent_messages.append(dm)
+
     def retrieve_new(self) -> list:
         """
         returns a list of DirectMessage objects containing all new messages
         """
+        return list(self.stream_new())
 
-        server_response = self._communicate_w_server(server=self.dsuserver, port=self.port, taip="new")
+    def retrieve_all(self) -> list:
+        """
+        returns a list of DirectMessage objects containing all messages
+        """
+        return list(self.stream_all())
 
-        messages = server_response["response"]["messages"]
-        messagelist = []
-        for message in messages:
-            newmessage = DirectMessage(timestamp=message["timestamp"], message=message["message"], recipient=self.username, frm=message["from"])
-            # newmessage.fill_info_received(message, self.username)
-            messagelist.append(newmessage)
+    def stream_new(self):
+        """
+        yields the new messages as DirectMessage objects while the server's response is still being read, see
+        _stream_from_server
+        """
+        return self._stream_from_server("new")
 
-        return messagelist
+    def stream_all(self):
+        """
+        yields all messages as DirectMessage objects while the server's response is still being read, see
+        _stream_from_server
+        """
+        return self._stream_from_server("all")
 
-    def retrieve_all(self) -> list:
+    def sync(self, profile, full: bool = False) -> list:
         """
-        returns a list of DirectMessage objects containing all messages
+        Merges the messages the profile does not have yet into it and returns the ones that were added.
+
+        Once the profile has synced before, only the messages the server has not handed out yet are fetched ("new"),
+        so the cost of a sync grows with the number of new messages instead of the size of the history. The first
+        sync, or one called with full=True, falls back to retrieving everything ("all") and merges only what is newer
+        than the profile's sync cursor for each sender. Messages the profile already has are never added twice.
+
+        Messages are merged while the server's response is still being read, so a huge inbox never has to be held in
+        memory as a whole. If the server answers with an error, ValueError is raised and the sync does not count.
         """
-        server_response = self._communicate_w_server(server=self.dsuserver, port=self.port, taip="all")
+        full = full or not profile.get_last_sync()
+        messages = self.stream_all() if full else self.stream_new()
 
-        messages = server_response["response"]["messages"]
-        messagelist = []
+        added = []
+        known = {}  # sender -> identities of the messages the profile already has with them, for a full sync
         for message in messages:
-            newmessage = DirectMessage(timestamp=message["timestamp"], message=message["message"], recipient=self.username, frm=message["from"])
-            # newmessage.fill_info_received(message, self.username)
-            messagelist.append(newmessage)
-
-        return messagelist
+            sender = message['from']
+            if full:
+                if message['timestamp'] <= profile.get_sync_cursor(sender):
+                    continue
+                # a profile saved before the cursor existed has none yet, so the history it already holds has to be
+                # recognised by the messages themselves or a full sync would append all of it again
+                if sender not in known:
+                    known[sender] = {_identity(old) for old in profile.get_chat_messages(sender)}
+                if _identity(message) in known[sender]:
+                    profile.update_sync_cursor(sender, message['timestamp'])
+                    continue
+            # add_msg ignores messages the profile already has, e.g. ones a full sync returned that "new" hands out
+            # again later
+            if profile.add_msg(message):
+                profile.update_sync_cursor(sender, message['timestamp'])
+                added.append(message)
+
+        if self.join_ok:
+            # a sync that never got through does not count, or the next one would skip the full download
+            profile.set_last_sync(time.time())
+        return added
 
     def _communicate_w_server(self, server: str, port: int, taip: str, message=str,
                               recipient=str):
         """
-    The send function joins a ds server and sends a message, bio, or both
+    Sends a request over the messenger's session, joining the ds server first if no session is open yet.
+
+    If the open session turns out to be broken (the server dropped the connection, for example), the messenger
+    reconnects, joins again and retries the request once.
 
     :param server: The ip address for the ICS 32 DS server.
     :param port: The port where the ICS 32 DS server is accepting connections.
@@ -163,41 +299,146 @@ class DirectMessenger:
     :param recipient: the username of the user you want to send a message to.
 
     """
-        try:
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as client:
-                client.connect((server, port))
-                joinresponse = self._send_to_server(client=client, username=self.username, password=self.password,
-                                                    typ="join")
-
-                if dsp.get_responseType(joinresponse) == "ok":
-                    token = dsp.get_token(joinresponse)
-                    self.token = token
-                    self.join_ok = True
-
+        for attempt in range(2):
+            written = False
+            try:
+                self._drop_stale_session()
+                reused = self._client is not None
+                if not reused:
+                    self._open_session(server, port)
+
+                if self.join_ok:
                     if taip == "send":
-                        if self.join_ok:
-                            server_response = self._send_to_server(client=client, token=token, message=message,
-                                                                   recipient=recipient, typ=taip)
-
+                        msg = dsp.get_sendmsg(self.token, message, recipient)
                     else:
-                        server_response = self._send_to_server(client=client, token=token, typ=taip)
+                        msg = dsp.get_rtrmsg(self.token, taip)
+                    self._write_request(msg)
+                    written = True
+                    server_response = self._read_reply(taip)
+                    if reused:
+                        self.round_trips_saved += 1
 
                 else:
                     dsp.incorrectlogin_response()
-        except socket.gaierror:
-            print("Unable to connect to server, please try again with a valid IP address and Port number!")
+                break
+            except socket.gaierror:
+                print("Unable to connect to server, please try again with a valid IP address and Port number!")
+                break
+            except OSError:
+                # the session went stale, drop it and try again with a fresh connection and join
+                self.close()
+                # a send whose reply got lost may still have been delivered, so it is never written a second time
+                if attempt == 1 or (written and taip == "send"):
+                    raise
 
         return server_response
 
-    def _send_to_server(self, client, username=None, password=None, token=None, message=None, recipient=None, typ=None):
+    def _stream_from_server(self, taip: str):
+        """
+        Sends a "new" or "all" retrieve request over the messenger's session and yields the messages of the response
+        as DirectMessage objects while it is being read (see ds_protocol.stream_srvmsg), so that at most a chunk of
+        the response and one message are held at a time, no matter how big the inbox is. As in _communicate_w_server,
+        a broken session is reopened and the request retried once, as long as nothing has been read yet.
+
+        The session cannot be used for other requests until the generator is exhausted. If the generator is closed
+        before that, the rest of the response is still on the connection, so the session is closed and the next
+        request opens a new one. Raises ValueError once the response is read if its type is not "ok".
+        """
+        for attempt in range(2):
+            try:
+                self._drop_stale_session()
+                reused = self._client is not None
+                if not reused:
+                    self._open_session(self.dsuserver, self.port)
+                if not self.join_ok:
+                    dsp.incorrectlogin_response()
+                    return
+                if reused:
+                    self.round_trips_saved += 1
+
+                self._send_file.write(dsp.get_rtrmsg(self.token, taip) + '\r\n')
+                self._send_file.flush()
+                response = {}
+                messages = dsp.stream_srvmsg(self._recv_file, response, self.chunk_size)
+                # reading the first message is what shows whether the session still works
+                first = list(itertools.islice(messages, 1))
+                break
+            except socket.gaierror:
+                print("Unable to connect to server, please try again with a valid IP address and Port number!")
+                return
+            except OSError:
+                self.close()
+                if attempt == 1:
+                    raise
+            except ValueError:
+                # the rest of the line is still on the connection
+                self.close()
+                raise
+
+        complete = False
+        try:
+            for message in itertools.chain(first, messages):
+                yield DirectMessage(timestamp=message["timestamp"], message=message["message"],
+                                    recipient=self.username, frm=message["from"])
+            complete = True
+        finally:
+            if not complete:
+                self.close()
+        # the whole line has been read, so the session is still in step even if the server refused the request
+        if response.get("type") != "ok":
+            raise ValueError(f"The DSP server refused the request: {response.get('message')}")
+
+    def _open_session(self, server: str, port: int) -> None:
+        """Connects to the server and joins with the messenger's username and password, caching the token."""
+        self._client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            self._client.connect((server, port))
+            self._send_file = self._client.makefile('w')
+            self._recv_file = self._client.makefile('r')
+            joinresponse = self._send_to_server(username=self.username, password=self.password, typ="join")
+        except Exception:
+            self.close()
+            raise
+        self.joins += 1
+
+        if dsp.get_responseType(joinresponse) == "ok":
+            self.token = dsp.get_token(joinresponse)
+            self.join_ok = True
+        else:
+            self.close()
+
+    def _drop_stale_session(self) -> None:
+        """
+        Closes the open session if the server has already closed its end (an idle disconnect, for example), so that
+        the next request opens a fresh one before anything is written. Between requests nothing should be waiting
+        on the connection, so a readable socket means either end-of-file or data that would misalign the replies.
+        """
+        if self._client is None:
+            return
+        try:
+            readable, _, _ = select.select([self._client], [], [], 0)
+        except (OSError, ValueError):
+            readable = True
+        if readable:
+            self.close()
+
+    def close(self) -> None:
+        """Closes the messenger's session with the server. The next request will connect and join again."""
+        for stream in (self._send_file, self._recv_file, self._client):
+            if stream is not None:
+                try:
+                    stream.close()
+                except OSError:
+                    pass
+        self._client = None
+        self._send_file = None
+        self._recv_file = None
+        self.join_ok = False
 
-        """Sends a join message to connect and retrieve a token for the requested account."""
+    def _send_to_server(self, username=None, password=None, token=None, message=None, recipient=None, typ=None):
 
-        join_send = client.makefile('w')
-        join_recv = client.makefile('r')
+        """Writes a single request to the open session and returns the server's response as a dictionary."""
 
-        # print("client connected to {HOST} on {PORT}")
-        # print()
         if typ == "join":
             msg = dsp.get_joinmsg(username, password)
         elif typ == "send":
@@ -205,10 +446,29 @@ class DirectMessenger:
         else:
             msg = dsp.get_rtrmsg(token, typ)
 
-        join_send.write(msg + '\r\n')
-        join_send.flush()
-        srv_msg = join_recv.readline()
-        msg_dict = dsp.load_srvmsg(srv_msg)
+        self._write_request(msg)
+        return self._read_reply(typ)
+
+    def _write_request(self, msg: str) -> None:
+        """Writes one request line to the open session."""
+        self._send_file.write(msg + '\r\n')
+        self._send_file.flush()
+
+    def _read_reply(self, typ) -> dict:
+        """
+        Reads the server's reply to a request of type typ and returns it as a dictionary. A reply that cannot be
+        parsed or does not fit the request means that later replies would be matched to the wrong requests, so the
+        session is closed and ValueError is raised.
+        """
+        srv_msg = self._recv_file.readline()
+        if srv_msg == '':
+            raise ConnectionResetError("The DSP server closed the connection.")
+        try:
+            msg_dict = dsp.load_srvmsg(srv_msg)
+            dsp.check_reply(msg_dict, typ)
+        except ValueError:
+            self.close()
+            raise
         # print(srv_msg)
         dsp.print_rMessage(msg_dict)
 
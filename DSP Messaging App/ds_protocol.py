@@ -3,6 +3,7 @@
 # 93592684
 
 import json
+import re
 from collections import namedtuple
 import time
 
@@ -14,7 +15,9 @@ The ds_protocol module contains functions that support communication with the DS
 def get_sendmsg(token, message, recipient)->str:
     """Using the user token and message, returns a request following the correct protocol to communicate with the DSP
     server and request to send a direct message."""
-    sendmsg = f'{{"token":"{token}", "directmessage": {{"entry": "{message}","recipient":"{recipient}", "timestamp": "{time.time()}"}}}}'
+    # json.dumps escapes quotes and newlines in the message, so the request always stays one valid line
+    sendmsg = json.dumps({"token": token, "directmessage": {"entry": message, "recipient": recipient,
+                                                            "timestamp": str(time.time())}})
     #{"token":"{token}", "directmessage": {"entry": "Hello World!","recipient":"ohhimark", "timestamp":
     # "1603167689.3928561"}}
     return sendmsg
@@ -24,7 +27,7 @@ def get_sendmsg2(token, message, recipient)->str:
     Using the user token and message, returns a request following the correct protocol to communicate with the DSP
     server and request to send a direct message. ————— This version is only for the test_ program. DO NOT USE OR DELETE
     """
-    sendmsg = f'{{"token":"{token}", "directmessage": {{"entry": "{message}","recipient":"{recipient}"}}}}'
+    sendmsg = json.dumps({"token": token, "directmessage": {"entry": message, "recipient": recipient}})
     #{"token":"{token}", "directmessage": {"entry": "Hello World!","recipient":"ohhimark", "timestamp":
     # "1603167689.3928561"}}
     return sendmsg
@@ -42,7 +45,7 @@ def get_msg_dict(message, recipient)->dict:
 def get_rtrmsg(token, taip)->str:
     """Using the user token and type, returns a request following the correct protocol to communicate with the DSP
         server and request to retrieve messages sent to the user"""
-    rtrmsg = f'{{"token":"{token}", "directmessage": "{taip}"}}'
+    rtrmsg = json.dumps({"token": token, "directmessage": taip})
     #{"token":"{token}", "directmessage": "new"}
     return rtrmsg
 
@@ -50,7 +53,7 @@ def get_rtrmsg(token, taip)->str:
 def get_joinmsg(username, password)->str:
     """Using the username and password, returns a request following the correct protocol to communicate with the DSP
         server and request join and exchange data."""
-    joinmsg = f'{{"join": {{"username": "{username}","password": "{password}","token":""}}}}'
+    joinmsg = json.dumps({"join": {"username": username, "password": password, "token": ""}})
     return joinmsg
 
 
@@ -59,6 +62,125 @@ def load_srvmsg(srv_msg)->dict:
     return json.loads(srv_msg)
 
 
+_decoder = json.JSONDecoder()
+_whitespace = json.decoder.WHITESPACE
+_number_start = '-0123456789'
+_number_rest = re.compile(r'[0-9.eE+-]*')
+
+
+def stream_srvmsg(stream, response: dict, chunk_size: int = 65536):
+    """
+    Reads one response of the server (one line) from stream, a chunk of at most chunk_size characters at a time, and
+    yields the items of its "messages" list as dictionaries as soon as each one has been read. Only the current chunk
+    and the message being parsed are held at any time, however long the line is. The other fields of the response
+    ("type", "message", ...) are put into the response dictionary as they are read.
+
+    The line is read to its end once the last message has been yielded. Raises ConnectionResetError if the server
+    closes the connection first, and ValueError if the line is not a valid response.
+    """
+    buf = ''
+    pos = 0
+    ended = False  # the whole line has been read into buf
+
+    def fill():
+        nonlocal buf, pos, ended
+        if ended:
+            raise ValueError("The DSP server's response ended too soon.")
+        chunk = stream.readline(chunk_size)
+        if chunk == '':
+            raise ConnectionResetError("The DSP server closed the connection.")
+        ended = chunk.endswith('\n')
+        buf = buf[pos:] + chunk
+        pos = 0
+
+    def peek():
+        """skips whitespace and returns the next character"""
+        nonlocal pos
+        while True:
+            pos = _whitespace.match(buf, pos).end()
+            if pos < len(buf):
+                return buf[pos]
+            fill()
+
+    def expect(char):
+        nonlocal pos
+        if peek() != char:
+            raise ValueError(f"Expected {char!r} in the DSP server's response.")
+        pos += 1
+
+    def value():
+        """parses the JSON value that starts at pos, reading more of the line until it is complete"""
+        nonlocal pos
+        peek()
+        while True:
+            try:
+                obj, end = _decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                if ended:
+                    raise
+                fill()
+                continue
+            if not ended and buf[pos] in _number_start and _number_rest.fullmatch(buf, end):
+                # a number that runs up to the end of the chunk may go on in the next one, even if what was read
+                # so far stops early (e.g. at "12." or "1e", which raw_decode reads as 12 and 1)
+                fill()
+                continue
+            pos = end
+            return obj
+
+    def members():
+        """yields the keys of the object that starts at pos, leaving pos at each key's value"""
+        nonlocal pos
+        expect('{')
+        while peek() != '}':
+            if buf[pos] == ',':
+                pos += 1
+                continue
+            key = value()
+            expect(':')
+            yield key
+        pos += 1
+
+    for key in members():
+        if key != "response" or peek() != '{':
+            value()
+            continue
+        for field in members():
+            if field == "messages" and peek() == '[':
+                pos += 1
+                while peek() != ']':
+                    if buf[pos] == ',':
+                        pos += 1
+                        continue
+                    yield value()
+                pos += 1
+            else:
+                response[field] = value()
+    while not ended:
+        fill()
+
+
+def check_reply(msg_dict, typ) -> None:
+    """
+    Raises ValueError unless msg_dict is a reply the server could have sent to a request of type typ ("join", "send",
+    "new" or "all"). On a kept-open session a reply that does not fit its request means the replies no longer line up
+    with the requests, so the caller has to drop the session.
+    """
+    response = msg_dict.get("response") if isinstance(msg_dict, dict) else None
+    if not isinstance(response, dict) or "type" not in response:
+        raise ValueError("The DSP server's reply is not a response.")
+    if response["type"] != "ok":
+        return
+    if typ == "join":
+        fits = "token" in response
+    elif typ == "send":
+        fits = "message" in response and "messages" not in response
+    else:
+        fits = isinstance(response.get("messages"), list)
+    if not fits:
+        raise ValueError(f"The DSP server's reply does not match the {typ!r} request.")
+
+
 def get_token(msg_dict):
     """Extracts the token from the dictionary of the server's response to the join request and returns it."""
     return msg_dict["response"]["token"]
@@ -117,5 +239,5 @@ def isolatepost(post):
 def get_biomsg(token, bio)->str:
     """Using the user token and bio, returns a request following the correct protocol to communicate with the DSP
         server and request to add a new bio for the user, returning the server's response."""
-    biomsg = f'{{"token":"{token}", "bio": {{"entry": "{bio}","timestamp": "{time.time()}"}}}}'
+    biomsg = json.dumps({"token": token, "bio": {"entry": bio, "timestamp": str(time.time())}})
     return biomsg
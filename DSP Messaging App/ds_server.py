@@ -0,0 +1,243 @@
+import argparse
+import asyncio
+import json
+import random
+import threading
+import uuid
+
+"""
+The ds_server module contains a small local stand-in for the DSP server. It speaks the same newline-delimited JSON
+protocol as the class server (join, directmessage send, and "new"/"all" retrieval), so the messengers can be tried
+out and measured without a network connection.
+"""
+
+
+class DSPServer:
+    """
+    The DSPServer class is an asyncio server that keeps all of its accounts and messages in memory.
+
+    :param host: The address to listen on.
+
+    :param port: The port to listen on. The default of 0 picks a free port, which is stored in self.port once the
+     server has started.
+
+    :param latency: Seconds added before each response reaches the client, like a one-way network delay. Requests
+     that are pipelined on one connection overlap their delays, just as they would on a real link.
+
+    :param jitter: Each delay is drawn uniformly from latency +/- jitter (never below zero).
+
+    :param failure_rate: The chance (0 to 1) that a request is lost and its connection dropped without a reply.
+
+    :param reply_loss_rate: The chance (0 to 1) that a request is handled but its reply is lost, and the connection
+     dropped, e.g. a message that was delivered although the sender never hears about it.
+
+    :param seed: Seeds the random numbers behind jitter and failures so that runs can be repeated.
+
+    Joining with an unknown username creates the account, just like on the class server. The server counts the
+    connections, joins and requests it has handled in self.connections, self.joins and self.requests.
+
+    The server can run on the caller's event loop (start/close) or on its own loop in a background thread
+    (start_in_thread/stop_thread), which is what blocking clients such as DirectMessenger need.
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0, jitter=0.0, failure_rate=0.0, seed=None,
+                 reply_loss_rate=0.0):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.reply_loss_rate = reply_loss_rate
+        self._random = random.Random(seed)
+
+        self.connections = 0
+        self.joins = 0
+        self.requests = 0
+
+        self._passwords = {}  # username -> password
+        self._tokens = {}  # token -> username
+        self._inbox = {}  # username -> list of messages received by that user
+        self._unread = {}  # username -> index of the first message in the inbox not yet returned by "new"
+        self._server = None
+        self._handlers = set()  # tasks serving the open connections
+        self._loop = None
+        self._thread = None
+
+    async def start(self) -> None:
+        """Starts listening for connections."""
+        self._server = await asyncio.start_server(self._handle, self.host, self.port, backlog=1024)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def close(self) -> None:
+        """Stops the server and drops the connections that are still open."""
+        if self._server is not None:
+            self._server.close()
+            for handler in list(self._handlers):
+                handler.cancel()
+            await asyncio.gather(*self._handlers, return_exceptions=True)
+            await self._server.wait_closed()
+            self._server = None
+
+    def start_in_thread(self) -> int:
+        """Starts the server on its own event loop in a daemon thread and returns the port it listens on."""
+        self._loop = asyncio.new_event_loop()
+        started = threading.Event()
+        errors = []
+
+        def run():
+            asyncio.set_event_loop(self._loop)
+            try:
+                self._loop.run_until_complete(self.start())
+            except Exception as ex:
+                errors.append(ex)
+                return
+            finally:
+                started.set()
+            self._loop.run_forever()
+
+        self._thread = threading.Thread(target=run, name="DSPServer", daemon=True)
+        self._thread.start()
+        started.wait()
+        if errors:
+            raise errors[0]
+        return self.port
+
+    def stop_thread(self) -> None:
+        """Stops a server that was started with start_in_thread."""
+        if self._loop is None:
+            return
+        asyncio.run_coroutine_threadsafe(self.close(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+        self._loop = None
+        self._thread = None
+
+    async def _handle(self, reader, writer) -> None:
+        """
+        Reads the request lines of one connection and queues each response with the time it is due, while a second
+        task writes the responses out in order once they are due.
+        """
+        self.connections += 1
+        handler = asyncio.current_task()
+        self._handlers.add(handler)
+        loop = asyncio.get_running_loop()
+        outgoing = asyncio.Queue()
+        sender = asyncio.create_task(self._send_responses(writer, outgoing))
+        last_due = 0.0
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                last_due = max(last_due, loop.time() + self._delay())
+                if self.failure_rate and self._random.random() < self.failure_rate:
+                    # the request is lost and the connection goes down with it
+                    break
+                response = self.handle_request(line)
+                if self.reply_loss_rate and self._random.random() < self.reply_loss_rate:
+                    # the request went through, but the connection goes down before its reply
+                    break
+                await outgoing.put((last_due, response))
+            await outgoing.put((last_due, None))
+            await sender
+        except ConnectionError:
+            sender.cancel()
+        except asyncio.CancelledError:
+            sender.cancel()
+            writer.close()
+        finally:
+            self._handlers.discard(handler)
+
+    async def _send_responses(self, writer, outgoing) -> None:
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                due, response = await outgoing.get()
+                if due > loop.time():
+                    await asyncio.sleep(due - loop.time())
+                if response is None:
+                    break
+                writer.write((json.dumps(response) + '\r\n').encode())
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    def _delay(self) -> float:
+        if not self.latency and not self.jitter:
+            return 0.0
+        return max(0.0, self.latency + self._random.uniform(-self.jitter, self.jitter))
+
+    def handle_request(self, line) -> dict:
+        """Takes one request line and returns the server's response as a dictionary."""
+        try:
+            request = json.loads(line)
+        except json.JSONDecodeError:
+            return _error("Request was not valid JSON")
+
+        self.requests += 1
+        if "join" in request:
+            self.joins += 1
+            return self._join(request["join"])
+
+        username = self._tokens.get(request.get("token"))
+        if username is None:
+            return _error("Invalid user token")
+
+        directmessage = request.get("directmessage")
+        if isinstance(directmessage, dict):
+            recipient = directmessage.get("recipient")
+            self._inbox.setdefault(recipient, []).append(
+                {"message": directmessage.get("entry"), "from": username,
+                 "timestamp": directmessage.get("timestamp", "0")})
+            return {"response": {"type": "ok", "message": "Direct message sent"}}
+        elif directmessage == "new":
+            inbox = self._inbox.get(username, [])
+            messages = inbox[self._unread.get(username, 0):]
+            self._unread[username] = len(inbox)
+            return {"response": {"type": "ok", "messages": messages}}
+        elif directmessage == "all":
+            return {"response": {"type": "ok", "messages": list(self._inbox.get(username, []))}}
+
+        return _error("Unknown request")
+
+    def _join(self, join) -> dict:
+        username = join.get("username")
+        password = join.get("password")
+        if self._passwords.setdefault(username, password) != password:
+            return _error("Invalid password or username already taken")
+
+        token = uuid.uuid4().hex
+        self._tokens[token] = username
+        return {"response": {"type": "ok", "message": f"Welcome back, {username}", "token": token}}
+
+
+def _error(message) -> dict:
+    return {"response": {"type": "error", "message": message}}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Runs a local stand-in for the DSP server.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=3021)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every response")
+    parser.add_argument("--jitter", type=float, default=0.0, help="random +/- seconds added to the latency")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="chance that a request drops its connection")
+    parser.add_argument("--reply-loss-rate", type=float, default=0.0,
+                        help="chance that a request is handled but its reply is lost with the connection")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    async def main():
+        server = DSPServer(args.host, args.port, args.latency, args.jitter, args.failure_rate, args.seed,
+                           args.reply_loss_rate)
+        await server.start()
+        print(f"DSP server listening on {server.host}:{server.port}")
+        await server._server.serve_forever()
+
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
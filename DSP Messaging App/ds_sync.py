@@ -0,0 +1,487 @@
+import json
+import os
+import queue
+import random
+import threading
+import time
+from pathlib import Path
+
+from ds_messenger import DirectMessage, DirectMessenger
+from Profile import DsuFileError, DsuProfileError, profile_cache, profile_persister
+
+"""
+The ds_sync module contains SyncWorker, which keeps a profile in sync with the DSP server from a background thread,
+and Outbox, which sends messages from one, so that a slow or unreachable server never blocks the thread that runs the
+GUI. How often the SyncWorker polls is up to its poll policy: FixedPoll or AdaptivePoll.
+"""
+
+
+def outbox_path(path) -> Path:
+    """
+    returns the path of the file that holds the unsent messages of the DSU file at path
+    """
+    p = Path(path)
+    return p.with_name(p.name + '.outbox')
+
+
+class FixedPoll:
+    """
+    The FixedPoll class is the poll policy that waits the same `interval` seconds after every poll.
+
+    A poll policy tells a SyncWorker how long to wait before its next poll. It has two methods, which the worker
+    calls from its own thread and from the GUI's respectively:
+
+    next_interval(received) is called after each poll with the number of messages it added (0 if it failed), and
+    returns the seconds to wait until the next one.
+
+    activity() is called when the user does something (opens a chat, types, sends). It returns how many seconds
+    after the last poll the next one should happen at the latest, or None to leave the schedule as it is.
+    """
+
+    def __init__(self, interval: float = 1.0):
+        self.interval = interval
+
+    def next_interval(self, received: int) -> float:
+        return self.interval
+
+    def activity(self):
+        return None
+
+
+class AdaptivePoll:
+    """
+    The AdaptivePoll class is the poll policy that polls every `min_interval` seconds while a chat is going on, and
+    backs off when it is not: after each poll that brought nothing the wait grows by `backoff` times, up to
+    `max_interval`. A poll that brings messages, or activity of the user, goes back to `min_interval`. The default
+    `min_interval` is the 1 second the GUI always polled at, so an active chat is never polled more often than before.
+
+    Every wait is spread by up to +/- `jitter` (a fraction of it) at random, so that clients that started together
+    do not keep polling the server at the same moments.
+    """
+
+    def __init__(self, min_interval: float = 1.0, max_interval: float = 15.0, backoff: float = 2.0,
+                 jitter: float = 0.1, seed=None):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.jitter = jitter
+        self._interval = min_interval
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def next_interval(self, received: int) -> float:
+        with self._lock:
+            if received:
+                self._interval = self.min_interval
+            interval = self._interval
+            if not received:
+                self._interval = min(interval * self.backoff, self.max_interval)
+        return self._spread(interval)
+
+    def activity(self):
+        with self._lock:
+            self._interval = self.min_interval
+        return self.min_interval
+
+    def _spread(self, interval: float) -> float:
+        return interval * self._random.uniform(1 - self.jitter, 1 + self.jitter)
+
+
+class SyncWorker:
+    """
+    The SyncWorker class polls the server for new messages on its own thread, as often as its poll policy says (see
+    FixedPoll), and merges them into the profile stored at `path` (the one the ProfileCache hands out for it). The changes are saved through
+    the ProfilePersister, and every message that was added is put on a queue for the GUI, which takes them off with
+    drain.
+
+    The worker has its own DirectMessenger, and so its own session with the server, which no other thread uses.
+
+    :param path: The DSU file of the profile to keep in sync.
+
+    :param cache: The ProfileCache the profile is taken from.
+
+    :param persister: The ProfilePersister that saves the changes.
+
+    :param policy: The poll policy, an AdaptivePoll if not given.
+
+    :param dsuserver: The ip address of the DSP server.
+
+    :param port: The port where the DSP server is accepting connections.
+
+    The queue holds (kind, value) pairs: ('message', message) for each message that was added, and ('error', text)
+    when a poll failed, e.g. because the server could not be reached or did not accept the username and password.
+    """
+
+    def __init__(self, path, cache=profile_cache, persister=profile_persister, policy=None,
+                 dsuserver="168.235.86.101", port=3021):
+        self.path = path
+        self.cache = cache
+        self.persister = persister
+        self.policy = policy if policy is not None else AdaptivePoll()
+        self.dsuserver = dsuserver
+        self.port = port
+        self.polls = 0  # polls that reached the server
+        self.updates = queue.Queue()
+        self._messenger = None
+        self._stopped = threading.Event()
+        self._wake = threading.Event()
+        self._thread = None
+
+        # when the last poll ended and when the next one is due (time.monotonic()), see activity
+        self._lock = threading.Lock()
+        self._last_poll = time.monotonic()
+        self._next_poll = self._last_poll
+
+        # see metrics
+        self._started = time.monotonic()
+        self._empty_polls = 0
+        self._errors = 0
+        self._messages = 0
+        self._waited = 0.0
+        self._delay_total = 0.0
+        self._delay_max = 0.0
+
+    def start(self) -> None:
+        """starts polling, if the worker is not running yet"""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="SyncWorker", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout: float = 1.0) -> None:
+        """
+        stops polling. Waits up to `timeout` seconds for a poll that is under way; one that takes longer is left to
+        finish on its own, and what it merges is still saved.
+        """
+        self._stopped.set()
+        self._wake.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(timeout)
+
+    def activity(self) -> None:
+        """
+        tells the worker that the user did something, so that the poll policy can move the next poll closer
+        """
+        delay = self.policy.activity()
+        if delay is None:
+            return
+        with self._lock:
+            due = self._last_poll + delay
+            if due >= self._next_poll:
+                return
+            self._next_poll = due
+        self._wake.set()
+
+    def metrics(self) -> dict:
+        """
+        returns counts that show what polling costs and brings: polls that reached the server, how many of them
+        brought nothing, failed polls, messages added, polls per minute, the average wait between polls, and the
+        average and longest time from a message being sent (its timestamp) to it being added
+        """
+        attempts = self.polls + self._errors
+        minutes = max(time.monotonic() - self._started, 1e-9) / 60
+        return {"polls": self.polls, "empty_polls": self._empty_polls, "errors": self._errors,
+                "messages": self._messages, "polls_per_minute": attempts / minutes,
+                "mean_interval": self._waited / attempts if attempts else 0.0,
+                "mean_delivery_seconds": self._delay_total / self._messages if self._messages else 0.0,
+                "max_delivery_seconds": self._delay_max}
+
+    def drain(self, limit: int) -> list:
+        """returns up to `limit` of the queued (kind, value) pairs, oldest first, without waiting for more"""
+        items = []
+        while len(items) < limit:
+            try:
+                items.append(self.updates.get_nowait())
+            except queue.Empty:
+                break
+        return items
+
+    def pending(self) -> bool:
+        """returns True if there are queued updates"""
+        return not self.updates.empty()
+
+    def poll(self) -> list:
+        """
+        syncs the profile with the server once, on the calling thread, and returns the messages that were added
+
+        Raises DsuProfileError, DsuFileError, OSError, ValueError
+        """
+        profile = self.cache.get(self.path)
+        messenger = self._messenger
+        if messenger is None or messenger.username != profile.username or messenger.password != profile.password:
+            if messenger is not None:
+                messenger.close()
+            messenger = DirectMessenger(self.dsuserver, profile.username, profile.password, self.port)
+            self._messenger = messenger
+
+        joins = messenger.joins
+        added = messenger.sync(profile)
+        if not messenger.join_ok:
+            self._errors += 1
+            if messenger.joins > joins:
+                self.updates.put(('error', f"The server did not accept the username and password of "
+                                           f"{profile.username}"))
+            else:
+                self.updates.put(('error', "Unable to connect to the server"))
+            return added
+        # the cache may have loaded the file again while the server was answering, e.g. because another program
+        # changed it, and what was merged into the profile it replaced would never be saved
+        self.cache.apply(self.path, lambda current: self._carry(profile, current, added))
+        self.polls += 1
+        if added:
+            self.persister.mark_dirty(self.path)
+        else:
+            self._empty_polls += 1
+        now = time.time()
+        for message in added:
+            delay = max(0.0, now - message['timestamp'])
+            self._delay_total += delay
+            self._delay_max = max(self._delay_max, delay)
+        self._messages += len(added)
+        for message in added:
+            self.updates.put(('message', message))
+        return added
+
+    @staticmethod
+    def _carry(synced, profile, added) -> None:
+        """merges the messages a sync added to the profile synced into profile, if that is a different one"""
+        if profile is synced:
+            return
+        for message in added:
+            profile.add_msg(message)
+            profile.update_sync_cursor(message['from'], message['timestamp'])
+        profile.set_last_sync(max(profile.get_last_sync(), synced.get_last_sync()))
+
+    def _run(self) -> None:
+        try:
+            while not self._stopped.is_set():
+                received = 0
+                try:
+                    received = len(self.poll())
+                except (DsuFileError, DsuProfileError, OSError, ValueError) as ex:
+                    self._errors += 1
+                    self.updates.put(('error', f"Unable to sync with the server: {ex}"))
+
+                interval = self.policy.next_interval(received)
+                with self._lock:
+                    self._last_poll = time.monotonic()
+                    self._next_poll = self._last_poll + interval
+                # activity may move the next poll closer while waiting
+                while not self._stopped.is_set():
+                    with self._lock:
+                        remaining = self._next_poll - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._wake.wait(remaining)
+                    self._wake.clear()
+                with self._lock:
+                    self._waited += time.monotonic() - self._last_poll
+        finally:
+            if self._messenger is not None:
+                self._messenger.close()
+
+
+class Outbox:
+    """
+    The Outbox class queues messages to send and sends them from a background thread, so that sending never waits
+    for the server. Whatever has queued up since the last send (a burst of quick sends, or everything that piled up
+    while the server was away) goes out together with DirectMessenger.send_many, over one session that is kept open.
+
+    Each message is an entry with a status: 'pending' until the server answers, then 'sent' or 'failed'. A sent
+    message is added to the profile at `path` (with the time it was queued) and saved through the ProfilePersister.
+    The pending entries are kept in the outbox file next to the DSU file (see outbox_path), so a message that was
+    not sent yet is sent after a restart. Every change of status is put on a queue for the GUI, which takes them off
+    with drain.
+
+    :param path: The DSU file of the profile that sends the messages.
+
+    :param cache: The ProfileCache the profile is taken from.
+
+    :param persister: The ProfilePersister that saves the sent messages.
+
+    :param retry_interval: Seconds to wait before trying again when the server could not be reached.
+
+    :param dsuserver: The ip address of the DSP server.
+
+    :param port: The port where the DSP server is accepting connections.
+
+    A message the server refuses is failed and dropped from the outbox file. So is one that was written to the server
+    but got no answer because the connection broke, since the server may have handled it anyway: no message is ever
+    sent twice. Messages that were never written, because the server could not be reached, stay pending and are sent
+    once it can be.
+    """
+
+    def __init__(self, path, cache=profile_cache, persister=profile_persister, retry_interval: float = 5.0,
+                 dsuserver="168.235.86.101", port=3021):
+        self.path = path
+        self.cache = cache
+        self.persister = persister
+        self.retry_interval = retry_interval
+        self.dsuserver = dsuserver
+        self.port = port
+        self.batches = 0  # send_many calls made
+        self.updates = queue.Queue()
+        self._entries = []  # pending and failed entries, oldest first
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+        self._messenger = None
+        self._thread = None
+        self._next_id = 0
+        self._saved = None  # the pending entries as last written to the outbox file
+
+        file = outbox_path(path)
+        if file.exists():
+            try:
+                with open(file) as f:
+                    self._entries = json.load(f)
+            except (OSError, ValueError) as ex:
+                raise DsuFileError("An error occurred while attempting to load the outbox.", ex)
+            self._saved = list(self._entries)
+            self._next_id = max((entry['id'] for entry in self._entries), default=-1) + 1
+
+    def start(self) -> None:
+        """starts the sending thread, if it is not running yet"""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="Outbox", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout: float = 1.0) -> None:
+        """
+        stops the sending thread, waiting up to `timeout` seconds for a send that is under way. Messages that were
+        not sent stay in the outbox file.
+        """
+        self._stopped.set()
+        self._wake.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(timeout)
+
+    def send(self, message: str, recipient: str) -> dict:
+        """queues message to be sent to recipient and returns its entry, without waiting for anything"""
+        with self._lock:
+            entry = {'id': self._next_id, 'message': message, 'recipient': recipient, 'timestamp': time.time(),
+                     'status': 'pending'}
+            self._next_id += 1
+            self._entries.append(entry)
+        self.updates.put(dict(entry))
+        self._wake.set()
+        return entry
+
+    def entries(self, recipient: str = None) -> list:
+        """returns copies of the pending and failed entries (only those to recipient, if given), oldest first"""
+        with self._lock:
+            return [dict(entry) for entry in self._entries if recipient is None or entry['recipient'] == recipient]
+
+    def drain(self, limit: int) -> list:
+        """returns up to `limit` of the queued entries whose status changed, oldest first, without waiting for more"""
+        items = []
+        while len(items) < limit:
+            try:
+                items.append(self.updates.get_nowait())
+            except queue.Empty:
+                break
+        return items
+
+    def pending(self) -> bool:
+        """returns True if there are queued changes of status"""
+        return not self.updates.empty()
+
+    def flush(self) -> bool:
+        """
+        sends the pending messages once, on the calling thread, and returns True if the server could be reached
+
+        Raises DsuProfileError, DsuFileError
+        """
+        with self._lock:
+            batch = [entry for entry in self._entries if entry['status'] == 'pending']
+        self._save()
+        if not batch:
+            return True
+
+        profile = self.cache.get(self.path)
+        messenger = self._messenger
+        if messenger is None or messenger.username != profile.username or messenger.password != profile.password:
+            if messenger is not None:
+                messenger.close()
+            messenger = DirectMessenger(self.dsuserver, profile.username, profile.password, self.port)
+            self._messenger = messenger
+
+        try:
+            results = messenger.send_many([(entry['message'], entry['recipient']) for entry in batch])
+            written = messenger.written
+        except OSError:
+            # the server could not be reached; send_many has closed the session
+            results = [False] * len(batch)
+            written = 0
+        self.batches += 1
+        # the messenger's own record of what it sent would only grow; the sent entries go into the profile instead
+        messenger.sent_messages.clear()
+        # without a session the messages that were not written are tried again later
+        reached = messenger.join_ok
+
+        sent = [entry for entry, result in zip(batch, results) if result]
+        if sent:
+            def add_sent(current):
+                for entry in sent:
+                    current.add_msg(DirectMessage(entry['message'], entry['timestamp'], entry['recipient'],
+                                                  current.username))
+
+            # taken from the cache again, as it may have loaded the file again while the batch was being sent
+            self.cache.apply(self.path, add_sent)
+
+        changed = []
+        with self._lock:
+            for i, (entry, result) in enumerate(zip(batch, results)):
+                if result:
+                    entry['status'] = 'sent'
+                    self._entries.remove(entry)
+                elif reached or i < written:
+                    entry['status'] = 'failed'
+                else:
+                    continue
+                changed.append(dict(entry))
+        if sent:
+            self.persister.mark_dirty(self.path)
+        self._save()
+        for entry in changed:
+            self.updates.put(entry)
+        return reached
+
+    def _save(self) -> None:
+        """writes the pending entries to the outbox file, if they changed since the last write"""
+        with self._lock:
+            pending = [dict(entry) for entry in self._entries if entry['status'] == 'pending']
+        if pending == self._saved:
+            return
+        file = outbox_path(self.path)
+        try:
+            if pending:
+                temp = file.with_name(file.name + '.tmp')
+                with open(temp, 'w') as f:
+                    json.dump(pending, f)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(temp, file)
+            elif file.exists():
+                os.remove(file)
+        except OSError as ex:
+            raise DsuFileError("An error occurred while attempting to save the outbox.", ex)
+        self._saved = pending
+
+    def _run(self) -> None:
+        try:
+            while not self._stopped.is_set():
+                self._wake.clear()
+                try:
+                    reached = self.flush()
+                except (DsuFileError, DsuProfileError) as ex:
+                    print("Unable to send the outbox:", ex)
+                    reached = False
+                with self._lock:
+                    waiting = any(entry['status'] == 'pending' for entry in self._entries)
+                # messages queued during the send go out right away; if the server was away, after a while
+                if waiting and reached:
+                    continue
+                self._wake.wait(self.retry_interval if waiting else None)
+        finally:
+            if self._messenger is not None:
+                self._messenger.close()
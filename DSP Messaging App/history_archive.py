@@ -0,0 +1,238 @@
+import json
+import os
+import sys
+import zlib
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from pathlib import Path
+
+from message_store import MessageStore
+
+"""
+The history_archive module contains HistoryArchive, which keeps the older messages of a profile out of the DSU file
+in immutable, zlib-compressed segment files, one chat per segment, together with a small index of the time range
+each segment covers. A Profile only decompresses a segment when a query (or a message it has to check for
+duplicates) reaches back into its time range. archive_profile moves old messages into the archive.
+"""
+
+
+def archive_path(path) -> Path:
+    """
+    returns the path of the directory that holds the archived history of the DSU file at path
+    """
+    p = Path(path)
+    return p.with_name(p.name + '.archive')
+
+
+class _Segment:
+    """
+    The messages of one segment file, decompressed into a MessageStore that shares its username table with the
+    profile, so they can be handed out as the same MessageView objects as the profile's own messages.
+    """
+
+    def __init__(self, names, messages):
+        self.store = MessageStore(names)
+        for frm, recipient, timestamp, message in messages:
+            self.store.append_fields(frm, recipient, timestamp, message)
+        self.times = self.store._timestamps
+
+    def has(self, key: tuple) -> bool:
+        timestamp = key[2]
+        for row in range(bisect_left(self.times, timestamp), bisect_right(self.times, timestamp)):
+            if self.store.row(row) == key:
+                return True
+        return False
+
+
+class HistoryArchive:
+    """
+    The HistoryArchive class reads and writes the archive directory of one DSU file. The directory holds the segment
+    files and index.json, which lists every segment with the chat it belongs to, the timestamps of its first and last
+    message and its number of messages. Segments are never changed once written; archiving more messages adds new
+    ones.
+
+    :param path: The archive directory (see archive_path).
+
+    :param names: The username table the messages of decompressed segments are interned in, normally the
+     ContactTable of the profile.
+
+    The last `cache_size` segments that were decompressed are kept in memory.
+    """
+
+    cache_size = 8
+
+    def __init__(self, path, names=None):
+        self.path = Path(os.path.abspath(path))
+        self._names = names
+        self._segments = {}  # username -> list of index entries, sorted by the timestamp of their last message
+        self._next = 1
+        self._cache = OrderedDict()  # file name -> _Segment
+
+        try:
+            with open(self.path / 'index.json', 'r') as f:
+                index = json.load(f)
+        except FileNotFoundError:
+            return
+        for entry in index['segments']:
+            self._segments.setdefault(entry['peer'], []).append(entry)
+        for entries in self._segments.values():
+            entries.sort(key=lambda entry: entry['end'])
+        self._next = index.get('next', 1)
+
+    def peers(self) -> list:
+        return list(self._segments)
+
+    def count(self, username) -> int:
+        """returns how many messages of the chat with username are archived"""
+        return sum(entry['count'] for entry in self._segments.get(username, ()))
+
+    def segments(self, username) -> list:
+        """returns the index entries of the chat with username, oldest first"""
+        return list(self._segments.get(username, ()))
+
+    def disk_bytes(self) -> int:
+        """returns the size of the archive directory's files"""
+        if not self.path.exists():
+            return 0
+        return sum(entry.stat().st_size for entry in os.scandir(self.path) if entry.is_file())
+
+    def messages(self, username, since: float = None, until: float = None, limit: int = None, newer=()) -> list:
+        """
+        returns the archived messages of the chat with username (with since <= timestamp < until) as MessageViews,
+        sorted by timestamp. Only segments whose time range overlaps the query are decompressed.
+
+        With a limit, only the latest `limit` messages of the range are needed, counting the messages in `newer`
+        (the timestamps of messages of the range the caller already has, sorted). Older segments are then only
+        decompressed while there are fewer than `limit` messages newer than them.
+        """
+        newer = list(newer)
+        found = []
+        for entry in reversed(self._segments.get(username, ())):
+            if since is not None and entry['end'] < since:
+                continue
+            if until is not None and entry['start'] >= until:
+                continue
+            if limit is not None:
+                # everything in this segment and the ones left is at or before entry['end']
+                if len(newer) - bisect_right(newer, entry['end']) >= limit:
+                    break
+            segment = self._load(entry)
+            start = 0 if since is None else bisect_left(segment.times, since)
+            end = len(segment.times) if until is None else bisect_left(segment.times, until)
+            for row in range(start, end):
+                found.append(segment.store[row])
+            if limit is not None:
+                newer = sorted(newer + list(segment.times[start:end]))
+        found.sort(key=lambda message: message['timestamp'])
+        return found
+
+    def has(self, username, key: tuple) -> bool:
+        """returns True if the message with the given message_key is archived in the chat with username"""
+        timestamp = key[2]
+        for entry in self._segments.get(username, ()):
+            if entry['start'] <= timestamp <= entry['end'] and self._load(entry).has(key):
+                return True
+        return False
+
+    def rows(self, username):
+        """
+        yields the archived messages of the chat with username as (from, recipient, timestamp, message) lists, one
+        segment at a time and oldest segment first. Unlike messages, it does not keep the segments it reads, so a
+        whole chat can be streamed through without holding more than one segment.
+        """
+        for entry in self._segments.get(username, ()):
+            with open(self.path / entry['file'], 'rb') as f:
+                yield from json.loads(zlib.decompress(f.read()))
+
+    def _load(self, entry) -> _Segment:
+        segment = self._cache.get(entry['file'])
+        if segment is not None:
+            self._cache.move_to_end(entry['file'])
+            return segment
+
+        with open(self.path / entry['file'], 'rb') as f:
+            messages = json.loads(zlib.decompress(f.read()))
+        segment = self._cache[entry['file']] = _Segment(self._names, messages)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return segment
+
+    def add_segment(self, username, messages: list) -> dict:
+        """
+        writes a new segment file with messages, a list of (from, recipient, timestamp, message) tuples of the chat
+        with username sorted by timestamp, and returns its index entry. The index itself is written by save_index.
+        """
+        self.path.mkdir(exist_ok=True)
+        name = f'{self._next:06d}.seg'
+        self._next += 1
+        data = zlib.compress(json.dumps([list(message) for message in messages]).encode(), 6)
+        with open(self.path / name, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+
+        entry = {'file': name, 'peer': username, 'start': messages[0][2], 'end': messages[-1][2],
+                 'count': len(messages), 'bytes': len(data)}
+        entries = self._segments.setdefault(username, [])
+        entries.append(entry)
+        entries.sort(key=lambda item: item['end'])
+        return entry
+
+    def save_index(self) -> None:
+        """writes index.json, replacing the old one in a single step"""
+        self.path.mkdir(exist_ok=True)
+        segments = [entry for entries in self._segments.values() for entry in entries]
+        temp = self.path / 'index.json.tmp'
+        with open(temp, 'w') as f:
+            json.dump({'next': self._next, 'segments': segments}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp, self.path / 'index.json')
+
+
+def archive_profile(path, keep: int = 1000, segment_messages: int = 10000) -> dict:
+    """
+    moves all but the latest `keep` messages of every chat of the DSU file at path into its archive, in segments of
+    at most `segment_messages` messages, and rewrites the DSU file with just the rest. Returns a report of what was
+    archived and the disk space and (estimated) memory it saves.
+
+    Raises DsuProfileError, DsuFileError
+    """
+    from Profile import Profile, _file_lock, chat_index_path, journal_path
+
+    p = Path(path)
+    with _file_lock(p):
+        profile = Profile()
+        profile.load_profile(p)
+        archive = profile._archive
+        if archive is None:
+            archive = HistoryArchive(archive_path(p), profile._users)
+
+        files = [p, journal_path(p), chat_index_path(p)]
+        disk_before = sum(os.path.getsize(f) for f in files if f.exists()) + archive.disk_bytes()
+
+        archived = segments = memory = 0
+        kept = []
+        for peer, rows in profile._chats.items():
+            old = rows[:max(0, len(rows) - keep)]
+            kept.extend(rows[len(old):])
+            for start in range(0, len(old), segment_messages):
+                messages = [profile._messages.row(row) for row in old[start:start + segment_messages]]
+                archive.add_segment(peer, messages)
+                segments += 1
+                archived += len(messages)
+                # three 8 byte columns, the list slot, the chat index entries and the text object
+                memory += sum(48 + sys.getsizeof(message[3]) for message in messages)
+        if not archived:
+            return {'messages_archived': 0, 'segments_written': 0, 'disk_bytes_before': disk_before,
+                    'disk_bytes_after': disk_before, 'disk_bytes_saved': 0, 'memory_bytes_saved': 0}
+        archive.save_index()
+
+        profile._drop_messages(kept)
+        profile._archive = archive
+        profile._write_snapshot(p)
+
+        disk_after = sum(os.path.getsize(f) for f in files if f.exists()) + archive.disk_bytes()
+        return {'messages_archived': archived, 'segments_written': segments, 'disk_bytes_before': disk_before,
+                'disk_bytes_after': disk_after, 'disk_bytes_saved': disk_before - disk_after,
+                'memory_bytes_saved': memory}
@@ -0,0 +1,185 @@
+from array import array
+from collections.abc import Mapping
+
+"""
+The message_store module contains MessageStore, a compact, column-oriented container for direct messages. Instead of
+one dictionary object per message, it keeps one array per field: timestamps as doubles, senders and recipients as
+small integer ids into a table of usernames, and the message texts in a list. Messages are read back through
+MessageView objects, which behave like the dictionaries the rest of the program expects.
+"""
+
+
+class MessageView(Mapping):
+    """
+    A read-only, dictionary-like view of one message in a MessageStore. It has the same keys as a serialized
+    DirectMessage ('timestamp', 'message', 'recipient', 'from' and 'frm'), so code written for DirectMessage dicts
+    can read it unchanged. dict(view) makes a real dictionary, e.g. for json.
+    """
+
+    __slots__ = ('_store', '_row')
+
+    _KEYS = ('timestamp', 'message', 'recipient', 'from', 'frm')
+
+    def __init__(self, store, row: int):
+        self._store = store
+        self._row = row
+
+    def __getitem__(self, key):
+        store = self._store
+        row = self._row
+        if key == 'timestamp':
+            return store._timestamps[row]
+        elif key == 'message':
+            return store._bodies[row]
+        elif key == 'recipient':
+            return store.name(store._recipients[row])
+        elif key == 'from' or key == 'frm':
+            return store.name(store._senders[row])
+        raise KeyError(key)
+
+    def __iter__(self):
+        return iter(self._KEYS)
+
+    def __len__(self):
+        return len(self._KEYS)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+    def get_message(self):
+        return self['message']
+
+    def get_time(self):
+        return self['timestamp']
+
+
+class MessageStore:
+    """
+    The MessageStore class holds messages in parallel arrays and hands them out as MessageView objects by row
+    number. It supports len(), indexing (including slices), iteration and append, so it can stand in for a list of
+    message dictionaries.
+
+    :param names: An optional username table shared with the owner of the store. It needs an `intern(name) -> int`
+     method and a `name(id) -> str` method. By default the store keeps its own.
+    """
+
+    def __init__(self, names=None):
+        self._timestamps = array('d')
+        self._senders = array('l')
+        self._recipients = array('l')
+        self._bodies = []
+        self._names = names if names is not None else NameTable()
+
+    def append(self, message) -> int:
+        """adds a message (any mapping with the DirectMessage keys) and returns its row number"""
+        return self.append_fields(message['from'], message['recipient'], message['timestamp'], message['message'])
+
+    def append_fields(self, frm, recipient, timestamp, message) -> int:
+        """adds a message given its fields and returns its row number"""
+        self._timestamps.append(float(timestamp))
+        self._senders.append(self._names.intern(frm))
+        self._recipients.append(self._names.intern(recipient))
+        self._bodies.append(message)
+        return len(self._bodies) - 1
+
+    def row(self, row: int) -> tuple:
+        """returns (from, recipient, timestamp, message) for a row"""
+        return (self.name(self._senders[row]), self.name(self._recipients[row]), self._timestamps[row],
+                self._bodies[row])
+
+    def timestamp(self, row: int) -> float:
+        return self._timestamps[row]
+
+    def name(self, name_id: int):
+        return self._names.name(name_id)
+
+    def __len__(self):
+        return len(self._bodies)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [MessageView(self, row) for row in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("message index out of range")
+        return MessageView(self, index)
+
+    def __iter__(self):
+        for row in range(len(self)):
+            yield MessageView(self, row)
+
+
+class NameTable:
+    """
+    Interns usernames: every distinct name is stored once and referred to by a small integer id, handed out in
+    insertion order.
+    """
+
+    def __init__(self):
+        self._ids = {}
+        self._names = []
+
+    def intern(self, name) -> int:
+        name_id = self._ids.get(name)
+        if name_id is None:
+            name_id = self._ids[name] = len(self._names)
+            self._names.append(name)
+        return name_id
+
+    def name(self, name_id: int):
+        return self._names[name_id]
+
+
+class ContactTable(NameTable):
+    """
+    The ContactTable class is the NameTable of a profile. Every username the profile comes across is interned to a
+    small integer id, and the ones the user has chats with are kept as the contact list, in the order they were
+    added. The contact list behaves like a list of usernames (iteration, len, indexing, `in`, append), with O(1)
+    membership tests.
+    """
+
+    def __init__(self, usernames=()):
+        NameTable.__init__(self)
+        self._contacts = []  # ids of the contacts, in the order they were added
+        self._contact_ids = set()
+        for username in usernames:
+            self.append(username)
+
+    def append(self, username) -> None:
+        """adds username to the contact list, if it is not on it yet"""
+        name_id = self.intern(username)
+        if name_id not in self._contact_ids:
+            self._contact_ids.add(name_id)
+            self._contacts.append(name_id)
+
+    def id(self, username):
+        """returns the id of username, or None if the table has never seen it"""
+        return self._ids.get(username)
+
+    def index(self, username) -> int:
+        """returns the position of username in the contact list"""
+        if username not in self:
+            raise ValueError(f"{username!r} is not a contact")
+        return self._contacts.index(self._ids[username])
+
+    def __contains__(self, username):
+        return self._ids.get(username) in self._contact_ids
+
+    def __iter__(self):
+        for name_id in self._contacts:
+            yield self._names[name_id]
+
+    def __len__(self):
+        return len(self._contacts)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self._names[name_id] for name_id in self._contacts[index]]
+        return self._names[self._contacts[index]]
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __repr__(self):
+        return repr(list(self))
@@ -0,0 +1,221 @@
+from bisect import bisect_left, insort
+
+"""
+The post_timeline module contains PostTimeline, the container a Profile keeps its posts in. Posts are kept sorted by
+timestamp in a list of small sorted buckets, so that finding, adding and removing a post costs a binary search over
+the buckets plus a binary search and a short shift inside one bucket, no matter how many posts there are. Finding a
+post by its position walks a Fenwick tree of the bucket sizes, which is just as cheap.
+"""
+
+
+class PostTimeline:
+    """
+    The PostTimeline class keeps posts (anything with a timestamp attribute) in timestamp order. Posts with the same
+    timestamp stay in the order they were added. Every post that is added is given an id, unique within the
+    timeline, which is stored on the post (post.id, if the post has such an attribute) and returned by add.
+
+    Iteration, len() and indexing (including negative indexes and slices) work like they would on a sorted list of
+    the posts.
+    """
+
+    # the size buckets are split in half at, twice the size they are built with
+    load = 512
+
+    def __init__(self, posts=()):
+        # Lists of (timestamp, id, post), sorted. Ids are unique, so entries never compare their posts, and a
+        # (timestamp, id) key sorts right before its own entry.
+        self._buckets = []
+        self._maxes = []  # (timestamp, id) of the last entry of each bucket
+        # Fenwick tree of the bucket sizes, for finding a position: _sizes[i] is the size of buckets i - (i & -i) up
+        # to i - 1. None until a position is looked up, and again whenever buckets are split, merged or dropped.
+        self._sizes = None
+        self._times = {}  # id -> timestamp
+        self._next_id = 1
+        self.extend(posts)
+
+    def __len__(self):
+        return len(self._times)
+
+    def __iter__(self):
+        for bucket in self._buckets:
+            for entry in bucket:
+                yield entry[2]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return list(self)[index]
+        bucket, position = self._locate(index)
+        return self._buckets[bucket][position][2]
+
+    def __repr__(self):
+        return repr(list(self))
+
+    def _new_entry(self, post) -> tuple:
+        post_id = self._next_id
+        self._next_id += 1
+        timestamp = float(post.timestamp)
+        self._times[post_id] = timestamp
+        if hasattr(post, '_id'):
+            post._id = post_id
+        return timestamp, post_id, post
+
+    def add(self, post) -> int:
+        """adds post in its place in the timeline and returns its id"""
+        entry = self._new_entry(post)
+        self._insert(entry)
+        return entry[1]
+
+    def extend(self, posts) -> list:
+        """
+        adds many posts, in any order, and returns their ids. A batch that is big compared to the timeline is sorted
+        once and the buckets are rebuilt, instead of inserting its posts one at a time.
+        """
+        entries = [self._new_entry(post) for post in posts]
+        if len(entries) > len(self._times) // 8 or len(entries) > self.load:
+            merged = [entry for bucket in self._buckets for entry in bucket]
+            merged.extend(entries)
+            merged.sort(key=lambda entry: entry[:2])
+            self._buckets = [merged[i:i + self.load] for i in range(0, len(merged), self.load)]
+            self._maxes = [bucket[-1][:2] for bucket in self._buckets]
+            self._sizes = None
+        else:
+            for entry in entries:
+                self._insert(entry)
+        return [entry[1] for entry in entries]
+
+    def _insert(self, entry) -> None:
+        key = entry[:2]
+        if not self._buckets:
+            self._buckets.append([entry])
+            self._maxes.append(key)
+            self._sizes = None
+            return
+
+        i = bisect_left(self._maxes, key)
+        if i == len(self._maxes):
+            # newer than everything, the usual case
+            i -= 1
+            self._buckets[i].append(entry)
+            self._maxes[i] = key
+        else:
+            insort(self._buckets[i], entry)
+
+        bucket = self._buckets[i]
+        if len(bucket) > 2 * self.load:
+            half = len(bucket) // 2
+            self._buckets[i:i + 1] = [bucket[:half], bucket[half:]]
+            self._maxes[i:i + 1] = [bucket[half - 1][:2], bucket[-1][:2]]
+            self._sizes = None
+        else:
+            self._resize(i, 1)
+
+    def _resize(self, bucket_index: int, delta: int) -> None:
+        """records that the size of a bucket changed by delta"""
+        sizes = self._sizes
+        if sizes is None:
+            return
+        i = bucket_index + 1
+        while i < len(sizes):
+            sizes[i] += delta
+            i += i & -i
+
+    def _build_sizes(self) -> list:
+        sizes = [0] + [len(bucket) for bucket in self._buckets]
+        for i in range(1, len(sizes)):
+            parent = i + (i & -i)
+            if parent < len(sizes):
+                sizes[parent] += sizes[i]
+        self._sizes = sizes
+        return sizes
+
+    def _locate(self, index: int) -> tuple:
+        """returns the bucket and the position in it of the post at a position of the whole timeline"""
+        if index < 0:
+            index += len(self._times)
+        if not 0 <= index < len(self._times):
+            raise IndexError("post index out of range")
+        sizes = self._sizes if self._sizes is not None else self._build_sizes()
+        # descend the tree, skipping every run of buckets that ends before index
+        i = 0
+        step = 1 << (len(sizes) - 1).bit_length()
+        while step:
+            if i + step < len(sizes) and sizes[i + step] <= index:
+                i += step
+                index -= sizes[i]
+            step >>= 1
+        return i, index
+
+    def _remove(self, bucket_index: int, position: int):
+        bucket = self._buckets[bucket_index]
+        timestamp, post_id, post = bucket.pop(position)
+        del self._times[post_id]
+        if bucket:
+            self._maxes[bucket_index] = bucket[-1][:2]
+            self._resize(bucket_index, -1)
+        else:
+            del self._buckets[bucket_index]
+            del self._maxes[bucket_index]
+            self._sizes = None
+        return post
+
+    def pop(self, index: int = -1):
+        """removes and returns the post at a position of the timeline"""
+        return self._remove(*self._locate(index))
+
+    def remove_id(self, post_id: int):
+        """removes the post with the given id and returns it, or returns None if there is no such post"""
+        timestamp = self._times.get(post_id)
+        if timestamp is None:
+            return None
+        key = (timestamp, post_id)
+        i = bisect_left(self._maxes, key)
+        return self._remove(i, bisect_left(self._buckets[i], key))
+
+    def remove_time(self, timestamp: float) -> list:
+        """removes every post with the given timestamp and returns them"""
+        timestamp = float(timestamp)
+        ids = [entry[1] for entry in self._entries_between(timestamp, timestamp, inclusive=True)]
+        return [self.remove_id(post_id) for post_id in ids]
+
+    def get(self, post_id: int):
+        """returns the post with the given id, or None"""
+        timestamp = self._times.get(post_id)
+        if timestamp is None:
+            return None
+        key = (timestamp, post_id)
+        i = bisect_left(self._maxes, key)
+        bucket = self._buckets[i]
+        return bucket[bisect_left(bucket, key)][2]
+
+    def _entries_between(self, start, end, inclusive=False):
+        """yields the entries with start <= timestamp < end (or <= end if inclusive), in order"""
+        if start is None:
+            i, position = 0, 0
+        else:
+            # ids start at 1, so (start, 0) sorts before every post at start
+            key = (float(start), 0)
+            i = bisect_left(self._maxes, key)
+            position = bisect_left(self._buckets[i], key) if i < len(self._buckets) else 0
+
+        while i < len(self._buckets):
+            bucket = self._buckets[i]
+            for entry in bucket[position:]:
+                if end is not None and (entry[0] > end if inclusive else entry[0] >= end):
+                    return
+                yield entry
+            i += 1
+            position = 0
+
+    def between(self, start: float = None, end: float = None) -> list:
+        """returns the posts with start <= timestamp < end, in timestamp order (either bound may be None)"""
+        return [entry[2] for entry in self._entries_between(start, end)]
+
+    def latest(self, n: int) -> list:
+        """returns the n newest posts, in timestamp order"""
+        found = []
+        for bucket in reversed(self._buckets):
+            if len(found) >= n:
+                break
+            found.extend(reversed(bucket[max(0, len(bucket) - (n - len(found))):]))
+        found.reverse()
+        return [entry[2] for entry in found]
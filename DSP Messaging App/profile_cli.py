@@ -0,0 +1,84 @@
+import argparse
+import sys
+import time
+from pathlib import Path
+
+from Profile import DsuFileError, DsuProfileError, Profile
+from sqlite_profile import SqliteProfile
+
+"""
+The profile_cli module moves the history of a profile in and out of NDJSON files (see Profile.export_ndjson) from the
+command line, and reports how fast it went:
+
+python profile_cli.py export Kenzo.dsu history.ndjson
+python profile_cli.py import Kenzo.dsu history.ndjson
+
+The profile can be a DSU file, a .dsb file or a .dsdb database. DSU and .dsb files are opened lazily, so an export
+holds one chat in memory at a time; importing into one keeps the whole history in memory, as a Profile always does,
+while importing into a .dsdb database does not.
+"""
+
+
+def open_profile(path):
+    """
+    returns the Profile (or SqliteProfile, for a .dsdb database) stored at path
+
+    Raises DsuProfileError, DsuFileError
+    """
+    if Path(path).suffix == '.dsdb':
+        profile = SqliteProfile()
+        profile.load_profile(path)
+    else:
+        profile = Profile()
+        profile.load_profile(path, lazy=True)
+    return profile
+
+
+def export_profile(path, target) -> dict:
+    """writes the profile at path to the NDJSON file target and returns the counts, with the seconds it took"""
+    start = time.perf_counter()
+    counts = open_profile(path).export_ndjson(target)
+    return dict(counts, seconds=time.perf_counter() - start)
+
+
+def import_profile(path, source) -> dict:
+    """adds the NDJSON file source to the profile at path, saves it and returns the counts, with the seconds it took"""
+    start = time.perf_counter()
+    profile = open_profile(path)
+    counts = profile.import_ndjson(source)
+    if isinstance(profile, Profile) and counts['messages'] > 0:
+        # after a bulk import a new base file is smaller and quicker to open than the same messages in the journal
+        profile._journal_state = None
+    profile.save_profile(path)
+    return dict(counts, seconds=time.perf_counter() - start)
+
+
+def _report(verb, counts) -> str:
+    seconds = max(counts['seconds'], 1e-9)
+    entries = counts['messages'] + counts['posts'] + counts.get('duplicates', 0)
+    text = (f"{verb} {counts['messages']} messages and {counts['posts']} posts in {counts['seconds']:.2f}s "
+            f"({entries / seconds:,.0f} entries/s)")
+    if 'duplicates' in counts:
+        text += f", skipped {counts['duplicates']} duplicates and {counts['skipped']} invalid lines"
+    return text
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Exports or imports the history of a profile as NDJSON.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    export_parser = commands.add_parser("export", help="write the posts and messages of a profile to an NDJSON file")
+    export_parser.add_argument("profile", help="a .dsu, .dsb or .dsdb file")
+    export_parser.add_argument("ndjson", help="the file to write")
+    import_parser = commands.add_parser("import", help="add the posts and messages of an NDJSON file to a profile")
+    import_parser.add_argument("profile", help="a .dsu, .dsb or .dsdb file")
+    import_parser.add_argument("ndjson", help="the file to read")
+    args = parser.parse_args()
+
+    try:
+        if args.command == "export":
+            print(_report("Exported", export_profile(args.profile, args.ndjson)))
+        else:
+            print(_report("Imported", import_profile(args.profile, args.ndjson)))
+    except (DsuFileError, DsuProfileError) as ex:
+        print("Unable to process the profile:", ex)
+        sys.exit(1)
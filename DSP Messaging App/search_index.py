@@ -0,0 +1,247 @@
+import json
+import os
+import re
+from array import array
+from bisect import bisect_left
+from heapq import nlargest
+from pathlib import Path
+
+from message_store import NameTable
+
+"""
+The search_index module contains SearchIndex, an inverted index over the text of direct messages. Every message is a
+document, and for every word the index keeps the ids of the documents it appears in. A document only records the chat
+it belongs to and its timestamp, which is enough for a Profile to find the message itself again.
+"""
+
+_TOKEN = re.compile(r'\w+')
+
+
+def tokenize(text) -> list:
+    """returns the distinct words of text, lowercased"""
+    return list(dict.fromkeys(_TOKEN.findall(text.lower()))) if text else []
+
+
+def query_terms(query) -> list:
+    """returns the words of a query, lowercased, keeping the '*' of prefix words"""
+    return [word + '*' if term.endswith('*') else word
+            for term in query.lower().split() for word in _TOKEN.findall(term)]
+
+
+def matches(terms, text) -> bool:
+    """returns True if text contains every word of terms (see query_terms)"""
+    words = tokenize(text)
+    for term in terms:
+        if term.endswith('*'):
+            if not any(word.startswith(term[:-1]) for word in words):
+                return False
+        elif term not in words:
+            return False
+    return True
+
+
+def search_index_path(path) -> Path:
+    """
+    returns the path of the search index that belongs to the profile file at path
+    """
+    p = Path(path)
+    return p.with_name(p.name + '.search')
+
+
+def read_search_header(path, base=None):
+    """
+    returns the first line of the search index at path, which says which file (base) and how much of its journal
+    the index was written for and how many documents it has, or None if there is no index or it was written for a
+    different base. It is much smaller than the rest of the index.
+    """
+    try:
+        with open(path, 'rb') as f:
+            header = json.loads(f.readline())
+    except (OSError, ValueError):
+        return None
+    if base is not None and header.get('base') != base:
+        return None
+    return header
+
+
+class SearchIndex:
+    """
+    The SearchIndex class maps words to the documents (messages) they appear in. Adding a message costs one append
+    per distinct word in it.
+
+    Queries are words separated by spaces, and a document matches if it contains all of them. A word ending in '*'
+    matches every word that starts with it, e.g. 'hel*' matches 'hello' and 'help'.
+    """
+
+    # how many documents a query with a limit looks at from the newest end before intersecting the whole lists
+    walk_budget = 4096
+
+    def __init__(self):
+        self._names = NameTable()  # usernames of the chats the documents belong to
+        self._peers = array('i')  # document id -> id of its chat's username
+        self._times = array('d')  # document id -> timestamp
+        self._postings = {}  # word -> array of the ids of the documents that contain it, in increasing order
+        # Every word in the index, for prefix queries: most of them sorted in _words, and the newest ones in
+        # _new_words until there are enough of them to be worth merging in.
+        self._words = []
+        self._new_words = []
+
+        # Documents are usually added in timestamp order, so walking a posting list backwards finds the newest
+        # matches first. The ids of the documents that were added out of order are kept aside and always checked.
+        self._late = set()
+        self._latest = float('-inf')
+
+    def __len__(self):
+        return len(self._times)
+
+    def add(self, peer, timestamp, text) -> int:
+        """indexes a message of the chat with peer and returns its document id"""
+        doc = len(self._times)
+        timestamp = float(timestamp)
+        self._peers.append(self._names.intern(peer))
+        self._times.append(timestamp)
+        if timestamp < self._latest:
+            self._late.add(doc)
+        else:
+            self._latest = timestamp
+        for word in tokenize(text):
+            postings = self._postings.get(word)
+            if postings is None:
+                postings = self._postings[word] = array('i')
+                self._new_words.append(word)
+                if len(self._new_words) > max(1024, len(self._words) // 16):
+                    self._words = sorted(self._words + self._new_words)
+                    self._new_words = []
+            postings.append(doc)
+        return doc
+
+    def document(self, doc: int) -> tuple:
+        """returns (peer, timestamp) for a document id"""
+        return self._names.name(self._peers[doc]), self._times[doc]
+
+    def _matches(self, term) -> array:
+        """returns the sorted ids of the documents that contain term (or, for 'prefix*', a word with that prefix)"""
+        if not term.endswith('*'):
+            return self._postings.get(term, array('i'))
+
+        prefix = term[:-1]
+        lists = [self._postings[word] for word in self._new_words if word.startswith(prefix)]
+        for i in range(bisect_left(self._words, prefix), len(self._words)):
+            if not self._words[i].startswith(prefix):
+                break
+            lists.append(self._postings[self._words[i]])
+        if not lists:
+            return array('i')
+        if len(lists) == 1:
+            return lists[0]
+        return array('i', sorted(set().union(*lists)))
+
+    def search(self, query, peer=None, limit: int = None) -> list:
+        """
+        returns the ids of the documents that match query (and belong to the chat with peer, if given), newest first
+        and at most `limit` of them
+        """
+        terms = query_terms(query)
+        if not terms:
+            return []
+
+        # walk the shortest list and look the others up with a binary search, so that a rare word keeps the query
+        # cheap no matter how common the other words are
+        lists = sorted((self._matches(term) for term in terms), key=len)
+        peer_id = None
+        if peer is not None:
+            peer_id = self._names._ids.get(peer)
+            if peer_id is None:
+                return []
+
+        def found(doc):
+            if peer_id is not None and self._peers[doc] != peer_id:
+                return False
+            for other in lists[1:]:
+                i = bisect_left(other, doc)
+                if i == len(other) or other[i] != doc:
+                    return False
+            return True
+
+        docs = None
+        if limit is not None:
+            # The documents that were added in order get older as the walk goes on, so it can stop after `limit`
+            # matches. If they are not found soon, the walk gives way to intersecting the whole lists.
+            docs = []
+            for walked, doc in enumerate(reversed(lists[0])):
+                if walked == self.walk_budget:
+                    docs = None
+                    break
+                if doc not in self._late and found(doc):
+                    docs.append(doc)
+                    if len(docs) == limit:
+                        break
+            if docs is not None:
+                shortest = lists[0]
+                for doc in self._late:
+                    i = bisect_left(shortest, doc)
+                    if i < len(shortest) and shortest[i] == doc and found(doc):
+                        docs.append(doc)
+        if docs is None:
+            candidates = set(lists[0]).intersection(*lists[1:]) if len(lists) > 1 else lists[0]
+            docs = [doc for doc in candidates if peer_id is None or self._peers[doc] == peer_id]
+
+        times = self._times
+        if limit is not None and len(docs) > limit:
+            return nlargest(limit, docs, key=times.__getitem__)
+        return sorted(docs, key=times.__getitem__, reverse=True)
+
+    def save(self, path, base, journal_bytes: int = 0) -> None:
+        """
+        writes the index to path: a JSON header line (see read_search_header), a JSON line with the usernames and
+        the words, and then the document and posting arrays as raw bytes. base identifies the profile file the index
+        was written for, and journal_bytes is how much of that file's journal the index already covers.
+        """
+        words = list(self._postings)
+        header = {'base': base, 'journal': journal_bytes, 'docs': len(self._times)}
+        vocabulary = {'names': self._names._names, 'late': sorted(self._late),
+                      'words': [[word, len(self._postings[word])] for word in words]}
+        temp = Path(str(path) + '.tmp')
+        with open(temp, 'wb') as f:
+            f.write(json.dumps(header).encode() + b'\n')
+            f.write(json.dumps(vocabulary).encode() + b'\n')
+            self._peers.tofile(f)
+            self._times.tofile(f)
+            for word in words:
+                self._postings[word].tofile(f)
+        os.replace(temp, path)
+
+    @classmethod
+    def load(cls, path, base=None):
+        """
+        reads an index written by save, returning None if there is none, or if base is given and the index was
+        written for a different base
+        """
+        try:
+            with open(path, 'rb') as f:
+                header = json.loads(f.readline())
+                if base is not None and header['base'] != base:
+                    return None
+                vocabulary = json.loads(f.readline())
+                data = f.read()
+        except (OSError, ValueError):
+            return None
+
+        index = cls()
+        for name in vocabulary['names']:
+            index._names.intern(name)
+        count = header['docs']
+        offset = 0
+        for column in (index._peers, index._times):
+            size = count * column.itemsize
+            column.frombytes(data[offset:offset + size])
+            offset += size
+        for word, length in vocabulary['words']:
+            postings = index._postings[word] = array('i')
+            postings.frombytes(data[offset:offset + length * postings.itemsize])
+            offset += length * postings.itemsize
+        index._words = sorted(index._postings)
+        index._late = set(vocabulary['late'])
+        if count:
+            index._latest = max(index._times)
+        return index
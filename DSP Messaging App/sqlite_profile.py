@@ -0,0 +1,372 @@
+import json
+import os
+import sqlite3
+from pathlib import Path
+
+from ds_messenger import DirectMessage
+from Profile import DsuFileError, DsuProfileError, Post, Profile, read_ndjson
+
+"""
+The sqlite_profile module contains SqliteProfile, a Profile backend that keeps messages, contacts and posts in a SQLite
+database (a .dsdb file) instead of in Python lists that are written out as JSON. It is meant for accounts whose
+history is too big to load and rewrite as a whole.
+"""
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS header (name TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS contacts (id INTEGER PRIMARY KEY, username TEXT NOT NULL UNIQUE);
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    peer TEXT NOT NULL,
+    sender TEXT,
+    recipient TEXT,
+    timestamp REAL NOT NULL,
+    message TEXT,
+    UNIQUE (sender, recipient, timestamp, message)
+);
+CREATE INDEX IF NOT EXISTS messages_peer_timestamp ON messages (peer, timestamp);
+CREATE TABLE IF NOT EXISTS posts (id INTEGER PRIMARY KEY, timestamp REAL NOT NULL, entry TEXT);
+CREATE INDEX IF NOT EXISTS posts_timestamp ON posts (timestamp);
+CREATE TABLE IF NOT EXISTS sync_cursor (peer TEXT PRIMARY KEY, timestamp REAL NOT NULL);
+"""
+
+
+class SqliteProfile:
+    """
+    The SqliteProfile class has the same surface as Profile (add_msg, get_chat_messages, the post timeline,
+    add_user, the sync cursor, load_profile and save_profile), but nothing is held in memory except the header
+    fields. Messages are indexed on (peer, timestamp), so a chat or a page of it is read straight from the
+    index.
+
+    Until a database is loaded or saved, the profile lives in an in-memory database. Changes are written as they are
+    made and committed by save_profile.
+
+    Every message belongs to a single chat: the one with whichever of its sender and recipient is not the profile's
+    own user.
+    """
+
+    # header attributes that are stored in the header table
+    _HEADER_FIELDS = Profile._HEADER_FIELDS
+
+    def __init__(self, dsuserver=None, username=None, password=None):
+        self.dsuserver = dsuserver
+        self.username = username
+        self.password = password
+        self.bio = ''
+        self._last_sync = 0
+
+        self._path = None
+        self._db = sqlite3.connect(':memory:')
+        self._db.executescript(_SCHEMA)
+
+    @property
+    def _users(self) -> list:
+        """the usernames of the users the profile has chats with, in the order they were added"""
+        return [row[0] for row in self._db.execute('SELECT username FROM contacts ORDER BY id')]
+
+    def add_user(self, username: str) -> bool:
+        """
+        adds username to the users the profile has chats with, returning False if it was already there
+        """
+        if username == self.username:
+            return False
+        return self._db.execute('INSERT OR IGNORE INTO contacts (username) VALUES (?)', (username,)).rowcount == 1
+
+    def add_msg(self, message: DirectMessage) -> bool:
+        """
+        add_msg accepts a DirectMessage object and stores it, returning True if the message was new and False if the
+        profile already had it.
+        """
+        sender = message['from']
+        recipient = message['recipient']
+        peer = recipient if sender == self.username else sender
+        inserted = self._db.execute(
+            'INSERT OR IGNORE INTO messages (peer, sender, recipient, timestamp, message) VALUES (?, ?, ?, ?, ?)',
+            (peer, sender, recipient, float(message['timestamp']), message['message'])).rowcount == 1
+        if inserted:
+            for user in (recipient, sender):
+                self.add_user(user)
+        return inserted
+
+    def get_chat_messages(self, username: str, since: float = None, until: float = None, limit: int = None) -> list:
+        """
+        accepts a username and returns a list of the messages in the chat with that user, sorted by timestamp. since,
+        until and limit work as they do for Profile.get_chat_messages.
+        """
+        query = 'SELECT sender, recipient, timestamp, message FROM messages WHERE peer = ?'
+        params = [username]
+        if since is not None:
+            query += ' AND timestamp >= ?'
+            params.append(since)
+        if until is not None:
+            query += ' AND timestamp < ?'
+            params.append(until)
+        query += ' ORDER BY timestamp DESC, id DESC'
+        if limit is not None:
+            query += ' LIMIT ?'
+            params.append(limit)
+
+        rows = self._db.execute(query, params).fetchall()
+        rows.reverse()
+        return [DirectMessage(message=message, timestamp=timestamp, recipient=recipient, frm=sender)
+                for sender, recipient, timestamp, message in rows]
+
+    def get_sync_cursor(self, username: str) -> float:
+        """
+        returns the latest server timestamp seen in a message from username, or 0 if there is none
+        """
+        row = self._db.execute('SELECT timestamp FROM sync_cursor WHERE peer = ?', (username,)).fetchone()
+        return 0 if row is None else row[0]
+
+    def get_last_sync(self) -> float:
+        """
+        returns when the profile last synced with the server, or 0 if it never has
+        """
+        return self._last_sync
+
+    def set_last_sync(self, timestamp: float) -> None:
+        """
+        records that the profile synced with the server at timestamp
+        """
+        self._last_sync = timestamp
+
+    def update_sync_cursor(self, username: str, timestamp: float) -> None:
+        """
+        moves the sync cursor for username forward to timestamp (it never moves back)
+        """
+        self._db.execute('INSERT INTO sync_cursor (peer, timestamp) VALUES (?, ?) '
+                         'ON CONFLICT (peer) DO UPDATE SET timestamp = max(timestamp, excluded.timestamp)',
+                         (username, timestamp))
+
+    def add_post(self, post: Post) -> int:
+        """
+        add_post accepts a Post object, stores it and returns its id (also set as post.id).
+        """
+        post._id = self._db.execute('INSERT INTO posts (timestamp, entry) VALUES (?, ?)',
+                                    (post.timestamp, post.entry)).lastrowid
+        return post._id
+
+    def add_posts(self, posts) -> list:
+        """
+        adds many Post objects at once and returns their ids
+        """
+        return [self.add_post(post) for post in posts]
+
+    def del_post(self, index: int) -> bool:
+        """
+        del_post removes the Post at a given index of get_posts() and returns True if successful and False if an
+        invalid index was supplied.
+        """
+        count = self._db.execute('SELECT count(*) FROM posts').fetchone()[0]
+        if not -count <= index < count:
+            return False
+        row = self._db.execute('SELECT id FROM posts ORDER BY timestamp, id LIMIT 1 OFFSET ?',
+                               (index % count,)).fetchone()
+        self._db.execute('DELETE FROM posts WHERE id = ?', row)
+        return True
+
+    def del_post_by_id(self, post_id: int) -> bool:
+        """
+        removes the post with the given id, returning False if there is none
+        """
+        return self._db.execute('DELETE FROM posts WHERE id = ?', (post_id,)).rowcount > 0
+
+    def del_post_by_time(self, timestamp: float) -> bool:
+        """
+        removes the posts with the given timestamp, returning False if there are none
+        """
+        return self._db.execute('DELETE FROM posts WHERE timestamp = ?', (timestamp,)).rowcount > 0
+
+    def _select_posts(self, query, params=()) -> list:
+        posts = []
+        for post_id, timestamp, entry in self._db.execute(query, params):
+            post = Post(entry, timestamp)
+            post._id = post_id
+            posts.append(post)
+        return posts
+
+    def get_posts(self) -> list:
+        """
+        get_posts returns a list of all posts, sorted by timestamp
+        """
+        return self._select_posts('SELECT id, timestamp, entry FROM posts ORDER BY timestamp, id')
+
+    def get_posts_between(self, start: float = None, end: float = None) -> list:
+        """
+        returns the posts with start <= timestamp < end, sorted by timestamp. Either bound may be None.
+        """
+        return self._select_posts('SELECT id, timestamp, entry FROM posts WHERE timestamp >= ? AND timestamp < ? '
+                                  'ORDER BY timestamp, id',
+                                  (float('-inf') if start is None else start, float('inf') if end is None else end))
+
+    def latest_posts(self, n: int) -> list:
+        """
+        returns the n newest posts, sorted by timestamp
+        """
+        posts = self._select_posts('SELECT id, timestamp, entry FROM posts ORDER BY timestamp DESC, id DESC LIMIT ?',
+                                   (n,))
+        posts.reverse()
+        return posts
+
+    def export_ndjson(self, path: str) -> dict:
+        """
+        writes the profile's posts and messages to path as NDJSON, in the format of Profile.export_ndjson. Rows are
+        streamed from the database, so memory use does not grow with the history.
+
+        Raises DsuFileError
+        """
+        counts = {'messages': 0, 'posts': 0}
+        try:
+            with open(path, 'w', encoding='utf-8') as f:
+                for timestamp, entry in self._db.execute('SELECT timestamp, entry FROM posts ORDER BY timestamp, id'):
+                    f.write(json.dumps({'post': {'entry': entry, 'timestamp': timestamp}}) + '\n')
+                    counts['posts'] += 1
+                cursor = self._db.execute('SELECT sender, recipient, timestamp, message FROM messages '
+                                          'ORDER BY peer, timestamp, id')
+                while True:
+                    rows = cursor.fetchmany(10000)
+                    if not rows:
+                        break
+                    f.write(''.join(json.dumps({'msg': {'from': sender, 'recipient': recipient, 'timestamp': timestamp,
+                                                        'message': message}}) + '\n'
+                                    for sender, recipient, timestamp, message in rows))
+                    counts['messages'] += len(rows)
+        except (OSError, sqlite3.Error) as ex:
+            raise DsuFileError("An error occurred while attempting to write the NDJSON file.", ex)
+        return counts
+
+    def import_ndjson(self, path: str) -> dict:
+        """
+        adds the posts and messages of an NDJSON file (see Profile.export_ndjson) to the profile, reading the file
+        one line at a time and inserting the messages in one statement, so memory use does not grow with the file.
+        Duplicates are skipped as they are by Profile.import_ndjson, and the counts it returns are the same. The
+        changes are committed by save_profile.
+
+        Raises DsuFileError
+        """
+        counts = {'messages': 0, 'posts': 0, 'duplicates': 0, 'skipped': 0}
+        users = {}
+        posts = []
+
+        def messages():
+            for entry in read_ndjson(path, counts):
+                if 'post' in entry:
+                    posts.append(entry['post'])
+                    continue
+                message = entry['msg']
+                sender = message['from']
+                recipient = message['recipient']
+                users[recipient] = users[sender] = None
+                counts['duplicates'] += 1
+                yield (recipient if sender == self.username else sender, sender, recipient, message['timestamp'],
+                       message['message'])
+
+        try:
+            before = self._db.total_changes
+            self._db.executemany('INSERT OR IGNORE INTO messages (peer, sender, recipient, timestamp, message) '
+                                 'VALUES (?, ?, ?, ?, ?)', messages())
+            counts['messages'] = self._db.total_changes - before
+            counts['duplicates'] -= counts['messages']
+            for user in users:
+                self.add_user(user)
+            for post in posts:
+                if self._db.execute('SELECT 1 FROM posts WHERE timestamp = ? AND entry = ?',
+                                    (post['timestamp'], post['entry'])).fetchone():
+                    counts['duplicates'] += 1
+                else:
+                    self.add_post(Post(post['entry'], post['timestamp']))
+                    counts['posts'] += 1
+        except OSError as ex:
+            raise DsuFileError("An error occurred while attempting to read the NDJSON file.", ex)
+        except sqlite3.Error as ex:
+            raise DsuFileError("An error occurred while attempting to process the DSU database.", ex)
+        return counts
+
+    def save_profile(self, path: str) -> None:
+        """
+        save_profile commits the profile to the .dsdb database at path. If path is not the database the profile
+        was loaded from, the whole database is copied there and the profile carries on with the copy.
+
+        Raises DsuFileError
+        """
+        p = Path(path)
+        if p.suffix != '.dsdb':
+            raise DsuFileError("Invalid DSU database path or type")
+
+        try:
+            self._db.executemany('INSERT OR REPLACE INTO header (name, value) VALUES (?, ?)',
+                                 [(name, json.dumps(getattr(self, name))) for name in self._HEADER_FIELDS])
+            self._db.commit()
+            if self._path != os.path.abspath(p):
+                target = sqlite3.connect(p)
+                self._db.backup(target)
+                self._db.close()
+                self._db = target
+                self._path = os.path.abspath(p)
+        except sqlite3.Error as ex:
+            raise DsuFileError("An error occurred while attempting to process the DSU database.", ex)
+
+    def load_profile(self, path: str) -> None:
+        """
+        load_profile opens the .dsdb database at path. Only the header fields are read; messages, contacts and
+        posts are read when they are asked for.
+
+        Raises DsuProfileError, DsuFileError
+        """
+        p = Path(path)
+        if not (os.path.exists(p) and p.suffix == '.dsdb'):
+            raise DsuFileError()
+
+        try:
+            db = sqlite3.connect(p)
+            db.executescript(_SCHEMA)
+            for name, value in db.execute('SELECT name, value FROM header'):
+                if name in self._HEADER_FIELDS:
+                    setattr(self, name, json.loads(value))
+        except sqlite3.Error as ex:
+            raise DsuProfileError(ex)
+
+        self._db.close()
+        self._db = db
+        self._path = os.path.abspath(p)
+
+    def close(self) -> None:
+        """commits any outstanding changes and closes the database"""
+        self._db.commit()
+        self._db.close()
+
+
+def migrate_dsu(dsu_path: str, dsdb_path: str) -> SqliteProfile:
+    """
+    reads the DSU file at dsu_path (and its journal and archive) and writes its whole contents into a new .dsdb
+    database at dsdb_path, returning the SqliteProfile for the new database
+
+    Raises DsuProfileError, DsuFileError
+    """
+    if os.path.exists(dsdb_path):
+        raise DsuFileError("The target DSU database already exists")
+
+    profile = Profile()
+    profile.load_profile(dsu_path)
+
+    migrated = SqliteProfile(profile.dsuserver, profile.username, profile.password)
+    migrated.bio = profile.bio
+    migrated.set_last_sync(profile.get_last_sync())
+    db = migrated._db
+    db.executemany('INSERT OR IGNORE INTO contacts (username) VALUES (?)', ((user,) for user in profile._users))
+    db.executemany('INSERT OR IGNORE INTO messages (peer, sender, recipient, timestamp, message) VALUES (?, ?, ?, ?, ?)',
+                   ((message['recipient'] if message['from'] == profile.username else message['from'],
+                     message['from'], message['recipient'], float(message['timestamp']), message['message'])
+                    for message in profile._messages))
+    if profile._archive is not None:
+        # the archived history is streamed one segment at a time, so it never has to be in memory as a whole
+        db.executemany('INSERT OR IGNORE INTO messages (peer, sender, recipient, timestamp, message) '
+                       'VALUES (?, ?, ?, ?, ?)',
+                       ((peer, frm, recipient, float(timestamp), message)
+                        for peer in profile._archive.peers()
+                        for frm, recipient, timestamp, message in profile._archive.rows(peer)))
+    db.executemany('INSERT INTO posts (timestamp, entry) VALUES (?, ?)',
+                   ((post.timestamp, post.entry) for post in profile.get_posts()))
+    db.executemany('INSERT INTO sync_cursor (peer, timestamp) VALUES (?, ?)', profile._sync_cursor.items())
+    migrated.save_profile(dsdb_path)
+    return migrated
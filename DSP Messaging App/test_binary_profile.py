@@ -0,0 +1,41 @@
+from binary_profile import dsb_to_dsu, dsu_to_dsb
+from ds_messenger import DirectMessage
+from history_archive import archive_profile
+from Profile import Profile
+
+
+def test_lone_surrogates_survive_the_binary_format(tmp_path):
+    dsu = tmp_path / "alice.dsu"
+    dsu.touch()
+    profile = Profile("127.0.0.1", "alice", "password")
+    # a server can send "\ud800" in a JSON message
+    profile.add_msg(DirectMessage(message="half \ud800 a pair", timestamp=1.0, recipient="alice", frm="bob"))
+    profile.save_profile(str(dsu))
+
+    dsb = tmp_path / "alice.dsb"
+    dsu_to_dsb(str(dsu), str(dsb))
+    loaded = Profile()
+    loaded.load_profile(str(dsb))
+    assert [m['message'] for m in loaded.get_chat_messages("bob")] == ["half \ud800 a pair"]
+
+    back = tmp_path / "back.dsu"
+    dsb_to_dsu(str(dsb), str(back))
+    loaded = Profile()
+    loaded.load_profile(str(back))
+    assert [m['message'] for m in loaded.get_chat_messages("bob")] == ["half \ud800 a pair"]
+
+
+def test_conversion_keeps_archived_messages(tmp_path):
+    dsu = tmp_path / "alice.dsu"
+    dsu.touch()
+    profile = Profile("127.0.0.1", "alice", "password")
+    for i in range(50):
+        profile.add_msg(DirectMessage(message=f"message {i}", timestamp=float(i), recipient="alice", frm="bob"))
+    profile.save_profile(str(dsu))
+    assert archive_profile(str(dsu), keep=10)['messages_archived'] == 40
+
+    dsb = tmp_path / "alice.dsb"
+    dsu_to_dsb(str(dsu), str(dsb))
+    loaded = Profile()
+    loaded.load_profile(str(dsb))
+    assert [m['message'] for m in loaded.get_chat_messages("bob")] == [f"message {i}" for i in range(50)]
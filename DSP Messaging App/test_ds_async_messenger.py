@@ -0,0 +1,104 @@
+import asyncio
+
+import pytest
+
+from ds_async_messenger import AsyncDirectMessenger
+from ds_server import DSPServer
+
+
+@pytest.fixture
+def server():
+    server = DSPServer()
+    server.start_in_thread()
+    yield server
+    server.stop_thread()
+
+
+def inbox(server, username) -> list:
+    return [message["message"] for message in server._inbox.get(username, [])]
+
+
+def test_session_joins_once_for_many_requests(server):
+    async def run():
+        messenger = AsyncDirectMessenger("127.0.0.1", "alice", "password", server.port)
+        assert await messenger.join()
+        for i in range(10):
+            assert await messenger.send(f"message {i}", "bob")
+        assert await messenger.retrieve_new() == []
+        await messenger.close()
+        return messenger
+
+    messenger = asyncio.run(run())
+    assert server.joins == 1
+    assert messenger.round_trips_saved == 11
+    assert len(messenger.sent_messages) == 10
+
+
+def test_reconnects_after_the_server_closed_the_session(server):
+    async def run(port, restart):
+        messenger = AsyncDirectMessenger("127.0.0.1", "alice", "password", port)
+        assert await messenger.send("before", "bob")
+        restarted = await asyncio.get_running_loop().run_in_executor(None, restart)
+        try:
+            # give the loop a moment to notice that the old connection was closed
+            await asyncio.sleep(0.05)
+            assert await messenger.send("after", "bob")
+            assert messenger.joins == 2
+            await messenger.close()
+            return inbox(restarted, "bob")
+        finally:
+            restarted.stop_thread()
+
+    def restart():
+        server.stop_thread()
+        restarted = DSPServer(port=server.port)
+        restarted.start_in_thread()
+        return restarted
+
+    assert asyncio.run(run(server.port, restart)) == ["after"]
+
+
+def test_send_whose_reply_was_lost_is_reported_failed_and_not_resent(server):
+    async def run():
+        messenger = AsyncDirectMessenger("127.0.0.1", "alice", "password", server.port)
+        assert await messenger.send("a", "bob")
+        server.reply_loss_rate = 1.0
+        assert not await messenger.send("b", "bob")
+        server.reply_loss_rate = 0.0
+        assert await messenger.send("c", "bob")
+        await messenger.close()
+        return messenger
+
+    messenger = asyncio.run(run())
+    assert inbox(server, "bob") == ["a", "b", "c"]
+    assert [message.get_message() for message in messenger.sent_messages] == ["a", "c"]
+
+
+def test_lost_retrieve_is_not_retried(server):
+    async def run():
+        messenger = AsyncDirectMessenger("127.0.0.1", "alice", "password", server.port)
+        assert await messenger.join()
+        server.reply_loss_rate = 1.0
+        with pytest.raises(OSError):
+            await messenger.retrieve_new()
+        server.reply_loss_rate = 0.0
+        await messenger.close()
+
+    asyncio.run(run())
+    assert server.connections == 1
+
+
+def test_wrong_password_is_rejected(server):
+    async def run():
+        owner = AsyncDirectMessenger("127.0.0.1", "alice", "password", server.port)
+        assert await owner.join()
+        await owner.close()
+
+        intruder = AsyncDirectMessenger("127.0.0.1", "alice", "wrong", server.port)
+        assert not await intruder.join()
+        assert not await intruder.send("hi", "bob")
+        assert await intruder.retrieve_new() == []
+        await intruder.close()
+
+    asyncio.run(run())
+    assert inbox(server, "bob") == []
@@ -0,0 +1,190 @@
+import json
+
+import pytest
+
+from ds_messenger import DirectMessenger
+from ds_server import DSPServer
+from Profile import Profile
+from sqlite_profile import SqliteProfile
+
+
+@pytest.fixture
+def server():
+    server = DSPServer()
+    server.start_in_thread()
+    yield server
+    server.stop_thread()
+
+
+def restart(server) -> DSPServer:
+    """Drops every open connection of server, like an idle disconnect, and starts a new server on the same port."""
+    server.stop_thread()
+    restarted = DSPServer(port=server.port)
+    restarted.start_in_thread()
+    return restarted
+
+
+def test_session_joins_once_for_many_requests(server):
+    messenger = DirectMessenger("127.0.0.1", "alice", "password", server.port)
+    for i in range(20):
+        assert messenger.send(f"message {i}", "bob")
+    assert messenger.retrieve_new() == []
+    messenger.close()
+
+    assert server.joins == 1
+    assert server.connections == 1
+    assert messenger.joins == 1
+    assert messenger.round_trips_saved == 20
+
+
+def test_messages_with_newlines_and_quotes_keep_replies_in_line(server):
+    messenger = DirectMessenger("127.0.0.1", "alice", "password", server.port)
+    assert messenger.send('line1\nline2 "quoted"', "bob")
+    assert messenger.send("hello", "bob")
+    assert messenger.send_many([("a\r\nb", "bob"), ('"', "bob"), ("\\", "bob")]) == [True, True, True]
+    messenger.close()
+
+    receiver = DirectMessenger("127.0.0.1", "bob", "password", server.port)
+    received = [message.get_message() for message in receiver.retrieve_all()]
+    receiver.close()
+    assert received == ['line1\nline2 "quoted"', "hello", "a\r\nb", '"', "\\"]
+    assert server.joins == 2
+
+
+def test_send_is_not_resent_when_its_reply_is_lost(server):
+    messenger = DirectMessenger("127.0.0.1", "alice", "password", server.port)
+    assert messenger.send("first", "bob")
+    # the server drops the connection after reading the next request, so its reply never arrives
+    server.failure_rate = 1.0
+    with pytest.raises(OSError):
+        messenger.send("second", "bob")
+    server.failure_rate = 0.0
+
+    assert messenger.send("third", "bob")
+    messenger.close()
+    # no second connection was opened to write "second" again, only the one for "third"
+    assert server.connections == 2
+    assert server.requests == 4  # two joins, "first" and "third"
+
+
+def test_send_reconnects_after_the_server_closed_the_session(server):
+    messenger = DirectMessenger("127.0.0.1", "alice", "password", server.port)
+    assert messenger.send("before", "bob")
+    server = restart(server)
+    try:
+        assert messenger.send("after", "bob")
+        assert messenger.joins == 2
+        assert server.requests == 2  # the join and "after", written once
+    finally:
+        messenger.close()
+        server.stop_thread()
+
+
+def test_send_many_reconnects_after_the_server_closed_the_session(server):
+    messenger = DirectMessenger("127.0.0.1", "alice", "password", server.port)
+    assert messenger.send_many([("before", "bob")]) == [True]
+    server = restart(server)
+    try:
+        assert messenger.send_many([("one", "bob"), ("two", "bob")]) == [True, True]
+        assert messenger.joins == 2
+    finally:
+        messenger.close()
+        server.stop_thread()
+
+
+def test_first_sync_of_an_old_profile_does_not_duplicate_its_history(server, tmp_path):
+    sender = DirectMessenger("127.0.0.1", "bob", "password", server.port)
+    assert sender.send_many([("hi", "alice"), ("there", "alice")]) == [True, True]
+    sender.close()
+
+    messenger = DirectMessenger("127.0.0.1", "alice", "password", server.port)
+    history = messenger.retrieve_all()
+    # a .dsu file written before sync existed: the messages are there, but no sync cursor or last sync time
+    path = tmp_path / "alice.dsu"
+    path.write_text(json.dumps({"dsuserver": "127.0.0.1", "username": "alice", "password": "password",
+                                "bio": "", "_posts": [], "_messages": history, "_users": ["bob"]}))
+    profile = Profile()
+    profile.load_profile(str(path))
+
+    assert messenger.sync(profile) == []
+    messenger.close()
+    assert len(profile.get_chat_messages("bob")) == 2
+
+
+def test_sync_that_the_server_refuses_does_not_count(server):
+    messenger = DirectMessenger("127.0.0.1", "alice", "password", server.port)
+    profile = Profile("127.0.0.1", "alice", "password")
+    assert messenger.sync(profile) == []
+    last_sync = profile.get_last_sync()
+
+    token, messenger.token = messenger.token, "expired"
+    with pytest.raises(ValueError):
+        messenger.sync(profile)
+    assert profile.get_last_sync() == last_sync
+
+    # the error reply was read to its end, so the session is still in step
+    messenger.token = token
+    assert messenger.send("hello", "bob")
+    messenger.close()
+    assert server.connections == 1
+
+
+def test_send_many_does_not_resend_a_window_whose_replies_were_lost(server):
+    messenger = DirectMessenger("127.0.0.1", "alice", "password", server.port)
+    assert messenger.send("a", "bob")
+    saved = messenger.round_trips_saved
+    server.reply_loss_rate = 1.0
+    assert messenger.send_many([("b", "bob"), ("c", "bob")]) == [False, False]
+    server.reply_loss_rate = 0.0
+
+    # "b" was handled before the connection went down, and "c" was never read; neither was written again
+    assert [message["message"] for message in server._inbox["bob"]] == ["a", "b"]
+    assert messenger.round_trips_saved == saved
+    assert messenger.send_many([("d", "bob")]) == [True]
+    messenger.close()
+    assert [message["message"] for message in server._inbox["bob"]] == ["a", "b", "d"]
+
+
+@pytest.mark.parametrize("backend", ["json", "sqlite"])
+def test_delta_sync_moves_the_cursor_and_fetches_only_new_messages(server, tmp_path, backend):
+    sender = DirectMessenger("127.0.0.1", "bob", "password", server.port)
+    sender.send_many([("one", "alice"), ("two", "alice")])
+    profile = Profile("127.0.0.1", "alice", "password") if backend == "json" else \
+        SqliteProfile("127.0.0.1", "alice", "password")
+    messenger = DirectMessenger("127.0.0.1", "alice", "password", server.port)
+
+    assert profile.get_last_sync() == 0
+    assert [m['message'] for m in messenger.sync(profile)] == ["one", "two"]
+    assert profile.get_last_sync() > 0
+    cursor = profile.get_sync_cursor("bob")
+    assert cursor == max(m['timestamp'] for m in profile.get_chat_messages("bob"))
+
+    # later syncs only ask for what the server has not handed out yet
+    requests = server.requests
+    assert messenger.sync(profile) == []
+    assert server.requests == requests + 1
+    sender.send("three", "alice")
+    assert [m['message'] for m in messenger.sync(profile)] == ["three"]
+    assert profile.get_sync_cursor("bob") > cursor
+
+    # a full sync only merges what is newer than the cursor, so nothing is added twice
+    assert messenger.sync(profile, full=True) == []
+    assert [m['message'] for m in profile.get_chat_messages("bob")] == ["one", "two", "three"]
+    messenger.close()
+    sender.close()
+
+
+def test_sync_cursor_and_last_sync_are_saved(tmp_path):
+    path = tmp_path / "alice.dsu"
+    path.touch()
+    profile = Profile("127.0.0.1", "alice", "password")
+    profile.update_sync_cursor("bob", 5.0)
+    profile.update_sync_cursor("bob", 3.0)  # never moves back
+    profile.set_last_sync(42.0)
+    profile.save_profile(str(path))
+
+    loaded = Profile()
+    loaded.load_profile(str(path))
+    assert loaded.get_sync_cursor("bob") == 5.0
+    assert loaded.get_sync_cursor("carol") == 0
+    assert loaded.get_last_sync() == 42.0
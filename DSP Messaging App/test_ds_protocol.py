@@ -0,0 +1,55 @@
+import io
+import json
+import random
+
+import pytest
+
+import ds_protocol as dsp
+
+
+def stream(line, chunk_size):
+    response = {}
+    messages = list(dsp.stream_srvmsg(io.StringIO(line), response, chunk_size))
+    return response, messages
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 5, 7, 64])
+def test_numbers_split_at_a_chunk_boundary(chunk_size):
+    line = '{"response": {"type": "ok", "messages": [1.5, 2.25, -3e-2, 10, 1E+3, 0.0]}}\r\n'
+    assert stream(line, chunk_size) == ({"type": "ok"}, [1.5, 2.25, -3e-2, 10, 1E+3, 0.0])
+
+
+def test_random_responses_with_random_chunk_sizes():
+    rng = random.Random(32)
+    alphabet = 'ab "\\\n\té中😀{}[],:'
+
+    def text():
+        return ''.join(rng.choice(alphabet) for _ in range(rng.randrange(12)))
+
+    def number():
+        return rng.choice([rng.randrange(-10 ** 6, 10 ** 6), rng.uniform(-1e9, 1e9), rng.uniform(0, 1) * 1e-12])
+
+    for _ in range(300):
+        messages = [{"message": text(), "from": text(), "timestamp": rng.choice([number(), str(number())])}
+                    for _ in range(rng.randrange(6))]
+        reply = {"response": {"type": "ok", "note": number(), "messages": messages, "extra": [number(), None, True]}}
+        line = json.dumps(reply, ensure_ascii=rng.random() < 0.5) + '\r\n'
+        response, streamed = stream(line, rng.randrange(1, 40))
+        assert streamed == messages
+        assert response == {"type": "ok", "note": reply["response"]["note"], "extra": reply["response"]["extra"]}
+
+
+def test_error_reply_has_no_messages():
+    line = '{"response": {"type": "error", "message": "Invalid user token"}}\r\n'
+    assert stream(line, 4) == ({"type": "error", "message": "Invalid user token"}, [])
+
+
+def test_invalid_line_raises_value_error():
+    with pytest.raises(ValueError):
+        stream('{"response": {"type": "ok", "messages": [1, }}\r\n', 3)
+
+
+def test_requests_stay_on_one_line():
+    request = dsp.get_sendmsg("token", 'say "hi"\nthen\\leave', "bob")
+    assert '\n' not in request
+    assert json.loads(request)["directmessage"]["entry"] == 'say "hi"\nthen\\leave'
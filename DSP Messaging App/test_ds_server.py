@@ -0,0 +1,84 @@
+import json
+import time
+
+import pytest
+
+from ds_messenger import DirectMessenger
+from ds_server import DSPServer
+
+
+def request(server, obj) -> dict:
+    return server.handle_request(json.dumps(obj).encode())["response"]
+
+
+def join(server, username, password="password") -> str:
+    return request(server, {"join": {"username": username, "password": password, "token": ""}})["token"]
+
+
+def test_handle_request_speaks_the_dsp_protocol():
+    server = DSPServer()
+    alice = join(server, "alice")
+    bob = join(server, "bob")
+    assert request(server, {"join": {"username": "alice", "password": "wrong", "token": ""}})["type"] == "error"
+
+    sent = request(server, {"token": alice, "directmessage": {"entry": "hi", "recipient": "bob", "timestamp": "1"}})
+    assert sent == {"type": "ok", "message": "Direct message sent"}
+    assert request(server, {"token": bob, "directmessage": "new"})["messages"] == \
+        [{"message": "hi", "from": "alice", "timestamp": "1"}]
+    # "new" hands every message out once, "all" every time
+    assert request(server, {"token": bob, "directmessage": "new"})["messages"] == []
+    assert len(request(server, {"token": bob, "directmessage": "all"})["messages"]) == 1
+
+    assert request(server, {"token": "nobody", "directmessage": "new"})["message"] == "Invalid user token"
+    assert request(server, {"token": bob, "directmessage": "later"})["message"] == "Unknown request"
+    assert server.handle_request(b"{not json")["response"]["type"] == "error"
+    assert server.joins == 3
+
+
+def test_latency_delays_every_reply():
+    server = DSPServer(latency=0.05)
+    port = server.start_in_thread()
+    try:
+        messenger = DirectMessenger("127.0.0.1", "alice", "password", port)
+        start = time.perf_counter()
+        assert messenger.send("hi", "bob")  # a join and a send, one delay each
+        assert time.perf_counter() - start >= 0.1
+        messenger.close()
+    finally:
+        server.stop_thread()
+
+
+def test_jitter_stays_in_range_and_repeats_with_a_seed():
+    delays = [DSPServer(latency=0.1, jitter=0.05, seed=7)._delay() for _ in range(2)]
+    assert delays[0] == delays[1]
+    server = DSPServer(latency=0.01, jitter=0.05, seed=7)
+    for _ in range(200):
+        assert 0.0 <= server._delay() <= 0.06
+    assert DSPServer()._delay() == 0.0
+
+
+def test_failure_drops_the_request_and_the_connection():
+    server = DSPServer(failure_rate=1.0)
+    port = server.start_in_thread()
+    try:
+        messenger = DirectMessenger("127.0.0.1", "alice", "password", port)
+        with pytest.raises(OSError):
+            messenger.send("hi", "bob")
+        assert server.requests == 0
+    finally:
+        server.stop_thread()
+
+
+def test_reply_loss_delivers_the_request_but_drops_the_reply():
+    server = DSPServer()
+    port = server.start_in_thread()
+    try:
+        messenger = DirectMessenger("127.0.0.1", "alice", "password", port)
+        assert messenger.send("first", "bob")
+        server.reply_loss_rate = 1.0
+        with pytest.raises(OSError):
+            messenger.send("second", "bob")
+        server.reply_loss_rate = 0.0
+        assert [message["message"] for message in server._inbox["bob"]] == ["first", "second"]
+    finally:
+        server.stop_thread()
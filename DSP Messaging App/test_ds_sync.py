@@ -0,0 +1,234 @@
+import json
+
+import pytest
+
+from ds_messenger import DirectMessenger
+from ds_server import DSPServer
+from ds_sync import AdaptivePoll, FixedPoll, Outbox, SyncWorker, outbox_path
+from Profile import Profile, ProfileCache, ProfilePersister
+
+
+def test_adaptive_poll_never_polls_faster_than_the_fixed_default():
+    policy = AdaptivePoll(jitter=0)
+    assert policy.activity() == FixedPoll().interval
+    assert policy.next_interval(received=3) == FixedPoll().interval
+    waits = [policy.next_interval(received=0) for _ in range(6)]
+    assert waits == sorted(waits) and waits[0] >= FixedPoll().interval
+    assert waits[-1] == policy.max_interval
+
+
+@pytest.fixture
+def server():
+    server = DSPServer()
+    server.start_in_thread()
+    yield server
+    server.stop_thread()
+
+
+def new_profile(tmp_path, password="password") -> str:
+    path = tmp_path / "alice.dsu"
+    path.touch()
+    Profile("127.0.0.1", "alice", password).save_profile(str(path))
+    return str(path)
+
+
+def send(server, *texts, frm="bob", to="alice"):
+    sender = DirectMessenger("127.0.0.1", frm, "password", server.port)
+    assert sender.send_many([(text, to) for text in texts]) == [True] * len(texts)
+    sender.close()
+
+
+def changed_elsewhere(path) -> None:
+    """saves the profile at path from another Profile, like another program would"""
+    other = Profile()
+    other.load_profile(path)
+    other.bio = "changed elsewhere"
+    other.save_profile(path)
+
+
+def test_sync_worker_poll_queues_messages_and_counts_them(server, tmp_path):
+    path = new_profile(tmp_path)
+    cache = ProfileCache()
+    persister = ProfilePersister(cache, interval=60)
+    worker = SyncWorker(path, cache, persister, FixedPoll(), "127.0.0.1", server.port)
+
+    send(server, "one", "two", "three")
+    assert [m['message'] for m in worker.poll()] == ["one", "two", "three"]
+    assert worker.poll() == []
+    send(server, "four")
+    assert [m['message'] for m in worker.poll()] == ["four"]
+
+    assert [kind for kind, _ in worker.drain(3)] == ["message"] * 3
+    assert [message['message'] for _, message in worker.drain(10)] == ["four"]
+    assert worker.drain(10) == [] and not worker.pending()
+    metrics = worker.metrics()
+    assert (metrics['polls'], metrics['empty_polls'], metrics['errors'], metrics['messages']) == (3, 1, 0, 4)
+    assert server.joins == 3  # two senders, and one session for all the polls
+
+    persister.close()
+    worker._messenger.close()
+    saved = Profile()
+    saved.load_profile(path)
+    assert [m['message'] for m in saved.get_chat_messages("bob")] == ["one", "two", "three", "four"]
+
+
+def test_sync_worker_reports_a_wrong_password(server, tmp_path):
+    path = new_profile(tmp_path, password="wrong")
+    owner = DirectMessenger("127.0.0.1", "alice", "password", server.port)
+    owner.retrieve_new()  # the username now belongs to another password
+    owner.close()
+    cache = ProfileCache()
+    worker = SyncWorker(path, cache, ProfilePersister(cache), FixedPoll(), "127.0.0.1", server.port)
+
+    assert worker.poll() == []
+    assert worker.drain(10) == [('error', "The server did not accept the username and password of alice")]
+    assert worker.metrics()['errors'] == 1 and worker.metrics()['polls'] == 0
+
+
+def test_sync_worker_merges_into_a_profile_loaded_again_during_the_poll(server, tmp_path):
+    path = new_profile(tmp_path)
+    cache = ProfileCache()
+    persister = ProfilePersister(cache, interval=60)
+    worker = SyncWorker(path, cache, persister, FixedPoll(), "127.0.0.1", server.port)
+    profile = cache.get(path)
+
+    messenger = worker._messenger = DirectMessenger("127.0.0.1", "alice", "password", server.port)
+    sync = messenger.sync
+
+    def sync_while_the_file_changes(synced, full=False):
+        # e.g. the GUI takes the profile from the cache after another program saved it
+        changed_elsewhere(path)
+        assert cache.get(path) is not synced
+        return sync(synced, full)
+
+    messenger.sync = sync_while_the_file_changes
+    send(server, "hello")
+    assert [m['message'] for m in worker.poll()] == ["hello"]
+    messenger.close()
+
+    current = cache.get(path)
+    assert current is not profile and current.bio == "changed elsewhere"
+    assert [m['message'] for m in current.get_chat_messages("bob")] == ["hello"]
+    assert current.get_last_sync() > 0
+    persister.close()
+    saved = Profile()
+    saved.load_profile(path)
+    assert saved.bio == "changed elsewhere" and [m['message'] for m in saved.get_chat_messages("bob")] == ["hello"]
+
+
+def test_outbox_adds_sent_messages_to_a_profile_loaded_again_during_the_send(server, tmp_path):
+    path = new_profile(tmp_path)
+    cache = ProfileCache()
+    persister = ProfilePersister(cache, interval=60)
+    outbox = Outbox(path, cache, persister, dsuserver="127.0.0.1", port=server.port)
+    profile = cache.get(path)
+
+    messenger = outbox._messenger = DirectMessenger("127.0.0.1", "alice", "password", server.port)
+    send_many = messenger.send_many
+
+    def send_while_the_file_changes(messages):
+        changed_elsewhere(path)
+        assert cache.get(path) is not profile
+        return send_many(messages)
+
+    messenger.send_many = send_while_the_file_changes
+    outbox.send("hi bob", "bob")
+    assert outbox.flush()
+    messenger.close()
+
+    current = cache.get(path)
+    assert current is not profile
+    assert [m['message'] for m in current.get_chat_messages("bob")] == ["hi bob"]
+    persister.close()
+    saved = Profile()
+    saved.load_profile(path)
+    assert saved.bio == "changed elsewhere" and [m['message'] for m in saved.get_chat_messages("bob")] == ["hi bob"]
+
+
+def saved_entries(path) -> list:
+    file = outbox_path(path)
+    return json.loads(file.read_text()) if file.exists() else []
+
+
+def test_outbox_keeps_pending_messages_across_a_restart(server, tmp_path):
+    path = new_profile(tmp_path)
+    cache = ProfileCache()
+    outbox = Outbox(path, cache, ProfilePersister(cache, interval=60), dsuserver="127.0.0.1", port=server.port)
+    first = outbox.send("one", "bob")
+    outbox.send("two", "carol")
+    assert [entry['status'] for entry in outbox.entries()] == ["pending", "pending"]
+    assert [entry['message'] for entry in outbox.entries("carol")] == ["two"]
+    assert outbox.drain(10) == [first, outbox.entries()[1]]
+
+    # the server goes away: nothing can be written, so both stay pending and are saved for a restart
+    server.stop_thread()
+    assert not outbox.flush()
+    assert [(entry['message'], entry['status']) for entry in saved_entries(path)] == [("one", "pending"),
+                                                                                      ("two", "pending")]
+    assert outbox.drain(10) == []
+
+    server = DSPServer(port=server.port)
+    server.start_in_thread()
+    try:
+        cache = ProfileCache()
+        persister = ProfilePersister(cache, interval=60)
+        restarted = Outbox(path, cache, persister, dsuserver="127.0.0.1", port=server.port)
+        assert [entry['message'] for entry in restarted.entries()] == ["one", "two"]
+        assert restarted.send("three", "bob")['id'] == 2
+        assert restarted.flush()
+        restarted._messenger.close()
+    finally:
+        server.stop_thread()
+
+    assert restarted.entries() == [] and not outbox_path(path).exists()
+    assert [(entry['message'], entry['status']) for entry in restarted.drain(10)[1:]] == [
+        ("one", "sent"), ("two", "sent"), ("three", "sent")]
+    assert [message["message"] for message in server._inbox["bob"]] == ["one", "three"]
+    persister.close()
+    saved = Profile()
+    saved.load_profile(path)
+    assert [m['message'] for m in saved.get_chat_messages("bob")] == ["one", "three"]
+    assert [m['message'] for m in saved.get_chat_messages("carol")] == ["two"]
+
+
+def test_outbox_fails_messages_the_server_refuses(server, tmp_path):
+    path = new_profile(tmp_path)
+    cache = ProfileCache()
+    outbox = Outbox(path, cache, ProfilePersister(cache, interval=60), dsuserver="127.0.0.1", port=server.port)
+    outbox.send("accepted", "bob")
+    assert outbox.flush()
+    outbox.drain(10)
+
+    outbox._messenger.token = "expired"
+    outbox.send("refused", "bob")
+    assert outbox.flush()
+    outbox._messenger.close()
+    assert [(entry['message'], entry['status']) for entry in outbox.drain(10)] == [
+        ("refused", "pending"), ("refused", "failed")]
+    assert [entry['status'] for entry in outbox.entries()] == ["failed"]
+    # a failed message is not sent again
+    assert saved_entries(path) == []
+    assert outbox.flush() and outbox.batches == 2
+    assert [message["message"] for message in server._inbox["bob"]] == ["accepted"]
+
+
+def test_outbox_does_not_send_a_batch_twice_when_the_connection_drops(server, tmp_path):
+    path = new_profile(tmp_path)
+    cache = ProfileCache()
+    outbox = Outbox(path, cache, ProfilePersister(cache, interval=60), dsuserver="127.0.0.1", port=server.port)
+    outbox.send("a", "bob")
+    assert outbox.flush()
+
+    # the server handles "b" and drops the connection before answering; "c" is never read
+    server.reply_loss_rate = 1.0
+    outbox.send("b", "bob")
+    outbox.send("c", "bob")
+    assert not outbox.flush()
+    server.reply_loss_rate = 0.0
+    assert [(entry['message'], entry['status']) for entry in outbox.entries()] == [("b", "failed"), ("c", "failed")]
+    assert saved_entries(path) == []
+
+    outbox.send("d", "bob")
+    assert outbox.flush()
+    outbox._messenger.close()
+    assert [message["message"] for message in server._inbox["bob"]] == ["a", "b", "d"]
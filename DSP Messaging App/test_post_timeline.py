@@ -0,0 +1,86 @@
+import random
+
+import pytest
+
+from post_timeline import PostTimeline
+
+
+class Post:
+    def __init__(self, timestamp, entry=""):
+        self.timestamp = timestamp
+        self.entry = entry
+        self._id = None
+
+    def __repr__(self):
+        return f"Post({self.timestamp!r}, {self.entry!r})"
+
+
+def small_timeline(posts=()) -> PostTimeline:
+    timeline = PostTimeline()
+    timeline.load = 4  # buckets split at 8 posts, so a few dozen posts make many buckets
+    timeline.extend(posts)
+    return timeline
+
+
+def test_positions_follow_inserts_deletes_and_bucket_splits():
+    rng = random.Random(7)
+    timeline = small_timeline()
+    expected = []
+    for step in range(600):
+        if expected and rng.random() < 0.35:
+            index = rng.randrange(-len(expected), len(expected))
+            assert timeline.pop(index) is expected.pop(index)
+        else:
+            post = Post(rng.randrange(50), str(step))
+            timeline.add(post)
+            # equal timestamps keep the order they were added in
+            expected.insert(sum(1 for p in expected if p.timestamp <= post.timestamp), post)
+        if step % 20 == 0:
+            assert [timeline[i] for i in range(len(expected))] == expected
+            assert [timeline[-i] for i in range(1, len(expected) + 1)] == expected[::-1]
+
+    assert len(timeline._buckets) > 2
+    assert list(timeline) == expected and len(timeline) == len(expected)
+    assert timeline[3:9] == expected[3:9] and timeline[::-5] == expected[::-5]
+    with pytest.raises(IndexError):
+        timeline[len(expected)]
+    with pytest.raises(IndexError):
+        timeline[-len(expected) - 1]
+
+
+def test_split_buckets_keep_order_and_positions():
+    timeline = small_timeline()
+    posts = [Post(float(i)) for i in range(20)]
+    for post in posts:
+        timeline.add(post)  # appends until the last bucket splits, again and again
+    assert len(timeline._buckets) > 1 and all(len(bucket) <= 2 * timeline.load for bucket in timeline._buckets)
+    assert [timeline[i] for i in range(20)] == posts
+
+    middle = Post(9.5)
+    timeline.add(middle)
+    assert timeline[10] is middle and timeline[11] is posts[10] and timeline[-1] is posts[-1]
+
+
+def test_ranges_ids_and_latest():
+    posts = [Post(float(i // 2), str(i)) for i in range(40)]
+    shuffled = posts[:]
+    random.Random(3).shuffle(shuffled)
+    timeline = small_timeline(shuffled[:30])
+    for post in shuffled[30:]:
+        timeline.add(post)
+    assert list(timeline) == sorted(posts, key=lambda post: (post.timestamp, shuffled.index(post)))
+
+    assert [p.timestamp for p in timeline.between(3.0, 5.0)] == [3.0, 3.0, 4.0, 4.0]
+    assert [p.timestamp for p in timeline.between(end=1.0)] == [0.0, 0.0]
+    assert [p.timestamp for p in timeline.between(18.5)] == [19.0, 19.0]
+    assert timeline.between(7.0, 7.0) == [] and timeline.between(100.0) == []
+    assert [p.timestamp for p in timeline.latest(3)] == [18.0, 19.0, 19.0]
+    assert timeline.latest(100) == list(timeline)
+
+    first = posts[0]
+    assert timeline.get(first._id) is first
+    assert timeline.remove_id(first._id) is first and timeline.remove_id(first._id) is None
+    assert timeline.get(first._id) is None
+    assert sorted(p.entry for p in timeline.remove_time(5.0)) == ["10", "11"]
+    assert len(timeline) == 37 and timeline.between(5.0, 6.0) == []
+    assert [timeline[i] for i in range(37)] == list(timeline)
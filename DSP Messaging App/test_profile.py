@@ -0,0 +1,356 @@
+import json
+import threading
+import time
+
+import pytest
+
+from ds_messenger import DirectMessage
+from history_archive import archive_profile
+from message_store import ContactTable, MessageStore, MessageView
+from Profile import Profile, ProfileCache, ProfilePersister, chat_index_path, compact_profile, journal_path
+from search_index import SearchIndex, search_index_path
+
+
+def message(text, timestamp):
+    return DirectMessage(message=text, timestamp=timestamp, recipient="alice", frm="bob")
+
+
+def new_profile(tmp_path):
+    path = tmp_path / "alice.dsu"
+    path.touch()
+    profile = Profile("127.0.0.1", "alice", "password")
+    profile.save_profile(str(path))
+    return profile, path
+
+
+def texts(path):
+    profile = Profile()
+    profile.load_profile(str(path))
+    return [m['message'] for m in profile.get_chat_messages("bob")]
+
+
+def test_save_after_a_torn_journal_line_is_kept(tmp_path):
+    profile, path = new_profile(tmp_path)
+    profile.add_msg(message("before the crash", 1.0))
+    profile.save_profile(str(path))
+    # a save that crashed part way through its write
+    with open(journal_path(path), 'ab') as f:
+        f.write(b'{"msg": {"message": "torn')
+
+    profile.add_msg(message("after the crash", 2.0))
+    profile.save_profile(str(path))
+    profile.add_msg(message("and later", 3.0))
+    profile.save_profile(str(path))
+
+    assert texts(path) == ["before the crash", "after the crash", "and later"]
+
+
+def test_torn_line_in_the_middle_of_the_journal_is_skipped(tmp_path):
+    profile, path = new_profile(tmp_path)
+    profile.add_msg(message("first", 1.0))
+    profile.save_profile(str(path))
+    with open(journal_path(path), 'ab') as f:
+        f.write(b'{"msg": \xe2\x82\n')
+    profile.add_msg(message("second", 2.0))
+    profile.save_profile(str(path))
+
+    assert texts(path) == ["first", "second"]
+
+
+def test_compaction_keeps_unsaved_changes_of_the_cached_profile(tmp_path):
+    _, path = new_profile(tmp_path)
+    cache = ProfileCache(lazy=True)
+    persister = ProfilePersister(cache, interval=60)
+    profile = cache.get(str(path))
+    profile.add_msg(message("saved", 1.0))
+    cache.save(str(path))
+    profile.add_msg(message("not saved yet", 2.0))
+    persister.mark_dirty(str(path))
+
+    compact_profile(str(path))
+
+    assert cache.get(str(path)) is profile
+    persister.close()
+    assert texts(path) == ["saved", "not saved yet"]
+
+
+def test_archiving_keeps_unsaved_changes_of_the_cached_profile(tmp_path):
+    _, path = new_profile(tmp_path)
+    cache = ProfileCache()
+    persister = ProfilePersister(cache, interval=60)
+    profile = cache.get(str(path))
+    for i in range(5):
+        profile.add_msg(message(f"old {i}", float(i)))
+    cache.save(str(path))
+    profile.add_msg(message("not saved yet", 10.0))
+    persister.mark_dirty(str(path))
+
+    archive_profile(str(path), keep=2)
+
+    reloaded = cache.get(str(path))
+    assert [m['message'] for m in reloaded.get_chat_messages("bob")][-1] == "not saved yet"
+    persister.close()
+    assert texts(path) == ["old 0", "old 1", "old 2", "old 3", "old 4", "not saved yet"]
+
+
+def test_readers_wait_for_a_background_save(tmp_path):
+    profile, path = new_profile(tmp_path)
+    profile.add_msg(message("hello", 1.0))
+    profile.save_profile(str(path))
+    lazy = Profile()
+    lazy.load_profile(str(path), lazy=True)
+
+    results = []
+    with lazy._lock:
+        # e.g. the persister thread in the middle of _write_snapshot, reading every chat into the profile
+        readers = [threading.Thread(target=lambda: results.append(lazy.chat_count("bob"))),
+                   threading.Thread(target=lambda: results.append(lazy.latest_posts(1))),
+                   threading.Thread(target=lambda: results.append(lazy.get_posts_between())),
+                   threading.Thread(target=lambda: results.append(lazy.get_posts()))]
+        for reader in readers:
+            reader.start()
+        time.sleep(0.05)
+        assert results == []
+        lazy._load_all_chats()
+    for reader in readers:
+        reader.join()
+    assert 1 in results and len(results) == 4
+
+
+def test_add_msg_ignores_messages_the_profile_already_has(tmp_path):
+    profile, path = new_profile(tmp_path)
+    assert profile.add_msg(message("hi", 1.0))
+    assert not profile.add_msg(message("hi", 1.0))
+    # the same text at another time, or from someone else, is a different message
+    assert profile.add_msg(message("hi", 2.0))
+    assert profile.add_msg(DirectMessage(message="hi", timestamp=1.0, recipient="alice", frm="carol"))
+    # timestamps the server sends as strings are the same message as the float
+    assert not profile.add_msg(DirectMessage(message="hi", timestamp="1.0", recipient="alice", frm="bob"))
+    profile.save_profile(str(path))
+
+    loaded = Profile()
+    loaded.load_profile(str(path))
+    assert not loaded.add_msg(message("hi", 2.0))
+    assert len(loaded.get_chat_messages("bob")) == 2
+    assert len(loaded.get_chat_messages("carol")) == 1
+
+
+def test_chat_index_keeps_each_chat_sorted_and_answers_ranges(tmp_path):
+    profile, _ = new_profile(tmp_path)
+    for timestamp in [5.0, 1.0, 3.0, 2.0, 4.0]:
+        profile.add_msg(message(f"bob {timestamp:g}", timestamp))
+    profile.add_msg(DirectMessage(message="to carol", timestamp=2.5, recipient="carol", frm="alice"))
+    profile.add_msg(DirectMessage(message="from carol", timestamp=1.5, recipient="alice", frm="carol"))
+
+    assert [m['message'] for m in profile.get_chat_messages("bob")] == [f"bob {i}" for i in range(1, 6)]
+    # messages the profile's user sent belong to the chat with their recipient
+    assert [m['message'] for m in profile.get_chat_messages("carol")] == ["from carol", "to carol"]
+    assert profile.get_chat_messages("dave") == []
+
+    def texts_between(**kwargs):
+        return [m['message'] for m in profile.get_chat_messages("bob", **kwargs)]
+
+    assert texts_between(since=2.0, until=4.0) == ["bob 2", "bob 3"]
+    assert texts_between(limit=2) == ["bob 4", "bob 5"]
+    assert texts_between(until=4.0, limit=2) == ["bob 2", "bob 3"]
+    assert profile.chat_count("bob") == 5
+
+
+def test_message_store_hands_out_dict_like_views():
+    store = MessageStore()
+    first = store.append(message("hello", 1.5))
+    second = store.append_fields("alice", "bob", "2", "reply")
+    assert (first, second, len(store)) == (0, 1, 2)
+
+    view = store[0]
+    assert dict(view) == {"timestamp": 1.5, "message": "hello", "recipient": "alice", "from": "bob", "frm": "bob"}
+    assert view == {"timestamp": 1.5, "message": "hello", "recipient": "alice", "from": "bob", "frm": "bob"}
+    assert (view.get_message(), view.get_time()) == ("hello", 1.5)
+    assert json.loads(json.dumps(dict(store[-1])))["timestamp"] == 2.0
+    assert store.row(1) == ("alice", "bob", 2.0, "reply")
+    assert [m["message"] for m in store] == ["hello", "reply"]
+    assert [m["message"] for m in store[::-1]] == ["reply", "hello"]
+    with pytest.raises(IndexError):
+        store[2]
+    with pytest.raises(KeyError):
+        view["bio"]
+
+
+def test_profile_messages_are_stored_in_columns(tmp_path):
+    profile, path = new_profile(tmp_path)
+    profile.add_msg(message("hello", 1.0))
+    assert isinstance(profile._messages, MessageStore)
+    assert isinstance(profile.get_chat_messages("bob")[0], MessageView)
+    profile.save_profile(str(path))
+    compact_profile(str(path))
+    # the file keeps the DirectMessage dictionaries it always had
+    assert json.loads(path.read_text())["_messages"] == [
+        {"timestamp": 1.0, "message": "hello", "recipient": "alice", "from": "bob", "frm": "bob"}]
+
+
+def test_contact_table_interns_usernames():
+    contacts = ContactTable(["bob", "carol", "bob"])
+    assert list(contacts) == ["bob", "carol"] and len(contacts) == 2
+    assert contacts.intern("dave") == 2  # seen, but not a contact
+    assert "dave" not in contacts and "bob" in contacts
+    contacts.append("dave")
+    assert contacts[-1] == "dave" and contacts[:2] == ["bob", "carol"]
+    assert contacts.index("carol") == 1 and contacts.id("carol") == 1 and contacts.id("erin") is None
+    assert contacts == ["bob", "carol", "dave"]
+    with pytest.raises(ValueError):
+        contacts.index("erin")
+
+
+def test_profile_shares_its_contact_table_with_the_message_store(tmp_path):
+    profile, path = new_profile(tmp_path)
+    for i in range(3):
+        profile.add_msg(message(f"hi {i}", float(i)))
+    profile.add_msg(DirectMessage(message="yo", timestamp=5.0, recipient="alice", frm="carol"))
+    assert profile._users == ["bob", "carol"]
+    assert profile._messages._names is profile._users
+    # every message refers to the same interned id for "bob"
+    assert set(profile._messages._senders[:3]) == {profile._users.id("bob")}
+    profile.save_profile(str(path))
+
+    loaded = Profile()
+    loaded.load_profile(str(path))
+    assert loaded._users == ["bob", "carol"]
+
+
+def lazy_fixture(tmp_path):
+    profile, path = new_profile(tmp_path)
+    for i in range(5):
+        profile.add_msg(message(f"bob {i}", float(i)))
+        profile.add_msg(DirectMessage(message=f"carol {i}", timestamp=float(i), recipient="alice", frm="carol"))
+    profile.save_profile(str(path))
+    compact_profile(str(path))  # writes the base file with its chat index
+    return profile, path
+
+
+def test_lazy_load_reads_one_chat_at_a_time(tmp_path):
+    profile, path = lazy_fixture(tmp_path)
+    profile.add_msg(message("bob late", 10.0))  # only in the journal
+    profile.save_profile(str(path))
+
+    lazy = Profile()
+    lazy.load_profile(str(path), lazy=True)
+    assert set(lazy._lazy_chats) == {"bob", "carol"} and len(lazy._messages) == 0
+    assert lazy.chat_count("bob") == 6 and len(lazy._messages) == 0
+    assert [m['message'] for m in lazy.get_chat_messages("bob", limit=2)] == ["bob 4", "bob late"]
+    assert len(lazy._messages) == 0  # a page is read without reading the chat
+
+    assert len(lazy.get_chat_messages("bob")) == 6
+    assert "bob" not in lazy._lazy_chats and "carol" in lazy._lazy_chats
+    assert [m['message'] for m in lazy.get_chat_messages("carol")] == [f"carol {i}" for i in range(5)]
+    assert lazy._lazy_source is None
+
+
+@pytest.mark.parametrize("damage", ["missing", "stale", "garbage"])
+def test_lazy_load_falls_back_without_a_matching_chat_index(tmp_path, damage):
+    _, path = lazy_fixture(tmp_path)
+    index = chat_index_path(path)
+    if damage == "missing":
+        index.unlink()
+    elif damage == "stale":
+        # the index describes an older version of the file
+        data = json.loads(index.read_text())
+        data['base'][1] += 1
+        index.write_text(json.dumps(data))
+    else:
+        index.write_text("{not json")
+
+    lazy = Profile()
+    lazy.load_profile(str(path), lazy=True)
+    assert lazy._lazy_chats == {}
+    assert len(lazy.get_chat_messages("bob")) == 5 and len(lazy.get_chat_messages("carol")) == 5
+
+
+def test_lazy_profile_survives_compaction_of_its_file(tmp_path):
+    profile, path = lazy_fixture(tmp_path)
+    lazy = Profile()
+    lazy.load_profile(str(path), lazy=True)
+
+    # the file is rewritten with its chats at other offsets
+    profile.add_msg(DirectMessage(message="a" * 5000, timestamp=0.5, recipient="alice", frm="bob"))
+    profile.save_profile(str(path))
+    compact_profile(str(path))
+
+    assert [m['message'] for m in lazy.get_chat_messages("carol")] == [f"carol {i}" for i in range(5)]
+    assert len(lazy.get_chat_messages("bob")) >= 5
+
+
+def searchable(tmp_path):
+    profile, path = new_profile(tmp_path)
+    profile.add_msg(message("lunch tomorrow at noon", 1.0))
+    profile.add_msg(message("meeting moved to tomorrow", 2.0))
+    profile.add_msg(message("help with the meetup", 3.0))
+    profile.add_msg(DirectMessage(message="Tomorrow works", timestamp=4.0, recipient="alice", frm="carol"))
+    profile.save_profile(str(path))
+    return profile, path
+
+
+def found(profile, query, **kwargs):
+    return [m['message'] for m in profile.search(query, **kwargs)]
+
+
+def test_search_matches_every_word_newest_first(tmp_path):
+    profile, _ = searchable(tmp_path)
+    assert found(profile, "tomorrow") == ["Tomorrow works", "meeting moved to tomorrow", "lunch tomorrow at noon"]
+    assert found(profile, "TOMORROW lunch") == ["lunch tomorrow at noon"]
+    assert found(profile, "meet*") == ["help with the meetup", "meeting moved to tomorrow"]
+    assert found(profile, "meet* tomorrow") == ["meeting moved to tomorrow"]
+    assert found(profile, "tomorrow", contact="carol") == ["Tomorrow works"]
+    assert found(profile, "tomorrow", contact="dave") == []
+    assert found(profile, "tomorrow", limit=2) == ["Tomorrow works", "meeting moved to tomorrow"]
+    assert found(profile, "tomorrow", limit=None) == found(profile, "tomorrow")
+    assert found(profile, "dinner") == [] and found(profile, "  ") == []
+
+
+def test_search_finds_new_and_archived_messages(tmp_path):
+    profile, path = searchable(tmp_path)
+    assert found(profile, "noon") == ["lunch tomorrow at noon"]
+    profile.add_msg(message("noon is fine", 5.0))
+    assert found(profile, "noon") == ["noon is fine", "lunch tomorrow at noon"]
+    profile.save_profile(str(path))
+
+    archive_profile(str(path), keep=1)
+    loaded = Profile()
+    loaded.load_profile(str(path))
+    assert found(loaded, "noon") == ["noon is fine", "lunch tomorrow at noon"]
+    assert found(loaded, "meet*", contact="bob") == ["help with the meetup", "meeting moved to tomorrow"]
+
+
+def test_search_index_is_saved_and_read_back(tmp_path):
+    profile, path = searchable(tmp_path)
+    found(profile, "tomorrow")  # builds the index and saves it next to the file
+    assert search_index_path(path).exists()
+    profile.add_msg(message("tomorrow again", 5.0))  # saved after the index, in the journal
+    profile.save_profile(str(path))
+
+    loaded = Profile()
+    loaded.load_profile(str(path))
+    assert loaded._search_pending is not None  # the saved index is only read when a search needs it
+    loaded.add_msg(message("see you tomorrow", 6.0))
+    assert found(loaded, "tomorrow", contact="bob") == [
+        "see you tomorrow", "tomorrow again", "meeting moved to tomorrow", "lunch tomorrow at noon"]
+
+
+@pytest.mark.parametrize("damage", ["missing", "stale", "garbage"])
+def test_search_rebuilds_an_index_that_does_not_match_the_file(tmp_path, damage):
+    profile, path = searchable(tmp_path)
+    found(profile, "tomorrow")
+    index = search_index_path(path)
+    if damage == "missing":
+        index.unlink()
+    elif damage == "stale":
+        # an index of another version of the file, which has "dinner" in it
+        other = SearchIndex()
+        other.add("bob", 1.0, "dinner tomorrow")
+        other.save(index, [1, 1])
+    else:
+        index.write_bytes(b"{not json\n")
+
+    loaded = Profile()
+    loaded.load_profile(str(path))
+    assert found(loaded, "dinner") == []
+    assert found(loaded, "tomorrow") == ["Tomorrow works", "meeting moved to tomorrow", "lunch tomorrow at noon"]
@@ -0,0 +1,91 @@
+import json
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+from ds_messenger import DirectMessage
+from profile_cli import export_profile, import_profile, open_profile
+from Profile import Post, Profile, compact_profile
+from sqlite_profile import SqliteProfile
+
+
+def history_file(tmp_path) -> Path:
+    path = tmp_path / "alice.dsu"
+    path.touch()
+    profile = Profile("127.0.0.1", "alice", "password")
+    profile.add_post(Post("first post", 1.0))
+    for i in range(3):
+        profile.add_msg(DirectMessage(message=f"bob {i}", timestamp=float(i), recipient="alice", frm="bob"))
+    profile.add_msg(DirectMessage(message="to carol", timestamp=5.0, recipient="carol", frm="alice"))
+    profile.save_profile(str(path))
+    compact_profile(str(path))
+    return path
+
+
+def lines(path) -> list:
+    return [json.loads(line) for line in Path(path).read_text().splitlines()]
+
+
+def test_export_writes_posts_then_one_chat_at_a_time(tmp_path):
+    path = history_file(tmp_path)
+    counts = export_profile(str(path), str(tmp_path / "history.ndjson"))
+    assert (counts['messages'], counts['posts']) == (4, 1)
+
+    entries = lines(tmp_path / "history.ndjson")
+    assert entries[0] == {'post': {'entry': "first post", 'timestamp': 1.0}}
+    assert [entry['msg']['message'] for entry in entries[1:]] == ["bob 0", "bob 1", "bob 2", "to carol"]
+    assert entries[-1]['msg'] == {'from': "alice", 'recipient': "carol", 'timestamp': 5.0, 'message': "to carol"}
+
+
+@pytest.mark.parametrize("suffix", [".dsu", ".dsdb"])
+def test_import_skips_duplicates_and_invalid_lines(tmp_path, suffix):
+    ndjson = tmp_path / "history.ndjson"
+    export_profile(str(history_file(tmp_path)), str(ndjson))
+    with open(ndjson, 'a') as f:
+        f.write('{"msg": {"frm": "dave", "recipient": "alice", "timestamp": "7", "message": "old frm key"}}\n')
+        f.write('not json\n{"other": 1}\n\n{"msg": {"from": "dave"}}\n')
+
+    target = tmp_path / f"bob{suffix}"
+    if suffix == ".dsu":
+        target.touch()
+        Profile("127.0.0.1", "alice", "password").save_profile(str(target))
+    else:
+        SqliteProfile("127.0.0.1", "alice", "password").save_profile(str(target))
+
+    counts = import_profile(str(target), str(ndjson))
+    assert (counts['messages'], counts['posts'], counts['duplicates'], counts['skipped']) == (5, 1, 0, 3)
+    # importing the same file again adds nothing
+    counts = import_profile(str(target), str(ndjson))
+    assert (counts['messages'], counts['posts'], counts['duplicates'], counts['skipped']) == (0, 0, 6, 3)
+
+    profile = open_profile(str(target))
+    assert [m['message'] for m in profile.get_chat_messages("bob")] == ["bob 0", "bob 1", "bob 2"]
+    assert [m['message'] for m in profile.get_chat_messages("dave")] == ["old frm key"]
+    assert [m['message'] for m in profile.get_chat_messages("carol")] == ["to carol"]
+    assert [post.entry for post in profile.get_posts()] == ["first post"]
+
+
+def run_cli(*args, cwd):
+    script = Path(__file__).with_name("profile_cli.py")
+    return subprocess.run([sys.executable, str(script), *args], cwd=cwd, capture_output=True, text=True)
+
+
+def test_command_line_round_trip(tmp_path):
+    path = history_file(tmp_path)
+    result = run_cli("export", path.name, "history.ndjson", cwd=tmp_path)
+    assert result.returncode == 0 and result.stdout.startswith("Exported 4 messages and 1 posts in ")
+
+    copy = tmp_path / "copy.dsu"
+    copy.touch()
+    Profile("127.0.0.1", "alice", "password").save_profile(str(copy))
+    result = run_cli("import", copy.name, "history.ndjson", cwd=tmp_path)
+    assert result.returncode == 0 and result.stdout.startswith("Imported 4 messages and 1 posts in ")
+    assert "skipped 0 duplicates and 0 invalid lines" in result.stdout
+    export_profile(str(copy), str(tmp_path / "again.ndjson"))
+    assert lines(tmp_path / "again.ndjson") == lines(tmp_path / "history.ndjson")
+
+    result = run_cli("export", "missing.dsu", "out.ndjson", cwd=tmp_path)
+    assert result.returncode == 1 and result.stdout.startswith("Unable to process the profile:")
+
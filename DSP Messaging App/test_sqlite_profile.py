@@ -0,0 +1,74 @@
+from ds_messenger import DirectMessage
+from history_archive import archive_profile
+from Profile import Post, Profile
+from sqlite_profile import SqliteProfile, migrate_dsu
+
+
+def test_migration_keeps_archived_messages(tmp_path):
+    dsu = tmp_path / "alice.dsu"
+    dsu.touch()
+    profile = Profile("127.0.0.1", "alice", "password")
+    for i in range(50):
+        profile.add_msg(DirectMessage(message=f"message {i}", timestamp=float(i), recipient="alice", frm="bob"))
+    profile.save_profile(str(dsu))
+    assert archive_profile(str(dsu), keep=10)['messages_archived'] == 40
+
+    migrated = migrate_dsu(str(dsu), str(tmp_path / "alice.dsdb"))
+    try:
+        assert [m['message'] for m in migrated.get_chat_messages("bob")] == [f"message {i}" for i in range(50)]
+    finally:
+        migrated.close()
+
+
+def received(text, timestamp, frm="bob"):
+    return DirectMessage(message=text, timestamp=timestamp, recipient="alice", frm=frm)
+
+
+def test_messages_contacts_and_cursor(tmp_path):
+    profile = SqliteProfile("127.0.0.1", "alice", "password")
+    for timestamp in [3.0, 1.0, 2.0]:
+        assert profile.add_msg(received(f"bob {timestamp:g}", timestamp))
+    assert not profile.add_msg(received("bob 1", 1.0))
+    assert profile.add_msg(DirectMessage(message="to carol", timestamp=4.0, recipient="carol", frm="alice"))
+
+    assert [m['message'] for m in profile.get_chat_messages("bob")] == ["bob 1", "bob 2", "bob 3"]
+    assert [m['message'] for m in profile.get_chat_messages("bob", since=2.0)] == ["bob 2", "bob 3"]
+    assert [m['message'] for m in profile.get_chat_messages("bob", until=3.0, limit=1)] == ["bob 2"]
+    assert [m['message'] for m in profile.get_chat_messages("carol")] == ["to carol"]
+    assert profile._users == ["bob", "carol"]
+    assert not profile.add_user("alice") and not profile.add_user("bob") and profile.add_user("dave")
+
+    profile.update_sync_cursor("bob", 3.0)
+    profile.update_sync_cursor("bob", 2.0)
+    assert profile.get_sync_cursor("bob") == 3.0
+    assert profile.get_sync_cursor("carol") == 0
+    profile.set_last_sync(10.0)
+
+    path = tmp_path / "alice.dsdb"
+    profile.save_profile(str(path))
+    profile.close()
+
+    loaded = SqliteProfile()
+    loaded.load_profile(str(path))
+    try:
+        assert (loaded.username, loaded.password, loaded.get_last_sync()) == ("alice", "password", 10.0)
+        assert loaded.get_sync_cursor("bob") == 3.0
+        assert len(loaded.get_chat_messages("bob")) == 3
+        assert loaded._users == ["bob", "carol", "dave"]
+    finally:
+        loaded.close()
+
+
+def test_posts():
+    profile = SqliteProfile("127.0.0.1", "alice", "password")
+    ids = profile.add_posts([Post("c", 3.0), Post("a", 1.0), Post("b", 2.0)])
+    assert [post.entry for post in profile.get_posts()] == ["a", "b", "c"]
+    assert [post.entry for post in profile.get_posts_between(2.0, 3.0)] == ["b"]
+    assert [post.entry for post in profile.latest_posts(2)] == ["b", "c"]
+
+    assert profile.del_post(0) and not profile.del_post(5)
+    assert profile.del_post_by_id(ids[0]) and not profile.del_post_by_id(ids[0])
+    assert [post.entry for post in profile.get_posts()] == ["b"]
+    assert profile.del_post_by_time(2.0)
+    assert profile.get_posts() == []
+    profile.close()